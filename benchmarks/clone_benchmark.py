@@ -0,0 +1,192 @@
+"""
+Clone throughput benchmark against the offline fake Drive server.
+
+Builds a generated source tree in a FakeDrive, runs GoogleDriveHelper.clone on it
+in a child process (so every run starts from a clean bot and its peak memory can
+be measured) and reports files/sec, API calls per file and peak memory. A run whose
+helper reports another number of copies than the fake Drive made fails.
+
+    python3 -m benchmarks.clone_benchmark
+    python3 -m benchmarks.clone_benchmark --scenario deep --latency 0.05 --rate-limit 0.02 --errors 0.01
+    python3 -m benchmarks.clone_benchmark --scenario small --quota 200
+
+Bot settings such as CLONE_WORKERS or COPY_BATCH_SIZE are read from the environment
+as usual, so the same scenario can be compared across configurations.
+"""
+import argparse
+import json
+import os
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.fake_drive import FakeDrive, FakeDriveServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVICE_ACCOUNTS = 5
+GB = 1024 ** 3
+
+
+def build_wide(drive, parent, scale):
+    """Many sibling folders with a few files each."""
+    for i in range(500 * scale):
+        folder = drive.add(f'folder{i}', parent, folder=True)
+        for j in range(4):
+            drive.add(f'file{i}_{j}.bin', folder, size=100 * 1024)
+
+
+def build_deep(drive, parent, scale):
+    """A single chain of nested folders."""
+    for i in range(200 * scale):
+        parent = drive.add(f'level{i}', parent, folder=True)
+        for j in range(2):
+            drive.add(f'file{i}_{j}.bin', parent, size=100 * 1024)
+
+
+def build_small(drive, parent, scale):
+    """Thousands of tiny files in a handful of folders."""
+    for i in range(10):
+        folder = drive.add(f'folder{i}', parent, folder=True)
+        for j in range(500 * scale):
+            drive.add(f'file{i}_{j}.txt', folder, size=1024)
+
+
+def build_huge(drive, parent, scale):
+    """A few very large files, enough to rotate through service account quotas."""
+    for i in range(20 * scale):
+        drive.add(f'video{i}.mkv', parent, size=50 * GB)
+
+
+def build_links(drive, parent, scale):
+    """A small tree cloned by /clone with several links, one of them bad, into two destinations."""
+    for i in range(2):
+        folder = drive.add(f'folder{i}', parent, folder=True)
+        for j in range(50 * scale):
+            drive.add(f'file{i}_{j}.txt', folder, size=1024)
+
+
+SCENARIOS = {
+    'wide': build_wide,
+    'deep': build_deep,
+    'small': build_small,
+    'huge': build_huge,
+    'links': build_links,
+}
+# Extra links and destinations of multi-link scenarios.
+BAD_LINK = 'https://drive.google.com/open'
+LINKS = {'links': [BAD_LINK]}
+DESTINATIONS = {'links': 2}
+
+
+def private_key():
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    return key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                             serialization.NoEncryption()).decode()
+
+
+def run_scenario(name, args, key):
+    drive = FakeDrive(latency=args.latency, rate_limit_ratio=args.rate_limit, error_ratio=args.errors,
+                      quota=args.quota)
+    source = drive.add(name, folder=True)
+    destinations = [drive.add(f'destination{i}', folder=True) for i in range(DESTINATIONS.get(name, 1))]
+    SCENARIOS[name](drive, source, args.scale)
+    files, folders, size = drive.count(source)
+    server = FakeDriveServer(drive).start()
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            server.write_service_accounts(os.path.join(workdir, 'accounts'), SERVICE_ACCOUNTS, key)
+            env = dict(os.environ,
+                       PYTHONPATH=os.pathsep.join(filter(None, [ROOT, os.environ.get('PYTHONPATH')])),
+                       DRIVE_DISCOVERY_FILE=server.write_discovery(os.path.join(workdir, 'discovery.json')),
+                       USE_SERVICE_ACCOUNTS='True')
+            env.setdefault('BOT_TOKEN', '123456:benchmark')
+            drive.calls.clear()
+            links = ','.join([source] + LINKS.get(name, []))
+            child = subprocess.run([sys.executable, '-m', 'benchmarks.clone_benchmark', '--child', links,
+                                    ','.join(destinations)],
+                                   cwd=workdir, env=env, capture_output=True, text=True)
+    finally:
+        server.stop()
+    if child.returncode != 0:
+        raise RuntimeError(f"{name}: clone failed\n{child.stderr[-2000:]}")
+    result = json.loads(child.stdout.strip().splitlines()[-1])
+    copied = [sum(totals) for totals in zip(*(drive.count(destination) for destination in destinations))]
+    if result['copied'] != copied[0]:
+        raise RuntimeError(f"{name}: the clone reported {result['copied']} copies, {copied[0]} were made")
+    calls = sum(count for call, count in drive.calls.items() if call not in ('token', 'batch', 'http')
+                and not call.startswith('error:'))
+    return {
+        'scenario': name,
+        'files': files,
+        'folders': folders,
+        'size_gb': round(size / GB, 2),
+        'copied': copied[0],
+        'seconds': round(result['seconds'], 2),
+        'files_per_sec': round(files / result['seconds'], 1) if result['seconds'] else 0,
+        'api_calls': calls,
+        'http_requests': drive.calls['http'],
+        'calls_per_file': round(calls / files, 3) if files else 0,
+        'errors_injected': drive.calls['error:403'] + drive.calls['error:500'] + drive.calls['error:429'],
+        'peak_mb': round(result['peak_kb'] / 1024, 1),
+    }
+
+
+def child(links, destinations):
+    """Runs one clone inside the benchmark's working directory and prints its timings as JSON."""
+    from bot.clone_status import CloneStatus
+    from bot.gDrive import GoogleDriveHelper
+    links, destinations = links.split(','), destinations.split(',')
+    status = CloneStatus()
+    helper = GoogleDriveHelper(GFolder_ID=destinations[0])
+    start = time.perf_counter()
+    copied = None
+    if len(links) > 1:
+        summary = helper.cloneLinks(links, destinations, status)
+        # The total users see, added up link by link.
+        copied = int(re.search(r'(\d+) archivos copiados', summary).group(1))
+    elif len(destinations) > 1:
+        helper.cloneMany(links[0], destinations, status)
+    else:
+        helper.clone(links[0], status)
+    seconds = time.perf_counter() - start
+    helper.releaseAccounts()
+    print(json.dumps({'seconds': seconds, 'copied': helper.copied_files if copied is None else copied,
+                      'peak_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenario', choices=sorted(SCENARIOS) + ['all'], default='all')
+    parser.add_argument('--scale', type=int, default=1, help='multiplies the size of every generated tree')
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds added to every API call')
+    parser.add_argument('--rate-limit', type=float, default=0.0, help='share of calls failing with 403 userRateLimitExceeded')
+    parser.add_argument('--errors', type=float, default=0.0, help='share of calls failing with 500 backendError')
+    parser.add_argument('--quota', type=int, default=0,
+                        help='API calls per second the server accepts before answering 429 (0: no limit)')
+    parser.add_argument('--json', action='store_true', help='print one JSON object per scenario')
+    parser.add_argument('--child', nargs=2, metavar=('LINKS', 'DESTINATIONS'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        return child(*args.child)
+
+    key = private_key()
+    names = sorted(SCENARIOS) if args.scenario == 'all' else [args.scenario]
+    columns = ('scenario', 'files', 'folders', 'size_gb', 'copied', 'seconds', 'files_per_sec',
+               'api_calls', 'http_requests', 'calls_per_file', 'errors_injected', 'peak_mb')
+    if not args.json:
+        print(' '.join(f'{column:>15}' for column in columns))
+    for name in names:
+        result = run_scenario(name, args, key)
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print(' '.join(f'{result[column]!s:>15}' for column in columns))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,433 @@
+"""
+Offline stand-in for the Drive v3 endpoints used by the bot.
+
+Serves files.get/list/copy/create/update/delete/generateIds, permissions.create,
+changes.getStartPageToken/list, batch requests and a service account token
+endpoint from an in-memory tree, with configurable latency and injected
+403 rate-limit / 5xx errors. Responses only hold the fields asked for, like Drive's.
+"""
+import hashlib
+import itertools
+import json
+import os
+import random
+import re
+import threading
+import time
+from collections import Counter
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, unquote
+
+FOLDER_MIME_TYPE = "application/vnd.google-apps.folder"
+DISCOVERY_DOCUMENT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                  'bot', 'drive_v3_discovery.json')
+_FILE_FIELDS = 'kind, id, name, mimeType'
+# What Drive returns without a fields parameter.
+DEFAULT_FIELDS = {
+    'files.get': _FILE_FIELDS,
+    'files.copy': _FILE_FIELDS,
+    'files.create': _FILE_FIELDS,
+    'files.update': _FILE_FIELDS,
+    'files.list': f'kind, incompleteSearch, nextPageToken, files({_FILE_FIELDS})',
+    'changes.list': f'kind, nextPageToken, newStartPageToken, '
+                    f'changes(kind, changeType, time, removed, fileId, file({_FILE_FIELDS}))',
+}
+
+
+def parse_fields(fields):
+    """:return: {field: sub-selection or None} of a field mask like 'nextPageToken, files(id, parents)'"""
+    selection, _ = _parse_fields(fields.replace(' ', ''), 0)
+    return selection
+
+
+def _parse_fields(text, i):
+    selection = {}
+    name = ''
+    while i < len(text):
+        c = text[i]
+        if c == '(':
+            sub, i = _parse_fields(text, i + 1)
+            _add_field(selection, name, sub)
+            name = ''
+            continue
+        if c in '),':
+            _add_field(selection, name, None)
+            name = ''
+            if c == ')':
+                return selection, i + 1
+        else:
+            name += c
+        i += 1
+    _add_field(selection, name, None)
+    return selection, i
+
+
+def _add_field(selection, name, sub):
+    if not name:
+        return
+    # a/b selects b inside a.
+    *path, last = name.split('/')
+    for part in path:
+        if selection.get(part) is None:
+            selection[part] = {}
+        selection = selection[part]
+    selection[last] = sub
+
+
+def select_fields(value, selection):
+    """:return: The parts of value in selection, a copy"""
+    if isinstance(value, list):
+        return [select_fields(item, selection) for item in value]
+    if not isinstance(value, dict):
+        return value
+    if selection is None or '*' in selection:
+        return json.loads(json.dumps(value))
+    return {key: select_fields(value[key], sub) for key, sub in selection.items() if key in value}
+
+
+class FakeDrive:
+    """
+    In-memory Drive. Every API call (batch sub-requests included) is counted in `calls`
+    by method, requests received over HTTP as `http` and injected errors as error:403 / error:429 / error:500.
+    """
+
+    def __init__(self, latency=0.0, rate_limit_ratio=0.0, error_ratio=0.0, page_size=100, seed=0, quota=0):
+        self.latency = latency
+        self.rate_limit_ratio = rate_limit_ratio
+        self.error_ratio = error_ratio
+        # API calls accepted per second, the rest get 429 rateLimitExceeded. 0 means no limit.
+        self.quota = quota
+        self.__window = (0, 0)
+        self.page_size = page_size
+        self.files = {}
+        self.children = {}
+        self.changes = []
+        self.calls = Counter()
+        self.__random = random.Random(seed)
+        self.__ids = itertools.count()
+        self.__lock = threading.Lock()
+
+    def new_id(self):
+        return 'fake%015d' % next(self.__ids)
+
+    def add(self, name, parent=None, folder=False, size=0, file_id=None, **extra):
+        with self.__lock:
+            return self.__add(name, parent, folder, size, file_id, **extra)
+
+    def __add(self, name, parent, folder, size, file_id=None, **extra):
+        file_id = file_id or self.new_id()
+        meta = {'id': file_id, 'name': name, 'mimeType': FOLDER_MIME_TYPE if folder else 'application/octet-stream',
+                'parents': [parent] if parent else [], 'trashed': False,
+                'modifiedTime': extra.pop('modifiedTime', '2020-01-01T00:00:00.000Z')}
+        if not folder:
+            meta['size'] = str(size)
+            meta['md5Checksum'] = extra.pop('md5Checksum', hashlib.md5(f'{name}{size}'.encode()).hexdigest())
+        meta.update(extra)
+        self.files[file_id] = meta
+        self.children.setdefault(file_id, [])
+        if parent:
+            self.children.setdefault(parent, []).append(file_id)
+        self.changes.append(file_id)
+        return file_id
+
+    def count_request(self):
+        with self.__lock:
+            self.calls['http'] += 1
+
+    def count(self, parent):
+        """:return: (files, folders, bytes) below parent"""
+        files = folders = size = 0
+        stack = [parent]
+        while stack:
+            for child in self.children.get(stack.pop(), []):
+                meta = self.files[child]
+                if meta['trashed']:
+                    continue
+                if meta['mimeType'] == FOLDER_MIME_TYPE:
+                    folders += 1
+                    stack.append(child)
+                else:
+                    files += 1
+                    size += int(meta.get('size', 0))
+        return files, folders, size
+
+    def fault(self, method, delay=True):
+        """:return: (status, body) of an injected error, or None"""
+        if delay and self.latency:
+            time.sleep(self.latency)
+        if self.quota:
+            with self.__lock:
+                second, used = self.__window
+                now = int(time.monotonic())
+                used = used + 1 if now == second else 1
+                self.__window = (now, used)
+            if used > self.quota:
+                self.calls['error:429'] += 1
+                return 429, error_body(429, 'rateLimitExceeded', 'Rate Limit Exceeded')
+        roll = self.__random.random()
+        if roll < self.rate_limit_ratio:
+            self.calls['error:403'] += 1
+            return 403, error_body(403, 'userRateLimitExceeded', 'User rate limit exceeded.')
+        if roll < self.rate_limit_ratio + self.error_ratio:
+            self.calls['error:500'] += 1
+            return 500, error_body(500, 'backendError', 'Backend Error')
+        return None
+
+    def handle(self, method, path, query, body, delay=True):
+        parts = [p for p in path.split('/') if p]
+        if parts[:2] == ['drive', 'v3']:
+            parts = parts[2:]
+        name = self.route(method, parts)
+        self.calls[name] += 1
+        fault = self.fault(name, delay) if name not in ('token', 'unknown') else None
+        if fault:
+            return fault
+        with self.__lock:
+            status, payload = getattr(self, 'do_' + name.replace('.', '_'))(parts, query, body)
+            fields = query.get('fields', [None])[0] or DEFAULT_FIELDS.get(name)
+            if status < 300 and isinstance(payload, dict) and fields:
+                payload = select_fields(payload, parse_fields(fields))
+            return status, payload
+
+    @staticmethod
+    def route(method, parts):
+        if parts == ['token']:
+            return 'token'
+        if parts[:1] == ['files']:
+            if len(parts) == 1:
+                return 'files.list' if method == 'GET' else 'files.create'
+            if parts[1] == 'generateIds':
+                return 'files.generateIds'
+            if len(parts) == 3 and parts[2] == 'copy':
+                return 'files.copy'
+            if len(parts) == 3 and parts[2] == 'permissions':
+                return 'permissions.create'
+            return {'GET': 'files.get', 'PATCH': 'files.update', 'DELETE': 'files.delete'}.get(method, 'unknown')
+        if parts == ['changes', 'startPageToken']:
+            return 'changes.getStartPageToken'
+        if parts == ['changes']:
+            return 'changes.list'
+        return 'unknown'
+
+    def do_token(self, parts, query, body):
+        return 200, {'access_token': 'fake-token', 'expires_in': 3600, 'token_type': 'Bearer'}
+
+    def do_unknown(self, parts, query, body):
+        return 404, error_body(404, 'notFound', 'Unknown endpoint')
+
+    def __get(self, file_id):
+        meta = self.files.get(file_id)
+        if meta is None:
+            return None, (404, error_body(404, 'notFound', f'File not found: {file_id}.'))
+        return meta, None
+
+    def do_files_get(self, parts, query, body):
+        meta, err = self.__get(parts[1])
+        return err or (200, meta)
+
+    def do_files_list(self, parts, query, body):
+        q = query.get('q', [''])[0]
+        parent = re.search(r"'([^']+)' in parents", q)
+        if parent is None:
+            return 400, error_body(400, 'invalid', 'Only parent queries are supported')
+        name = re.search(r"name = '((?:[^'\\]|\\.)*)'", q)
+        mime = re.search(r"mimeType (=|!=) '([^']+)'", q)
+        result = []
+        for child in self.children.get(parent.group(1), []):
+            meta = self.files[child]
+            if 'trashed = false' in q and meta['trashed']:
+                continue
+            if name and meta['name'] != name.group(1).replace("\\'", "'"):
+                continue
+            if mime and (meta['mimeType'] == mime.group(2)) != (mime.group(1) == '='):
+                continue
+            result.append(meta)
+        page_size = min(int(query.get('pageSize', ['100'])[0]), 1000, self.page_size)
+        start = int(query.get('pageToken', ['0'])[0] or 0)
+        response = {'files': result[start:start + page_size]}
+        if start + page_size < len(result):
+            response['nextPageToken'] = str(start + page_size)
+        return 200, response
+
+    def do_files_copy(self, parts, query, body):
+        meta, err = self.__get(parts[1])
+        if err:
+            return err
+        body = json.loads(body or '{}')
+        parent = (body.get('parents') or meta['parents'])[0]
+        if parent not in self.files:
+            return 404, error_body(404, 'notFound', f'File not found: {parent}.')
+        extra = {k: v for k, v in meta.items() if k in ('md5Checksum', 'modifiedTime')}
+        extra.update({k: v for k, v in body.items() if k == 'modifiedTime'})
+        new_id = self.__add(body.get('name', meta['name']), parent, False, int(meta.get('size', 0)), **extra)
+        return 200, self.files[new_id]
+
+    def do_files_create(self, parts, query, body):
+        body = json.loads(body or '{}')
+        parent = (body.get('parents') or [None])[0]
+        if parent and parent not in self.files:
+            return 404, error_body(404, 'notFound', f'File not found: {parent}.')
+        if body.get('id') in self.files:
+            return 409, error_body(409, 'duplicate', 'A file already exists with the provided ID.')
+        new_id = self.__add(body.get('name', 'Untitled'), parent, body.get('mimeType') == FOLDER_MIME_TYPE,
+                            0, body.get('id'))
+        return 200, self.files[new_id]
+
+    def do_files_update(self, parts, query, body):
+        meta, err = self.__get(parts[1])
+        if err:
+            return err
+        meta.update({k: v for k, v in json.loads(body or '{}').items() if k in ('name', 'trashed', 'modifiedTime')})
+        for parent in filter(None, query.get('removeParents', [''])[0].split(',')):
+            if parent in meta['parents']:
+                meta['parents'].remove(parent)
+                self.children[parent].remove(meta['id'])
+        for parent in filter(None, query.get('addParents', [''])[0].split(',')):
+            # Drive ignores parents the file already has.
+            if parent in meta['parents']:
+                continue
+            meta['parents'].append(parent)
+            self.children.setdefault(parent, []).append(meta['id'])
+        self.changes.append(meta['id'])
+        return 200, meta
+
+    def do_files_delete(self, parts, query, body):
+        meta, err = self.__get(parts[1])
+        if err:
+            return err
+        meta['trashed'] = True
+        self.changes.append(meta['id'])
+        return 204, None
+
+    def do_files_generateIds(self, parts, query, body):
+        count = int(query.get('count', ['10'])[0])
+        return 200, {'ids': [self.new_id() for _ in range(count)], 'space': 'drive', 'kind': 'drive#generatedIds'}
+
+    def do_permissions_create(self, parts, query, body):
+        meta, err = self.__get(parts[1])
+        return err or (200, {'id': 'anyoneWithLink', 'type': 'anyone', 'role': 'reader'})
+
+    def do_changes_getStartPageToken(self, parts, query, body):
+        return 200, {'startPageToken': str(len(self.changes))}
+
+    def do_changes_list(self, parts, query, body):
+        start = int(query.get('pageToken', ['0'])[0])
+        page_size = min(int(query.get('pageSize', ['100'])[0]), self.page_size)
+        ids = self.changes[start:start + page_size]
+        response = {'changes': [{'fileId': i, 'removed': False, 'file': self.files[i]} for i in ids]}
+        if start + page_size < len(self.changes):
+            response['nextPageToken'] = str(start + page_size)
+        else:
+            response['newStartPageToken'] = str(len(self.changes))
+        return 200, response
+
+    def handle_batch(self, content_type, body):
+        self.calls['batch'] += 1
+        # Drive works on the parts of a batch concurrently, the latency is paid once.
+        if self.latency:
+            time.sleep(self.latency)
+        message = BytesParser().parsebytes(b'Content-Type: ' + content_type.encode() + b'\r\n\r\n' + body)
+        boundary = 'fake_batch_boundary'
+        out = []
+        for part in message.get_payload():
+            content_id = part['Content-ID'] or ''
+            raw = part.get_payload(decode=True) if part.get('Content-Transfer-Encoding') != 'binary' \
+                else part.get_payload().encode('utf-8')
+            head, _, sub_body = raw.partition(b'\r\n\r\n') if b'\r\n\r\n' in raw else raw.partition(b'\n\n')
+            request_line = head.split(b'\n')[0].decode().strip()
+            method, url, _ = request_line.split(' ', 2)
+            parsed = urlparse(url)
+            status, payload = self.handle(method, unquote(parsed.path), parse_qs(parsed.query),
+                                          sub_body.decode('utf-8'), delay=False)
+            text = json.dumps(payload) if payload is not None else ''
+            out.append(f'--{boundary}\r\nContent-Type: application/http\r\n'
+                       f'Content-ID: <response-{content_id.strip("<>")}>\r\n\r\n'
+                       f'HTTP/1.1 {status} {"OK" if status < 300 else "Error"}\r\n'
+                       f'Content-Type: application/json; charset=UTF-8\r\n\r\n{text}\r\n')
+        out.append(f'--{boundary}--\r\n')
+        return ''.join(out).encode('utf-8'), f'multipart/mixed; boundary={boundary}'
+
+
+def error_body(code, reason, message):
+    return {'error': {'errors': [{'domain': 'usageLimits', 'reason': reason, 'message': message}],
+                      'code': code, 'message': message}}
+
+
+def make_handler(drive):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def __respond(self, status, body, content_type='application/json; charset=UTF-8'):
+            if body is None:
+                data = b''
+            elif isinstance(body, bytes):
+                data = body
+            else:
+                data = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def __handle(self):
+            drive.count_request()
+            length = int(self.headers.get('Content-Length') or 0)
+            body = self.rfile.read(length) if length else b''
+            parsed = urlparse(self.path)
+            if parsed.path.startswith('/batch/'):
+                data, content_type = drive.handle_batch(self.headers.get('Content-Type'), body)
+                return self.__respond(200, data, content_type)
+            if parsed.path == '/token':
+                body = body.decode()
+            else:
+                body = body.decode('utf-8')
+            status, payload = drive.handle(self.command, unquote(parsed.path), parse_qs(parsed.query), body)
+            self.__respond(status, payload)
+
+        do_GET = do_POST = do_PATCH = do_DELETE = do_PUT = __handle
+
+    return Handler
+
+
+class FakeDriveServer:
+    """Runs a FakeDrive on a localhost port in a background thread."""
+
+    def __init__(self, drive, host='127.0.0.1', port=0):
+        self.drive = drive
+        self.__server = ThreadingHTTPServer((host, port), make_handler(drive))
+        self.__server.daemon_threads = True
+        self.url = f'http://{host}:{self.__server.server_port}/'
+        self.__thread = threading.Thread(target=self.__server.serve_forever, daemon=True)
+
+    def start(self):
+        self.__thread.start()
+        return self
+
+    def stop(self):
+        self.__server.shutdown()
+        self.__server.server_close()
+
+    def write_discovery(self, path, source=DISCOVERY_DOCUMENT):
+        """Writes a copy of the Drive discovery document pointing at this server."""
+        with open(source) as f:
+            document = json.load(f)
+        document['rootUrl'] = self.url
+        document['baseUrl'] = self.url + 'drive/v3/'
+        document['mtlsRootUrl'] = self.url
+        with open(path, 'w') as f:
+            json.dump(document, f)
+        return path
+
+    def write_service_accounts(self, path, count, private_key):
+        """Writes service account files whose tokens are issued by this server."""
+        os.makedirs(path, exist_ok=True)
+        for index in range(count):
+            with open(os.path.join(path, f'{index}.json'), 'w') as f:
+                json.dump({'type': 'service_account', 'project_id': 'fake', 'private_key_id': str(index),
+                           'private_key': private_key, 'client_email': f'sa{index}@fake.iam.gserviceaccount.com',
+                           'client_id': str(index), 'token_uri': self.url + 'token'}, f)
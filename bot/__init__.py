@@ -1,10 +1,12 @@
 import logging
+import multiprocessing
 import time
 import os
 import telegram.ext as tg
-from bot.config import BOT_TOKEN
+from bot.config import BOT_TOKEN, BOT_MODE
 
-if os.path.exists('log.txt'):
+# Clone shard worker processes log to the same file.
+if os.path.exists('log.txt') and multiprocessing.parent_process() is None:
     with open('log.txt', 'r+') as f:
         f.truncate(0)
 
@@ -13,6 +15,10 @@ logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s
                     level=logging.INFO)
 
 LOGGER = logging.getLogger(__name__)
-updater = tg.Updater(token=BOT_TOKEN, use_context=True, workers=16)
-bot = updater.bot
-dispatcher = updater.dispatcher
\ No newline at end of file
+if BOT_MODE == 'worker':
+    # Workers never talk to Telegram, they do not need a token.
+    updater = bot = dispatcher = None
+else:
+    updater = tg.Updater(token=BOT_TOKEN, use_context=True, workers=16)
+    bot = updater.bot
+    dispatcher = updater.dispatcher
\ No newline at end of file
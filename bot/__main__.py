@@ -2,12 +2,22 @@ from telegram.ext import CommandHandler, run_async
 from bot.gDrive import GoogleDriveHelper
 from bot.fs_utils import get_readable_file_size
 from bot import LOGGER, dispatcher, updater, bot
-from bot.config import BOT_TOKEN, OWNER_ID, GDRIVE_FOLDER_ID
+from bot.config import BOT_TOKEN, OWNER_ID, GDRIVE_FOLDER_ID, USE_SERVICE_ACCOUNTS
 from bot.decorators import is_authorised, is_owner
 from telegram.error import TimedOut, BadRequest
-from bot.clone_status import CloneStatus
 from bot.msg_utils import deleteMessage, sendMessage
-import time
+from bot.sa_pool import get_pool
+from bot.job_scheduler import CloneJob, CloneScheduler, RemoteScheduler, QueueLimitReached, QUEUED, CANCELLED
+from bot.config import MAX_CONCURRENT_CLONES, MAX_JOBS_PER_USER
+from bot.status_ticker import StatusTicker
+from bot.drive_metrics import metrics, start_metrics_server
+from bot.config import METRICS_PORT, CLONE_PROCESSES
+from bot.clone_shards import get_shard_workers
+from bot.rate_limiter import controller
+from bot.listing_cache import listing_cache
+from bot.config import BOT_MODE
+from bot.job_queue import open_job_queue
+from bot.queue_worker import QueueWorker
 
 REPO_LINK = "https://Telegram.me/DKzippO"
 # Soon to be used for direct updates from within the bot.
@@ -25,18 +35,56 @@ def helper(update, context):
     sendMessage("Aquí están los comandos disponibles del bot\n\n" \
         "*Usa:* `/clone <link> [DESTINATION_ID]`\n*Ejemplo:* \n1. `/clone https://drive.google.com/drive/u/1/folders/0AO-ISIXXXXXXXXXXXX`\n2. `/clone 0AO-ISIXXXXXXXXXXXX`" \
             "\n*El ID de destino* es opcional. Puede ser un enlace o un ID al lugar donde desea almacenar un clon en particular." \
+            " Separa varios destinos con comas (`/clone <link> ID1,ID2`) para copiar a todos leyendo el origen una sola vez." \
             "\n\nTambién puede *ignorar carpetas* del proceso de clonación haciendo lo siguiente:\n" \
                 "`/clone <FOLDER_ID> [DESTINATION] [id1,id2,id3]`\n En este ejemplo: id1, id2 and id3 sería ignorado por la clonación\nNo utilice <> o [] en el mensaje actual." \
                     "*Asegúrate de no poner ningún espacio entre comas. (,)*\n" \
+                    "\nSi una clonación se interrumpe, envía el mismo `/clone` otra vez para continuar donde se quedó.\n" \
+                    "\n*Sincronizar:* `/clone --sync <link> [DESTINATION_ID]` copia solo los archivos nuevos o modificados " \
+                    "(compara checksum, tamaño y fecha). Añade `--delete` para mover a la papelera lo que ya no está en el origen.\n" \
+                    "`/sync <link> [DESTINATION_ID]` mantiene una copia al día: la primera vez sincroniza la carpeta entera, " \
+                    "después solo aplica los cambios del origen desde la última sincronización.\n" \
+                    "\nPara clonar *varios enlaces* a la vez, pon uno por línea debajo del comando " \
+                    "o responde con `/clone [DESTINATION_ID]` a un archivo de texto con un enlace por línea.\n" \
+                    "\n`/count <link>` cuenta los archivos, carpetas y el tamaño total de un enlace sin copiar nada.\n" \
+                    "\n`/queue` muestra las clonaciones en curso y en cola.\n`/cancel <ID>` cancela una clonación por su ID de trabajo.\n" \
                         f"*Creador del bot:* [Skueletor]({REPO_LINK})", context.bot, update, 'Markdown')
 
-# TODO Cancel Clones with /cancel command.
+def readLinks(text):
+    """:return: The links of a text, one per line, skipping empty lines and # comments"""
+    links = []
+    for line in text.splitlines():
+        line = line.strip()
+        if line and not line.startswith('#'):
+            links.append(line.split()[0])
+    return links
+
+
 @run_async
 @is_authorised
 def cloneNode(update, context):
-    args = update.message.text.split(" ")
-    if len(args) > 1:
-        link = args[1]
+    # Extra lines of the message, or a text file the command replies to, hold more links.
+    lines = update.message.text.split('\n')
+    args = lines[0].split(" ")
+    flags = {arg for arg in args[1:] if arg.startswith('--')}
+    args = [arg for arg in args if arg not in flags]
+    links = readLinks('\n'.join(lines[1:]))
+    reply = update.message.reply_to_message
+    if reply is not None and reply.document is not None:
+        try:
+            data = context.bot.get_file(reply.document.file_id).download_as_bytearray()
+            links = readLinks(data.decode('utf-8', errors='ignore')) + links
+        except Exception as e:
+            LOGGER.error(f"Could not read the link file: {e}")
+            sendMessage("No se pudo leer el archivo de enlaces.", context.bot, update)
+            return
+        # The file takes the place of the link: /clone [DESTINATION_ID] [id1,id2,id3]
+        args.insert(1, links.pop(0) if links else '')
+    elif (len(args) < 2 or not args[1]) and links:
+        # Only links on the lines below the command.
+        args[1:2] = [links.pop(0)]
+    if len(args) > 1 and args[1]:
+        links.insert(0, args[1])
         try:
             ignoreList = args[-1].split(',')
         except IndexError:
@@ -48,43 +96,203 @@ def cloneNode(update, context):
             print(DESTINATION_ID)
         except IndexError:
             pass
-            # Usage: /clone <FolderToClone> <Destination> <IDtoIgnoreFromClone>,<IDtoIgnoreFromClone>
-
-        msg = sendMessage(f"<b>Clonando:</b> <code>{link}</code>", context.bot, update)
-        status_class = CloneStatus()
-        gd = GoogleDriveHelper(GFolder_ID=DESTINATION_ID)
-        sendCloneStatus(update, context, status_class, msg, link)
-        result = gd.clone(link, status_class, ignoreList=ignoreList)
-        deleteMessage(context.bot, msg)
-        status_class.set_status(True)
-        sendMessage(result, context.bot, update)
+            # Usage: /clone <FolderToClone> <Destination>[,<Destination>] <IDtoIgnoreFromClone>,<IDtoIgnoreFromClone>
+        destinations = [dest for dest in DESTINATION_ID.split(',') if dest]
+        changes = update.message.text.startswith('/sync')
+        if changes and (len(destinations) > 1 or len(links) > 1):
+            sendMessage("<code>/sync</code> solo admite un enlace y un destino.", context.bot, update)
+            return
+
+        user_id = update.effective_message.from_user.id
+        is_owner_user = user_id == OWNER_ID
+        job = CloneJob(user_id, update.message.chat_id, update, links, destinations, ignoreList,
+                       priority=0 if is_owner_user else 1, sync='--sync' in flags, delete='--delete' in flags,
+                       changes=changes)
+        try:
+            position = scheduler.submit(job, limited=not is_owner_user)
+        except QueueLimitReached as e:
+            sendMessage(str(e), context.bot, update)
+            return
+        if position:
+            sendMessage(f"<b>En cola:</b> <code>{job.link}</code>\n<b>Posición:</b> {position}\n"
+                        f"<b>ID de trabajo:</b> <code>{job.id}</code> (usa /cancel {job.id} para cancelar)",
+                        context.bot, update)
     else:
         sendMessage("Proporcione un enlace compartido de Google Drive para clonar.", bot, update)
 
 
+def runJob(job):
+    """Runs a clone or count job, on this bot or on a queue worker. :return: The result message"""
+    if job.status is None:
+        job.status = job.new_status()
+    job.helper = GoogleDriveHelper() if job.count else GoogleDriveHelper(GFolder_ID=job.destinations[0])
+    if job.state == CANCELLED:
+        # /cancel arrived while the helper was being set up.
+        job.helper.cancel()
+    try:
+        if job.count:
+            return job.helper.count(job.link, job.status)
+        elif job.changes:
+            return job.helper.syncChanges(job.link, job.status)
+        elif len(job.links) > 1:
+            return job.helper.cloneLinks(job.links, job.destinations, job.status, ignoreList=job.ignoreList,
+                                         sync=job.sync, delete=job.delete)
+        elif len(job.destinations) > 1:
+            return job.helper.cloneMany(job.link, job.destinations, job.status, ignoreList=job.ignoreList,
+                                        sync=job.sync, delete=job.delete)
+        else:
+            return job.helper.clone(job.link, job.status, ignoreList=job.ignoreList, sync=job.sync, delete=job.delete)
+    finally:
+        job.helper.releaseAccounts()
+        job.status.set_status(True)
+
+
+def replyToJob(job, text):
+    # Jobs queued before a frontend restarted have no update, only the ids of the chat and the /clone message.
+    return bot.send_message(job.chat_id, reply_to_message_id=job.message_id, text=text, parse_mode='HTMl')
+
+
+def jobStarted(job):
+    action = "Contando" if job.count else "Clonando"
+    job.message = replyToJob(job, f"<b>{action}:</b> <code>{job.link}</code>\n<b>ID de trabajo:</b> <code>{job.id}</code>")
+    ticker.add(job.message, job.status, countStatusText if job.count else cloneStatusText)
+
+
+def jobFinished(job, result):
+    if job.message is not None:
+        ticker.remove(job.message)
+        deleteMessage(bot, job.message)
+    if result:
+        replyToJob(job, result)
+    elif job.state == CANCELLED:
+        replyToJob(job, f"Trabajo <code>{job.id}</code> cancelado.")
+
+
+def runCloneJob(job):
+    job.status = job.new_status()
+    jobStarted(job)
+    result = None
+    try:
+        result = runJob(job)
+    except Exception as e:
+        LOGGER.exception(f"Clone job {job.id} failed: {e}")
+        result = str(e).replace('>', '').replace('<', '')
+    finally:
+        jobFinished(job, result)
+
+
+ticker = StatusTicker()
+if BOT_MODE == 'frontend':
+    scheduler = RemoteScheduler(open_job_queue(), jobStarted, jobFinished, per_user=MAX_JOBS_PER_USER)
+elif BOT_MODE == 'worker':
+    scheduler = None
+else:
+    scheduler = CloneScheduler(runCloneJob, workers=MAX_CONCURRENT_CLONES, per_user=MAX_JOBS_PER_USER)
+
+
 @run_async
-def sendCloneStatus(update, context, status, msg, link):
-    old_text = ''
-    while not status.done():
-        sleeper(3)
-        try:
-            text=f'🔗 *Clonando:* [{status.MainFolderName}]({status.MainFolderLink})\n━━━━━━━━━━━━━━\n🗃️ *Archivo actual:* `{status.get_name()}`\n⬆️ *Transferido*: `{status.get_size()}`\n📁 *Destino:* [{status.DestinationFolderName}]({status.DestinationFolderLink})'
-            if status.checkFileStatus():
-                text += f"\n🕒 *Comprobación de archivos existentes:* `{str(status.checkFileStatus())}`"
-            if not text == old_text:
-                msg.edit_text(text=text, parse_mode="Markdown", timeout=200)
-                old_text = text
-        except Exception as e:
-            LOGGER.error(e)
-            if str(e) == "Mensaje para editar no encontrado":
-                break
-            sleeper(2)
-            continue
-    return
+@is_authorised
+def showQueue(update, context):
+    jobs = scheduler.jobs()
+    if not jobs:
+        sendMessage("No hay clonaciones en curso ni en cola.", context.bot, update)
+        return
+    lines = []
+    for job in jobs:
+        line = f"<b>{job.id}</b> · {'Recuento · ' if job.count else ''}{job.state} · <code>{job.link}</code>"
+        if job.state == QUEUED:
+            line += f" · posición {scheduler.position(job)}"
+        elif job.status is not None:
+            line += f" · {job.status.get_size()}"
+        lines.append(line)
+    sendMessage("\n".join(lines), context.bot, update)
+
+
+@run_async
+@is_authorised
+def cancelJob(update, context):
+    args = update.message.text.split(" ")
+    try:
+        job_id = int(args[1])
+    except (IndexError, ValueError):
+        sendMessage("<b>Usa:</b> <code>/cancel &lt;ID de trabajo&gt;</code> (consulta /queue)", context.bot, update)
+        return
+    user_id = update.effective_message.from_user.id
+    job = scheduler.cancel(job_id, user_id=None if user_id == OWNER_ID else user_id)
+    if job is None:
+        sendMessage(f"No se encontró el trabajo <code>{job_id}</code>.", context.bot, update)
+    else:
+        sendMessage(f"Trabajo <code>{job_id}</code> cancelado.", context.bot, update)
 
-def sleeper(value, enabled=True):
-    time.sleep(int(value))
-    return
+
+@run_async
+@is_authorised
+def countNode(update, context):
+    args = update.message.text.split(" ")
+    if len(args) < 2:
+        sendMessage("<b>Usa:</b> <code>/count &lt;link&gt;</code>", context.bot, update)
+        return
+    # Runs on the clone workers like any other job, so /queue, /cancel and the per-user limit apply.
+    user_id = update.effective_message.from_user.id
+    is_owner_user = user_id == OWNER_ID
+    job = CloneJob(user_id, update.message.chat_id, update, [args[1]], [], [],
+                   priority=0 if is_owner_user else 1, count=True)
+    try:
+        position = scheduler.submit(job, limited=not is_owner_user)
+    except QueueLimitReached as e:
+        sendMessage(str(e), context.bot, update)
+        return
+    if position:
+        sendMessage(f"<b>En cola:</b> <code>{job.link}</code>\n<b>Posición:</b> {position}\n"
+                    f"<b>ID de trabajo:</b> <code>{job.id}</code> (usa /cancel {job.id} para cancelar)",
+                    context.bot, update)
+
+
+def countStatusText(status):
+    return f'🔢 *Contando:* [{status.name}]({status.link})\n━━━━━━━━━━━━━━\n📄 *Archivos:* `{status.files}`' \
+           f'\n🗂️ *Carpetas:* `{status.folders}`\n💾 *Tamaño:* `{status.get_size()}`'
+
+
+def cloneStatusText(status):
+    if status.links:
+        current = status.links[-1]
+        text = f'🔗 *Clonando:* `{len(status.links)}/{status.total_links}` enlaces\n━━━━━━━━━━━━━━' \
+               f'\n🗃️ *Actual:* [{current.MainFolderName}]({current.MainFolderLink})' \
+               f'\n⬆️ *Transferido*: `{status.get_size()}`'
+        if current.targets:
+            for target in current.targets:
+                text += f'\n📁 [{target.DestinationFolderName}]({target.DestinationFolderLink}): `{target.get_size()}`'
+        else:
+            text += f'\n📁 *Destino:* [{current.DestinationFolderName}]({current.DestinationFolderLink})'
+        return text
+    if status.targets:
+        main = status.targets[0]
+        text = f'🔗 *Clonando:* [{main.MainFolderName}]({main.MainFolderLink})\n━━━━━━━━━━━━━━'
+        for target in status.targets:
+            text += f'\n📁 [{target.DestinationFolderName}]({target.DestinationFolderLink}): `{target.get_size()}`'
+        return text
+    text=f'🔗 *Clonando:* [{status.MainFolderName}]({status.MainFolderLink})\n━━━━━━━━━━━━━━\n🗃️ *Archivo actual:* `{status.get_name()}`\n⬆️ *Transferido*: `{status.get_size()}`\n📁 *Destino:* [{status.DestinationFolderName}]({status.DestinationFolderLink})'
+    if status.checkFileStatus():
+        text += f"\n🕒 *Comprobación de archivos existentes:* `{str(status.checkFileStatus())}`"
+    return text
+
+@run_async
+@is_owner
+def sendStats(update, context):
+    text = metrics.summary()
+    if USE_SERVICE_ACCOUNTS:
+        available, total, used = get_pool().stats()
+        text += f"\n\n<b>Cuentas de servicio disponibles:</b> {available}/{total} · hoy {get_readable_file_size(used)}"
+    if listing_cache.enabled:
+        folders, items, hits, misses = listing_cache.stats()
+        text += f"\n\n<b>Caché de listados:</b> {folders} carpetas ({items} elementos) · {hits} aciertos · {misses} fallos"
+    limits = controller.stats()
+    if limits:
+        # Most throttled accounts first.
+        text += "\n\n<b>Ritmo de peticiones</b>"
+        for account, (rate, limit, in_flight, throttled) in sorted(limits.items(), key=lambda item: -item[1][3])[:10]:
+            text += f"\n<code>{account}</code>: {rate:.0f}/s · {in_flight}/{limit} en curso · {throttled} limitadas"
+    sendMessage(text, context.bot, update)
 
 @run_async
 @is_owner
@@ -96,14 +304,33 @@ def sendLogs(update, context):
 
 def main():
     LOGGER.info("Bot iniciado!")
+    if USE_SERVICE_ACCOUNTS:
+        get_pool()
+        if CLONE_PROCESSES:
+            get_shard_workers()
+    if METRICS_PORT:
+        start_metrics_server(METRICS_PORT)
+    if BOT_MODE == 'worker':
+        QueueWorker(open_job_queue(), runJob).run()
+        return
     clone_handler = CommandHandler('clone', cloneNode)
     start_handler = CommandHandler('start', start)
     help_handler = CommandHandler('help', helper)
     log_handler = CommandHandler('logs', sendLogs)
+    queue_handler = CommandHandler('queue', showQueue)
+    cancel_handler = CommandHandler('cancel', cancelJob)
+    sync_handler = CommandHandler('sync', cloneNode)
+    stats_handler = CommandHandler('stats', sendStats)
+    count_handler = CommandHandler('count', countNode)
     dispatcher.add_handler(log_handler)
     dispatcher.add_handler(start_handler)
     dispatcher.add_handler(clone_handler)
     dispatcher.add_handler(help_handler)
+    dispatcher.add_handler(queue_handler)
+    dispatcher.add_handler(cancel_handler)
+    dispatcher.add_handler(sync_handler)
+    dispatcher.add_handler(stats_handler)
+    dispatcher.add_handler(count_handler)
     updater.start_polling()
 
 main()
@@ -0,0 +1,234 @@
+import asyncio
+import threading
+
+from bot import LOGGER
+from bot.config import IS_TEAM_DRIVE, USE_SERVICE_ACCOUNTS, LIST_WORKERS, ASYNC_COPY_CONCURRENCY
+from bot.async_drive import AsyncDriveClient, AsyncDriveError, ACCOUNT_LIMIT_REASONS, FOLDER_MIME_TYPE, new_session
+from bot.listing_cache import listing_cache
+from bot.sa_pool import get_pool
+
+LIST_FIELDS = 'id, name, mimeType, size'
+
+
+class _Lane:
+    """One account the clone copies with, switched when Drive limits it."""
+
+    def __init__(self, client, account=None):
+        self.client = client
+        self.account = account
+        self.lock = asyncio.Lock()
+
+
+class AsyncClone:
+    """
+    Copies a folder tree on one event loop with up to `in_flight` copies at once.
+
+    Folders are listed (through the source listing cache) and created as the walk
+    reaches them, every file becomes a copy task as soon as a slot is free. Copies are
+    spread over as many service account lanes as a threaded clone has workers, a lane
+    that gets userRateLimitExceeded or dailyLimitExceeded moves to another account.
+    Files and folders that already exist in the destination are skipped by name.
+    """
+
+    def __init__(self, credentials_factory, status, ignoreList=(), in_flight=ASYNC_COPY_CONCURRENCY, lanes=8):
+        # credentials_factory() returns the user's credentials when service accounts are off.
+        self.__credentials_factory = credentials_factory
+        self.__status = status
+        self.__ignore = set(ignoreList or ())
+        self.__in_flight = max(1, in_flight)
+        self.__lane_count = max(1, lanes)
+        self.__lanes = []
+        self.__next_lane = 0
+        self.__accounts = []
+        self.__session = None
+        self.__slots = None
+        self.__listing = None
+        self.__tasks = set()
+        self.__error = None
+        self.__loop = None
+        self.__main = None
+        self.__cancelled = threading.Event()
+        self.copied_files = 0
+        self.transferred_size = 0
+
+    @property
+    def is_cancelled(self):
+        return self.__cancelled.is_set()
+
+    def cancel(self):
+        """Stops the clone from any thread, copies in flight are abandoned."""
+        self.__cancelled.set()
+        loop, main = self.__loop, self.__main
+        if loop is not None and main is not None:
+            loop.call_soon_threadsafe(main.cancel)
+
+    def run(self, source, dest_parent):
+        """
+        Clones the folder `source` (its metadata) into dest_parent, blocking until it is done.
+        :return: Id of the destination copy of the folder, None if cancelled before it existed
+        """
+        return asyncio.run(self.__run(source, dest_parent))
+
+    async def __run(self, source, dest_parent):
+        self.__loop = asyncio.get_running_loop()
+        self.__main = asyncio.current_task()
+        self.__slots = asyncio.Semaphore(self.__in_flight)
+        self.__listing = asyncio.Semaphore(max(1, LIST_WORKERS))
+        self.__session = new_session(self.__in_flight + LIST_WORKERS)
+        dir_id = None
+        try:
+            await self.__open_lanes()
+            existing = await self.__index(dest_parent)
+            folder = existing[1].get(source.get('name'))
+            dir_id = folder.get('id') if folder else await self.__create_folder(source.get('name'), dest_parent)
+            await self.__clone_folder(source.get('id'), dir_id, folder is not None)
+            while self.__tasks and self.__error is None:
+                await asyncio.wait(set(self.__tasks), return_when=asyncio.FIRST_EXCEPTION)
+            if self.__error is not None:
+                raise self.__error
+        except asyncio.CancelledError:
+            if not self.is_cancelled:
+                raise
+        finally:
+            for task in self.__tasks:
+                task.cancel()
+            await asyncio.gather(*self.__tasks, return_exceptions=True)
+            await self.__session.close()
+            self.__release_accounts()
+            self.__main = None
+        return dir_id
+
+    async def __open_lanes(self):
+        if not USE_SERVICE_ACCOUNTS:
+            credentials = await asyncio.get_running_loop().run_in_executor(None, self.__credentials_factory)
+            self.__lanes = [_Lane(AsyncDriveClient(self.__session, credentials))]
+            return
+        for _ in range(max(1, min(self.__lane_count, len(get_pool())))):
+            account = await self.__lease()
+            self.__lanes.append(_Lane(AsyncDriveClient(self.__session, account.credentials), account))
+
+    async def __lease(self, exclude=None):
+        # acquire() sleeps while every account rests, so it runs off the event loop.
+        account = await asyncio.get_running_loop().run_in_executor(None, get_pool().acquire, exclude)
+        self.__accounts.append(account)
+        return account
+
+    def __release_accounts(self):
+        accounts, self.__accounts = self.__accounts, []
+        for account in accounts:
+            get_pool().release(account)
+
+    def __lane(self):
+        lane = self.__lanes[self.__next_lane % len(self.__lanes)]
+        self.__next_lane += 1
+        return lane
+
+    async def __switch(self, lane, client, reason):
+        """Moves a lane off its limited account, unless another copy already did."""
+        async with lane.lock:
+            if lane.client is not client:
+                return
+            pool = get_pool()
+            if reason == 'dailyLimitExceeded':
+                pool.mark_exhausted(lane.account)
+            else:
+                pool.mark_throttled(lane.account)
+            if lane.account in self.__accounts:
+                self.__accounts.remove(lane.account)
+                pool.release(lane.account)
+            account = await self.__lease(exclude=lane.account)
+            LOGGER.info(f"Switching to {account} service account")
+            lane.account = account
+            lane.client = AsyncDriveClient(self.__session, account.credentials)
+
+    def __spawn(self, coroutine):
+        task = asyncio.ensure_future(coroutine)
+        self.__tasks.add(task)
+        task.add_done_callback(self.__task_done)
+
+    def __task_done(self, task):
+        self.__tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None and self.__error is None:
+            self.__error = task.exception()
+
+    async def __list(self, folder_id):
+        children = listing_cache.get(folder_id, LIST_FIELDS)
+        if children is not None:
+            return children
+        children = []
+        async with self.__listing:
+            async for page in self.__lane().client.iter_folder(folder_id, LIST_FIELDS):
+                if self.is_cancelled:
+                    raise asyncio.CancelledError()
+                children.extend(page)
+        listing_cache.put(folder_id, LIST_FIELDS, children)
+        return children
+
+    async def __index(self, folder_id):
+        """:return: ({name: file}, {name: folder}) already in a destination folder"""
+        files, folders = {}, {}
+        async with self.__listing:
+            async for page in self.__lane().client.iter_folder(folder_id, LIST_FIELDS):
+                for meta in page:
+                    target = folders if meta.get('mimeType') == FOLDER_MIME_TYPE else files
+                    target.setdefault(meta.get('name'), meta)
+        return files, folders
+
+    async def __create_folder(self, name, parent_id):
+        folder = await self.__lane().client.create_folder(name, parent_id)
+        if not IS_TEAM_DRIVE:
+            await self.__lane().client.create_permission(folder.get('id'))
+        LOGGER.info(f"Created folder {name} ({folder.get('id')})")
+        return folder.get('id')
+
+    async def __clone_folder(self, folder_id, dest_id, existed):
+        children = await self.__list(folder_id)
+        # Folders created by this clone are empty, only older ones need listing.
+        files, folders = await self.__index(dest_id) if existed else ({}, {})
+        for meta in children:
+            if self.is_cancelled:
+                return
+            if meta.get('mimeType') == FOLDER_MIME_TYPE:
+                if meta.get('id') in self.__ignore:
+                    LOGGER.info("Ignorando FolderID del clon: " + str(meta.get('id')))
+                    continue
+                self.__spawn(self.__clone_subfolder(meta, dest_id, folders.get(meta.get('name'))))
+            elif meta.get('name') in files:
+                self.__status.checkFileExist(True)
+            else:
+                self.__status.checkFileExist(False)
+                # Waiting for a slot keeps the walk only as far ahead as the copies.
+                await self.__slots.acquire()
+                self.__spawn(self.__copy(meta, dest_id))
+
+    async def __clone_subfolder(self, meta, dest_parent, existing):
+        if existing is not None:
+            await self.__clone_folder(meta.get('id'), existing.get('id'), True)
+        else:
+            dir_id = await self.__create_folder(meta.get('name'), dest_parent)
+            await self.__clone_folder(meta.get('id'), dir_id, False)
+
+    async def __copy(self, file, parent_id):
+        try:
+            lane = self.__lane()
+            while True:
+                client = lane.client
+                try:
+                    await client.copy(file.get('id'), parent_id)
+                    break
+                except AsyncDriveError as e:
+                    if e.reason not in ACCOUNT_LIMIT_REASONS or not USE_SERVICE_ACCOUNTS:
+                        raise
+                    LOGGER.info(f"Got: {e.reason}, Trying Again.")
+                    await self.__switch(lane, client, e.reason)
+            size = int(file.get('size', 0))
+            self.copied_files += 1
+            self.transferred_size += size
+            if lane.account is not None:
+                get_pool().record_bytes(lane.account, size)
+            self.__status.set_name(file.get('name'))
+            self.__status.add_size(size)
+        except AsyncDriveError as e:
+            LOGGER.error(f"Failed to copy {file.get('name')}: {e}")
+        finally:
+            self.__slots.release()
@@ -0,0 +1,165 @@
+import asyncio
+import json
+import time
+
+try:
+    import aiohttp
+except ImportError:
+    # Optional, only asyncio clones (ASYNC_CLONE) need it.
+    aiohttp = None
+from google.auth.transport.requests import Request
+
+from bot.config import DRIVE_CONNECT_TIMEOUT, DRIVE_READ_TIMEOUT
+from bot.drive_metrics import metrics, call_name, error_reason, account_name
+from bot.drive_service import get_discovery_document
+from bot.rate_limiter import controller, is_throttled, jittered_backoff, THROTTLE_REASONS
+
+FOLDER_MIME_TYPE = "application/vnd.google-apps.folder"
+# Retried on the same account, like drive_retry does for the threaded client.
+TRANSIENT_REASONS = ('backendError', 'internalError') + THROTTLE_REASONS
+# Copies that fail with these move to another service account instead.
+ACCOUNT_LIMIT_REASONS = ('userRateLimitExceeded', 'dailyLimitExceeded')
+ATTEMPTS = 15
+
+_base_url = None
+
+
+def available():
+    return aiohttp is not None
+
+
+def base_url():
+    """:return: The Drive v3 endpoint of the discovery document, e.g. https://www.googleapis.com/drive/v3/"""
+    global _base_url
+    if _base_url is None:
+        document = json.loads(get_discovery_document())
+        _base_url = document['rootUrl'] + document['servicePath']
+    return _base_url
+
+
+def new_session(connections):
+    """:return: An aiohttp session keeping up to `connections` requests in flight"""
+    if aiohttp is None:
+        raise RuntimeError("aiohttp is not installed, run: pip3 install aiohttp")
+    return aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=connections),
+                                 timeout=aiohttp.ClientTimeout(sock_connect=DRIVE_CONNECT_TIMEOUT,
+                                                               sock_read=DRIVE_READ_TIMEOUT))
+
+
+class AsyncDriveError(Exception):
+    def __init__(self, status, reason, message):
+        super().__init__(f"<HttpError {status}: {message}>")
+        self.status = status
+        self.reason = reason
+
+
+def is_retryable(status, reason):
+    return status == 429 or status >= 500 or reason in TRANSIENT_REASONS
+
+
+class AsyncDriveClient:
+    """
+    Drive v3 client for coroutines, covering the calls a clone needs.
+
+    It authorizes with the same google-auth credentials as the threaded client: tokens
+    are refreshed on an executor thread, so the event loop never blocks on it. Requests
+    go through the account's limiter in bot.rate_limiter and are counted in bot.drive_metrics.
+    Rate limits and server errors are retried with jittered backoff.
+    """
+
+    def __init__(self, session, credentials):
+        self.__session = session
+        self.credentials = credentials
+        self.account = account_name(credentials)
+        self.__limiter = controller.limiter(self.account)
+        self.__refreshing = None
+
+    async def __token(self):
+        if self.credentials.valid:
+            return self.credentials.token
+        if self.__refreshing is None:
+            loop = asyncio.get_running_loop()
+            self.__refreshing = loop.run_in_executor(None, self.credentials.refresh, Request())
+        try:
+            await asyncio.shield(self.__refreshing)
+        finally:
+            if self.__refreshing is not None and self.__refreshing.done():
+                self.__refreshing = None
+        return self.credentials.token
+
+    async def __send(self, method, url, params, body):
+        """:return: (status, content) of a single attempt, status 0 if Drive did not answer"""
+        call = call_name(method, url)
+        await self.__limiter.acquire_async()
+        throttled = None
+        start = time.perf_counter()
+        try:
+            headers = {'Authorization': f'Bearer {await self.__token()}'}
+            async with self.__session.request(method, url, params=params, json=body, headers=headers) as response:
+                status, content = response.status, await response.read()
+            reason = error_reason(status, content)
+            throttled = is_throttled(status, reason)
+        except asyncio.TimeoutError:
+            metrics.record(call, 0, 'timeout', self.account, time.perf_counter() - start)
+            return 0, b''
+        except aiohttp.ClientError:
+            metrics.record(call, 0, 'connectionError', self.account, time.perf_counter() - start)
+            return 0, b''
+        finally:
+            self.__limiter.release(throttled)
+        metrics.record(call, status, reason, self.account, time.perf_counter() - start)
+        return status, content
+
+    async def request(self, method, path, params=None, body=None, give_up=()):
+        """
+        :param give_up: Error reasons raised right away instead of retried
+        :return: The decoded JSON response
+        """
+        url = base_url() + path
+        params = {key: str(value).lower() if isinstance(value, bool) else value
+                  for key, value in (params or {}).items() if value is not None}
+        for attempt in range(1, ATTEMPTS + 1):
+            status, content = await self.__send(method, url, params, body)
+            if 200 <= status < 300:
+                return json.loads(content) if content else {}
+            reason = error_reason(status, content) if status else 'timeout'
+            if attempt == ATTEMPTS or reason in give_up or (status and not is_retryable(status, reason)):
+                try:
+                    message = json.loads(content)['error']['message']
+                except (ValueError, KeyError, TypeError):
+                    message = reason
+                raise AsyncDriveError(status, reason, message)
+            metrics.record_retry(call_name(method, url))
+            await asyncio.sleep(jittered_backoff(attempt, cap=60))
+
+    async def get(self, file_id, fields):
+        return await self.request('GET', f'files/{file_id}', {'supportsAllDrives': True,
+                                                              'fields': fields.replace(' ', '')})
+
+    async def list(self, query, fields, page_token=None, page_size=1000):
+        return await self.request('GET', 'files', {'supportsAllDrives': True, 'includeItemsFromAllDrives': True,
+                                                   'q': query, 'spaces': 'drive', 'pageSize': page_size,
+                                                   'fields': f'nextPageToken, files({fields})',
+                                                   'pageToken': page_token})
+
+    async def iter_folder(self, folder_id, fields):
+        """Yields the children of folder_id one page at a time."""
+        page_token = None
+        while True:
+            response = await self.list(f"'{folder_id}' in parents and trashed = false", fields, page_token)
+            yield response.get('files', [])
+            page_token = response.get('nextPageToken')
+            if page_token is None:
+                return
+
+    async def copy(self, file_id, parent_id):
+        return await self.request('POST', f'files/{file_id}/copy', {'supportsAllDrives': True},
+                                  {'parents': [parent_id]}, give_up=ACCOUNT_LIMIT_REASONS)
+
+    async def create_folder(self, name, parent_id):
+        return await self.request('POST', 'files', {'supportsAllDrives': True},
+                                  {'name': name, 'mimeType': FOLDER_MIME_TYPE, 'parents': [parent_id]})
+
+    async def create_permission(self, file_id):
+        return await self.request('POST', f'files/{file_id}/permissions', {'supportsAllDrives': True},
+                                  {'role': 'reader', 'type': 'anyone', 'withLink': True})
@@ -0,0 +1,126 @@
+import sqlite3
+import threading
+import time
+
+from bot import LOGGER
+from bot.config import CLONE_JOURNAL
+
+
+class CloneJournal:
+    """
+    Persistent record of a folder clone, keyed by (source id, destination id).
+
+    It keeps the source -> destination folder mapping, every copied file and the
+    frontier: folders whose listing or copies have not finished yet. A clone that
+    is started again with the same source and destination resumes from the frontier.
+    Writes are buffered and committed every `commit_every` changes or `commit_interval` seconds.
+    """
+
+    def __init__(self, source_id, dest_id, path=CLONE_JOURNAL, commit_every=500, commit_interval=5):
+        self.source_id = source_id
+        self.dest_id = dest_id
+        self.__commit_every = commit_every
+        self.__commit_interval = commit_interval
+        self.__dirty = 0
+        self.__last_commit = time.time()
+        self.__lock = threading.Lock()
+        self.__db = sqlite3.connect(path, check_same_thread=False)
+        self.__db.executescript("""
+            CREATE TABLE IF NOT EXISTS clones (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                source_id TEXT NOT NULL,
+                dest_id TEXT NOT NULL,
+                started REAL,
+                UNIQUE (source_id, dest_id)
+            );
+            CREATE TABLE IF NOT EXISTS folders (
+                clone_id INTEGER NOT NULL,
+                source_id TEXT NOT NULL,
+                dest_id TEXT NOT NULL,
+                path TEXT,
+                done INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (clone_id, source_id)
+            );
+            CREATE TABLE IF NOT EXISTS files (
+                clone_id INTEGER NOT NULL,
+                source_id TEXT NOT NULL,
+                dest_id TEXT,
+                PRIMARY KEY (clone_id, source_id)
+            );
+        """)
+        row = self.__db.execute("SELECT id FROM clones WHERE source_id = ? AND dest_id = ?",
+                                (source_id, dest_id)).fetchone()
+        if row is None:
+            cursor = self.__db.execute("INSERT INTO clones (source_id, dest_id, started) VALUES (?, ?, ?)",
+                                       (source_id, dest_id, time.time()))
+            self.__db.commit()
+            self.__clone_id = cursor.lastrowid
+        else:
+            self.__clone_id = row[0]
+
+    def __write(self, sql, params):
+        with self.__lock:
+            self.__db.execute(sql, params)
+            self.__dirty += 1
+            if self.__dirty >= self.__commit_every or time.time() - self.__last_commit >= self.__commit_interval:
+                self.__commit()
+
+    def __commit(self):
+        self.__db.commit()
+        self.__dirty = 0
+        self.__last_commit = time.time()
+
+    def is_resumable(self):
+        with self.__lock:
+            row = self.__db.execute("SELECT 1 FROM folders WHERE clone_id = ? AND done = 0 LIMIT 1",
+                                    (self.__clone_id,)).fetchone()
+        return row is not None
+
+    def frontier(self):
+        """:return: List of (source_id, dest_id, path) of the folders that still have pending work"""
+        with self.__lock:
+            return self.__db.execute("SELECT source_id, dest_id, path FROM folders WHERE clone_id = ? AND done = 0",
+                                     (self.__clone_id,)).fetchall()
+
+    def dest_of(self, source_id):
+        with self.__lock:
+            row = self.__db.execute("SELECT dest_id FROM folders WHERE clone_id = ? AND source_id = ?",
+                                    (self.__clone_id, source_id)).fetchone()
+        return row[0] if row else None
+
+    def known_folders(self):
+        with self.__lock:
+            rows = self.__db.execute("SELECT source_id FROM folders WHERE clone_id = ?", (self.__clone_id,))
+            return {row[0] for row in rows}
+
+    def is_copied(self, source_id):
+        with self.__lock:
+            row = self.__db.execute("SELECT 1 FROM files WHERE clone_id = ? AND source_id = ?",
+                                    (self.__clone_id, source_id)).fetchone()
+        return row is not None
+
+    def add_folder(self, source_id, dest_id, path):
+        self.__write("INSERT OR REPLACE INTO folders (clone_id, source_id, dest_id, path, done) VALUES (?, ?, ?, ?, 0)",
+                     (self.__clone_id, source_id, dest_id, path))
+
+    def folder_done(self, source_id):
+        self.__write("UPDATE folders SET done = 1 WHERE clone_id = ? AND source_id = ?",
+                     (self.__clone_id, source_id))
+
+    def file_copied(self, source_id, dest_id):
+        self.__write("INSERT OR REPLACE INTO files (clone_id, source_id, dest_id) VALUES (?, ?, ?)",
+                     (self.__clone_id, source_id, dest_id))
+
+    def finish(self):
+        """Forgets a clone that completed without pending work."""
+        with self.__lock:
+            for table in ('files', 'folders'):
+                self.__db.execute(f"DELETE FROM {table} WHERE clone_id = ?", (self.__clone_id,))
+            self.__db.execute("DELETE FROM clones WHERE id = ?", (self.__clone_id,))
+            self.__commit()
+        LOGGER.info(f"Clone journal of {self.source_id} -> {self.dest_id} cleared")
+
+    def close(self):
+        with self.__lock:
+            self.__commit()
+            self.__db.close()
@@ -0,0 +1,218 @@
+import itertools
+import multiprocessing
+import queue
+import threading
+import time
+
+from bot import LOGGER
+from bot.config import CLONE_PROCESSES, CLONE_WORKERS
+from bot.sa_pool import get_pool, set_pool, ServiceAccountPool
+
+# Seconds a worker remembers a cancelled clone, its late shards are answered at once meanwhile.
+CANCELLED_TTL = 3600
+
+
+class _Shard:
+    def __init__(self, clone_id, files, worker):
+        self.clone_id = clone_id
+        self.files = files
+        self.worker = worker
+        # ('copied', file id, response, account path) for every copy, then ('done', ids of failed files)
+        self.events = queue.Queue()
+
+
+class ShardWorkers:
+    """
+    Worker processes that copy shards of folder clones, so copies are not bound to one core.
+
+    The parent process keeps walking the source and creating folders, every batch of
+    files it would copy becomes a shard sent to the least busy worker. Each worker owns
+    a disjoint slice of the service accounts and copies with `threads` threads of its
+    own. Every copy is reported back as it happens, so the parent keeps its journal,
+    index and CloneStatus up to date. Workers that die are started again.
+    """
+
+    def __init__(self, processes=CLONE_PROCESSES, threads=CLONE_WORKERS):
+        accounts = [account.path for account in get_pool().accounts]
+        self.processes = max(1, min(processes, len(accounts)))
+        self.threads = max(1, threads)
+        self.__slices = [accounts[i::self.processes] for i in range(self.processes)]
+        # Spawned, a forked copy of the bot would inherit the locks held by its threads.
+        self.__context = multiprocessing.get_context('spawn')
+        self.__results = self.__context.Queue()
+        self.__lock = threading.Lock()
+        self.__ids = itertools.count()
+        self.__shards = {}
+        self.__load = [0] * self.processes
+        self.__workers = [None] * self.processes
+        for index in range(self.processes):
+            self.__start(index)
+        threading.Thread(target=self.__collect, name='shard-results', daemon=True).start()
+
+    def __start(self, index):
+        tasks = self.__context.Queue()
+        process = self.__context.Process(target=_work, name=f'clone-shard-{index}', daemon=True,
+                                         args=(self.__slices[index], tasks, self.__results, self.threads))
+        process.start()
+        self.__workers[index] = (process, tasks)
+        LOGGER.info(f"Started clone shard worker {index} with {len(self.__slices[index])} service accounts")
+
+    def copy(self, clone_id, files, parent_id, on_copied):
+        """
+        Copies files into parent_id on a worker process, blocking until the shard is done.
+        clone_id has to be unique to the clone, shards of a cancelled clone_id are dropped.
+        on_copied(file, response, account_path) is called for every copy, on the calling thread.
+        :return: List of files that could not be copied
+        """
+        with self.__lock:
+            shard_id = next(self.__ids)
+            worker = min(range(self.processes), key=self.__load.__getitem__)
+            self.__load[worker] += 1
+            shard = self.__shards[shard_id] = _Shard(clone_id, files, worker)
+            tasks = self.__workers[worker][1]
+        tasks.put(('copy', clone_id, shard_id, files, parent_id))
+        pending = {file.get('id'): file for file in files}
+        try:
+            while True:
+                event = shard.events.get()
+                if event[0] == 'done':
+                    failed = event[1]
+                    break
+                _, file_id, response, account = event
+                file = pending.pop(file_id, None)
+                if file is not None:
+                    on_copied(file, response, account)
+        finally:
+            with self.__lock:
+                self.__shards.pop(shard_id, None)
+                self.__load[worker] -= 1
+        if failed is None:
+            # The shard was cancelled or its worker died, whatever it did not report is lost.
+            return list(pending.values())
+        return [pending[file_id] for file_id in failed if file_id in pending]
+
+    def cancel(self, clone_id):
+        """Drops the shards of a clone, those in flight return at once."""
+        with self.__lock:
+            shards = [shard for shard in self.__shards.values() if shard.clone_id == clone_id]
+            workers = [tasks for _, tasks in self.__workers]
+        for tasks in workers:
+            tasks.put(('cancel', clone_id))
+        for shard in shards:
+            shard.events.put(('done', None))
+
+    def __collect(self):
+        while True:
+            try:
+                event = self.__results.get(timeout=1)
+            except queue.Empty:
+                self.__check_workers()
+                continue
+            with self.__lock:
+                shard = self.__shards.get(event[1])
+            if shard is not None:
+                shard.events.put((event[0],) + tuple(event[2:]))
+
+    def __check_workers(self):
+        for index, (process, _) in enumerate(self.__workers):
+            if process.is_alive():
+                continue
+            LOGGER.error(f"Clone shard worker {index} exited with code {process.exitcode}, restarting it")
+            with self.__lock:
+                lost = [shard for shard in self.__shards.values() if shard.worker == index]
+                self.__start(index)
+            for shard in lost:
+                shard.events.put(('done', None))
+
+
+class _Listener:
+    """Reports the copies of a worker process's helper back to the parent."""
+
+    def __init__(self, results):
+        self.__results = results
+        self.__local = threading.local()
+
+    @property
+    def shard_id(self):
+        return getattr(self.__local, 'shard_id', None)
+
+    @shard_id.setter
+    def shard_id(self, shard_id):
+        self.__local.shard_id = shard_id
+
+    def onFileCopied(self, file, parent_id, response, account):
+        self.__results.put(('copied', self.shard_id, file.get('id'), response, account.path if account else None))
+
+
+def _work(accounts, tasks, results, threads):
+    """Entry point of a worker process."""
+    # Imported here, bot.gDrive imports this module.
+    from bot.gDrive import GoogleDriveHelper
+    set_pool(ServiceAccountPool(files=accounts))
+    listener = _Listener(results)
+    helpers = {}
+    # Clone id -> when it was cancelled
+    cancelled = {}
+    lock = threading.Lock()
+
+    def helper_for(parent_id):
+        # One helper per process, it only needs some valid folder id to start.
+        with lock:
+            if not helpers:
+                helpers[None] = GoogleDriveHelper(listener=listener, GFolder_ID=parent_id)
+            return helpers[None]
+
+    def run():
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            now = time.monotonic()
+            if task[0] == 'cancel':
+                with lock:
+                    cancelled[task[1]] = now
+                    for clone_id in [i for i, when in cancelled.items() if now - when > CANCELLED_TTL]:
+                        del cancelled[clone_id]
+                continue
+            _, clone_id, shard_id, files, parent_id = task
+            with lock:
+                skipped = clone_id in cancelled
+            if skipped:
+                # The parent still waits for it, whether or not cancel() saw the shard.
+                results.put(('done', shard_id, None))
+                continue
+            listener.shard_id = shard_id
+            try:
+                failed = helper_for(parent_id).copyFiles(files, parent_id, _NullStatus())
+                results.put(('done', shard_id, [file.get('id') for file in failed]))
+            except Exception as e:
+                LOGGER.error(f"Shard {shard_id} failed: {e}")
+                results.put(('done', shard_id, None))
+
+    workers = [threading.Thread(target=run, name=f'shard-copy-{i}', daemon=True) for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+class _NullStatus:
+    """Progress is kept by the parent's CloneStatus."""
+
+    def set_name(self, name=''):
+        pass
+
+    def add_size(self, value):
+        pass
+
+
+_workers = None
+_workers_lock = threading.Lock()
+
+
+def get_shard_workers():
+    global _workers
+    with _workers_lock:
+        if _workers is None:
+            _workers = ShardWorkers()
+        return _workers
@@ -1,3 +1,5 @@
+import threading
+
 from bot.fs_utils import get_readable_file_size
 
 class CloneStatus:
@@ -10,13 +12,22 @@ class CloneStatus:
         self.MainFolderLink = ''
         self.DestinationFolderName = ''
         self.DestinationFolderLink = ''
+        # CloneStatus of every destination of a fan-out clone.
+        self.targets = []
+        # CloneStatus of every link of a multi-link clone started so far.
+        self.links = []
+        self.total_links = 0
+        self.__lock = threading.Lock()
 
+    def get_bytes(self):
+        return int(self.size) + sum(target.get_bytes() for target in self.targets + self.links)
 
     def get_size(self):
-        return get_readable_file_size(int(self.size))
+        return get_readable_file_size(self.get_bytes())
     
     def add_size(self, value):
-        self.size += int(value)
+        with self.__lock:
+            self.size += int(value)
 
     def set_name(self, name=''):
         self.name = name
@@ -42,4 +53,73 @@ class CloneStatus:
 
     def SetDestinationFolder(self, folder_name, link):
         self.DestinationFolderName = folder_name
-        self.DestinationFolderLink = link
\ No newline at end of file
+        self.DestinationFolderLink = link
+
+    def to_dict(self):
+        """:return: The progress as plain data, sent by queue workers to the frontend"""
+        return {'size': self.size, 'name': self.name, 'status': self.status, 'checking': self.checking,
+                'main': [self.MainFolderName, self.MainFolderLink],
+                'destination': [self.DestinationFolderName, self.DestinationFolderLink],
+                'targets': [target.to_dict() for target in self.targets],
+                'links': [link.to_dict() for link in self.links], 'total_links': self.total_links}
+
+    def load(self, data):
+        """Takes over the progress of to_dict(), keeping the nested statuses already there."""
+        self.size = data['size']
+        self.name = data['name']
+        self.status = data['status']
+        self.checking = data['checking']
+        self.MainFolderName, self.MainFolderLink = data['main']
+        self.DestinationFolderName, self.DestinationFolderLink = data['destination']
+        self.total_links = data['total_links']
+        for attr in ('targets', 'links'):
+            nested = getattr(self, attr)
+            while len(nested) < len(data[attr]):
+                nested.append(CloneStatus())
+            del nested[len(data[attr]):]
+            for status, values in zip(nested, data[attr]):
+                status.load(values)
+
+class CountStatus:
+    def __init__(self):
+        self.name = ''
+        self.link = ''
+        self.files = 0
+        self.folders = 0
+        self.size = 0
+        self.status = False
+        self.__lock = threading.Lock()
+
+    def get_size(self):
+        return get_readable_file_size(int(self.size))
+
+    def add_file(self, size=0):
+        with self.__lock:
+            self.files += 1
+            self.size += int(size)
+
+    def add_folder(self):
+        with self.__lock:
+            self.folders += 1
+
+    def totals(self):
+        return self.files, self.folders, self.size
+
+    def to_dict(self):
+        """:return: The progress as plain data, sent by queue workers to the frontend"""
+        return {'name': self.name, 'link': self.link, 'totals': list(self.totals()), 'status': self.status}
+
+    def load(self, data):
+        self.name = data['name']
+        self.link = data['link']
+        self.set_totals(data['totals'])
+        self.status = data['status']
+
+    def set_totals(self, totals):
+        self.files, self.folders, self.size = totals
+
+    def set_status(self, stat):
+        self.status = stat
+
+    def done(self):
+        return self.status
@@ -13,6 +13,57 @@ AUTHORISED_USERS = []
 INDEX_URL = ""
 IS_TEAM_DRIVE = True
 USE_SERVICE_ACCOUNTS = True
+CLONE_WORKERS = 8
+# Number of files copied in parallel per clone.
+COPY_BATCH_SIZE = 20
+# Copies sent per batch request (max 100). Set to 1 to disable batching.
+LIST_WORKERS = 4
+# Number of source folders listed at the same time.
+CLONE_JOURNAL = "clone_journal.db"
+# SQLite file used to resume interrupted clones.
+SYNC_STATE = "sync_state.db"
+# SQLite file with the changes page token and id mapping of folders kept in sync with /sync.
+LISTING_CACHE_TTL = 600
+# Seconds listings of source folders (and /count results) are reused, 0 disables the cache.
+LISTING_CACHE_MAX_ITEMS = 50000
+# Files and folders kept in memory across all cached listings, least recently used folders are dropped first.
+# Each one costs about 1 KB, so the default stays around 50 MB, well inside a 512 MB dyno.
+LISTING_CACHE_FILE = ""
+# Optional SQLite file so cached listings survive restarts.
+SA_DAILY_LIMIT_GB = 750
+# Daily upload cap of a single service account.
+DRIVE_DISCOVERY_FILE = ""
+# Optional path to a Drive v3 discovery document, the bundled copy is used when empty.
+DRIVE_CONNECT_TIMEOUT = 15
+DRIVE_READ_TIMEOUT = 650
+# Seconds. Copies of big files can take minutes before Drive answers.
+HTTP_POOL_SIZE = 64
+# Keep-alive connections shared by all Drive clients.
+DRIVE_REQUESTS_PER_SECOND = 100
+DRIVE_MAX_REQUESTS_PER_SECOND = 200
+# Starting and highest Drive API call rate per account, it adapts to Drive's rate limit answers.
+CLONE_PROCESSES = 0
+# Worker processes copying the files of folder clones, each with its own slice of the service accounts. 0 copies in the bot's process.
+ASYNC_CLONE = False
+# Copy folders with the asyncio Drive client instead of worker threads (needs aiohttp).
+ASYNC_COPY_CONCURRENCY = 200
+# Copies in flight at once in an asyncio clone.
+MAX_CONCURRENT_CLONES = 2
+# Clones running at the same time, the rest wait in the queue.
+MAX_JOBS_PER_USER = 2
+# Queued plus running clones allowed per user (the owner is not limited).
+STATUS_UPDATE_INTERVAL = 5
+# Seconds between edits of a clone status message.
+METRICS_PORT = 0
+# Port of the Prometheus metrics endpoint on 127.0.0.1, 0 disables it.
+BOT_MODE = "standalone"
+# standalone runs everything in one process, frontend only talks to Telegram and queues the clones in JOB_QUEUE, worker clones the queued jobs without Telegram.
+JOB_QUEUE = "sqlite:jobs.db"
+# Queue shared by frontends and workers, as backend:location.
+JOB_LEASE_SECONDS = 60
+# Seconds a worker can go without a heartbeat before another one takes its job over.
+WORKER_NAME = ""
+# Name of a worker in logs and in the queue, hostname:pid when empty.
 # --------------------------------------
 
 # dont edit below this >
@@ -26,3 +77,29 @@ AUTHORISED_USERS = json.loads(os.environ.get('AUTHORISED_USERS', json.dumps(AUTH
 INDEX_URL = os.environ.get('INDEX_URL', INDEX_URL)
 IS_TEAM_DRIVE = stb(os.environ.get('IS_TEAM_DRIVE', str(IS_TEAM_DRIVE)))
 USE_SERVICE_ACCOUNTS = stb(os.environ.get('USE_SERVICE_ACCOUNTS', str(USE_SERVICE_ACCOUNTS)))
+CLONE_WORKERS = int(os.environ.get('CLONE_WORKERS', CLONE_WORKERS))
+COPY_BATCH_SIZE = min(int(os.environ.get('COPY_BATCH_SIZE', COPY_BATCH_SIZE)), 100)
+LIST_WORKERS = int(os.environ.get('LIST_WORKERS', LIST_WORKERS))
+CLONE_JOURNAL = os.environ.get('CLONE_JOURNAL', CLONE_JOURNAL)
+SYNC_STATE = os.environ.get('SYNC_STATE', SYNC_STATE)
+LISTING_CACHE_TTL = int(os.environ.get('LISTING_CACHE_TTL', LISTING_CACHE_TTL))
+LISTING_CACHE_MAX_ITEMS = int(os.environ.get('LISTING_CACHE_MAX_ITEMS', LISTING_CACHE_MAX_ITEMS))
+LISTING_CACHE_FILE = os.environ.get('LISTING_CACHE_FILE', LISTING_CACHE_FILE)
+SA_DAILY_LIMIT_GB = int(os.environ.get('SA_DAILY_LIMIT_GB', SA_DAILY_LIMIT_GB))
+DRIVE_DISCOVERY_FILE = os.environ.get('DRIVE_DISCOVERY_FILE', DRIVE_DISCOVERY_FILE)
+DRIVE_CONNECT_TIMEOUT = float(os.environ.get('DRIVE_CONNECT_TIMEOUT', DRIVE_CONNECT_TIMEOUT))
+DRIVE_READ_TIMEOUT = float(os.environ.get('DRIVE_READ_TIMEOUT', DRIVE_READ_TIMEOUT))
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', HTTP_POOL_SIZE))
+DRIVE_REQUESTS_PER_SECOND = float(os.environ.get('DRIVE_REQUESTS_PER_SECOND', DRIVE_REQUESTS_PER_SECOND))
+DRIVE_MAX_REQUESTS_PER_SECOND = float(os.environ.get('DRIVE_MAX_REQUESTS_PER_SECOND', DRIVE_MAX_REQUESTS_PER_SECOND))
+CLONE_PROCESSES = int(os.environ.get('CLONE_PROCESSES', CLONE_PROCESSES))
+ASYNC_CLONE = stb(os.environ.get('ASYNC_CLONE', str(ASYNC_CLONE)))
+ASYNC_COPY_CONCURRENCY = int(os.environ.get('ASYNC_COPY_CONCURRENCY', ASYNC_COPY_CONCURRENCY))
+MAX_CONCURRENT_CLONES = int(os.environ.get('MAX_CONCURRENT_CLONES', MAX_CONCURRENT_CLONES))
+MAX_JOBS_PER_USER = int(os.environ.get('MAX_JOBS_PER_USER', MAX_JOBS_PER_USER))
+STATUS_UPDATE_INTERVAL = int(os.environ.get('STATUS_UPDATE_INTERVAL', STATUS_UPDATE_INTERVAL))
+METRICS_PORT = int(os.environ.get('METRICS_PORT', METRICS_PORT))
+BOT_MODE = os.environ.get('BOT_MODE', BOT_MODE)
+JOB_QUEUE = os.environ.get('JOB_QUEUE', JOB_QUEUE)
+JOB_LEASE_SECONDS = int(os.environ.get('JOB_LEASE_SECONDS', JOB_LEASE_SECONDS))
+WORKER_NAME = os.environ.get('WORKER_NAME', WORKER_NAME)
@@ -0,0 +1,61 @@
+import threading
+
+G_DRIVE_DIR_MIME_TYPE = "application/vnd.google-apps.folder"
+
+
+class DestinationIndex:
+    """
+    In-memory name -> metadata index of destination folders.
+    Every folder is listed once (with full paging) the first time it is looked up,
+    later lookups and updates never touch the Drive API.
+    """
+
+    def __init__(self, lister):
+        # lister(folder_id) must return the complete list of children of folder_id
+        self.__lister = lister
+        self.__folders = {}
+        self.__lock = threading.Lock()
+
+    def __get(self, folder_id):
+        with self.__lock:
+            entry = self.__folders.get(folder_id)
+        if entry is not None:
+            return entry
+        entry = ({}, {})
+        for meta in self.__lister(folder_id):
+            self.__insert(entry, meta)
+        with self.__lock:
+            return self.__folders.setdefault(folder_id, entry)
+
+    @staticmethod
+    def __insert(entry, meta):
+        files, folders = entry
+        target = folders if meta.get('mimeType') == G_DRIVE_DIR_MIME_TYPE else files
+        target.setdefault(meta.get('name'), meta)
+
+    def find_file(self, name, parent_id):
+        return self.__get(parent_id)[0].get(name)
+
+    def find_folder(self, name, parent_id):
+        return self.__get(parent_id)[1].get(name)
+
+    def children(self, folder_id):
+        """:return: Indexed files and folders of folder_id, one per name"""
+        files, folders = self.__get(folder_id)
+        with self.__lock:
+            return list(files.values()) + list(folders.values())
+
+    def add(self, parent_id, meta):
+        with self.__lock:
+            entry = self.__folders.get(parent_id)
+            if entry is not None:
+                self.__insert(entry, meta)
+
+    def add_empty(self, folder_id):
+        """Registers a folder created by us, so it never needs listing."""
+        with self.__lock:
+            self.__folders.setdefault(folder_id, ({}, {}))
+
+    def forget(self, folder_id):
+        with self.__lock:
+            self.__folders.pop(folder_id, None)
@@ -0,0 +1,222 @@
+import json
+import re
+import threading
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+from bot import LOGGER
+
+# Upper bounds in seconds of the latency histogram buckets.
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, float('inf'))
+_ID = r'[^/]+'
+# (method, path under /drive/v3/) -> API method name
+_CALLS = (
+    ('GET', re.compile(r'files/generateIds'), 'files.generateIds'),
+    ('POST', re.compile(rf'files/{_ID}/copy'), 'files.copy'),
+    ('POST', re.compile(rf'files/{_ID}/permissions'), 'permissions.create'),
+    ('GET', re.compile(r'files'), 'files.list'),
+    ('POST', re.compile(r'files'), 'files.create'),
+    ('GET', re.compile(rf'files/{_ID}'), 'files.get'),
+    ('PATCH', re.compile(rf'files/{_ID}'), 'files.update'),
+    ('DELETE', re.compile(rf'files/{_ID}'), 'files.delete'),
+    ('GET', re.compile(r'changes/startPageToken'), 'changes.getStartPageToken'),
+    ('GET', re.compile(r'changes'), 'changes.list'),
+)
+
+
+def call_name(method, uri):
+    """:return: The Drive API method behind an HTTP request, e.g. files.copy"""
+    path = urlparse(uri).path
+    if path.startswith('/batch'):
+        return 'batch'
+    path = path.split('/drive/v3/', 1)[-1].strip('/')
+    for call_method, pattern, name in _CALLS:
+        if call_method == method and pattern.fullmatch(path):
+            return name
+    return f'{method} {path}'
+
+
+def error_reason(status, content):
+    """:return: The reason of a Drive error response, or None for a successful one"""
+    if status < 400:
+        return None
+    try:
+        reason = json.loads(content).get('error').get('errors')[0].get('reason')
+    except (ValueError, AttributeError, IndexError, TypeError):
+        reason = None
+    if reason is None:
+        return '5xx' if status >= 500 else str(status)
+    return reason
+
+
+def account_name(credentials):
+    return getattr(credentials, 'service_account_email', None) or 'token'
+
+
+class _Histogram:
+    def __init__(self):
+        self.counts = [0] * len(LATENCY_BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.sum += seconds
+        self.count += 1
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                self.counts[i] += 1
+                return
+
+    def quantile(self, q):
+        """:return: The upper bound of the bucket holding the q-quantile"""
+        target = q * self.count
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return LATENCY_BUCKETS[-1]
+
+
+class DriveMetrics:
+    """Counters and latency histograms of every Drive call made by the bot."""
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.__lock:
+            # (call, status) -> count
+            self.calls = defaultdict(int)
+            # (call, reason) -> count
+            self.errors = defaultdict(int)
+            # call -> histogram
+            self.latency = defaultdict(_Histogram)
+            # call -> retries
+            self.retries = defaultdict(int)
+            # account -> [calls, errors]
+            self.accounts = defaultdict(lambda: [0, 0])
+
+    def record(self, call, status, reason=None, account=None, seconds=None):
+        """
+        Records one Drive call. Sub-requests of a batch are recorded without a latency,
+        the batch request itself carries it.
+        """
+        with self.__lock:
+            self.calls[(call, int(status))] += 1
+            if reason is not None:
+                self.errors[(call, reason)] += 1
+            if seconds is not None:
+                self.latency[call].observe(seconds)
+            if account is not None:
+                stats = self.accounts[account]
+                stats[0] += 1
+                if reason is not None:
+                    stats[1] += 1
+
+    def record_retry(self, call, count=1):
+        with self.__lock:
+            self.retries[call] += count
+
+    def summary(self):
+        """:return: HTML report for the /stats command"""
+        with self.__lock:
+            totals = defaultdict(int)
+            failures = defaultdict(int)
+            for (call, status), count in self.calls.items():
+                totals[call] += count
+                if status >= 400:
+                    failures[call] += count
+            lines = ['<b>Llamadas a la API de Drive</b>']
+            for call in sorted(totals, key=totals.get, reverse=True):
+                line = f'<code>{call}</code>: {totals[call]}'
+                histogram = self.latency.get(call)
+                if histogram is not None and histogram.count:
+                    line += f' · media {histogram.sum / histogram.count:.2f}s' \
+                            f' · p50 ≤{histogram.quantile(0.5)}s · p95 ≤{histogram.quantile(0.95)}s'
+                if failures[call]:
+                    line += f' · errores {failures[call]}'
+                lines.append(line)
+            if self.errors:
+                lines.append('\n<b>Errores</b>')
+                for (call, reason), count in sorted(self.errors.items(), key=lambda item: -item[1]):
+                    lines.append(f'<code>{call}</code> {reason}: {count}')
+            if self.retries:
+                lines.append('\n<b>Reintentos</b>')
+                for call, count in sorted(self.retries.items(), key=lambda item: -item[1]):
+                    lines.append(f'<code>{call}</code>: {count}')
+            if self.accounts:
+                # Accounts with the most errors first, the full list is in the Prometheus endpoint.
+                lines.append('\n<b>Cuentas</b>')
+                for account, (calls, errors) in sorted(self.accounts.items(), key=lambda item: -item[1][1])[:10]:
+                    lines.append(f'<code>{account}</code>: {calls} llamadas, {errors} errores')
+        if len(lines) == 1:
+            lines.append('Todavía no se ha hecho ninguna llamada.')
+        return '\n'.join(lines)
+
+    def prometheus(self):
+        """:return: The metrics in the Prometheus text exposition format"""
+        out = []
+        with self.__lock:
+            out.append('# TYPE drive_api_calls_total counter')
+            for (call, status), count in sorted(self.calls.items()):
+                out.append(f'drive_api_calls_total{{call="{call}",status="{status}"}} {count}')
+            out.append('# TYPE drive_api_errors_total counter')
+            for (call, reason), count in sorted(self.errors.items()):
+                out.append(f'drive_api_errors_total{{call="{call}",reason="{reason}"}} {count}')
+            out.append('# TYPE drive_api_retries_total counter')
+            for call, count in sorted(self.retries.items()):
+                out.append(f'drive_api_retries_total{{call="{call}"}} {count}')
+            out.append('# TYPE drive_api_account_calls_total counter')
+            for account, (calls, _) in sorted(self.accounts.items()):
+                out.append(f'drive_api_account_calls_total{{account="{account}"}} {calls}')
+            out.append('# TYPE drive_api_account_errors_total counter')
+            for account, (_, errors) in sorted(self.accounts.items()):
+                out.append(f'drive_api_account_errors_total{{account="{account}"}} {errors}')
+            out.append('# TYPE drive_api_latency_seconds histogram')
+            for call, histogram in sorted(self.latency.items()):
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS, histogram.counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else bound
+                    out.append(f'drive_api_latency_seconds_bucket{{call="{call}",le="{le}"}} {cumulative}')
+                out.append(f'drive_api_latency_seconds_sum{{call="{call}"}} {histogram.sum}')
+                out.append(f'drive_api_latency_seconds_count{{call="{call}"}} {histogram.count}')
+        return '\n'.join(out) + '\n'
+
+
+metrics = DriveMetrics()
+
+
+def record_retry(retry_state):
+    """tenacity before_sleep hook: counts and logs retries of Drive calls."""
+    name = retry_state.fn.__name__.split('__')[-1] if retry_state.fn else 'unknown'
+    metrics.record_retry(name)
+    LOGGER.info(f"Retrying {name} in {retry_state.next_action.sleep}s "
+                f"(attempt {retry_state.attempt_number}): {retry_state.outcome.exception()}")
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.rstrip('/') not in ('', '/metrics'):
+            self.send_error(404)
+            return
+        body = metrics.prometheus().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port, host='127.0.0.1'):
+    """Serves the metrics on http://host:port/metrics from a daemon thread."""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    LOGGER.info(f"Prometheus metrics on http://{host}:{port}/metrics")
+    return server
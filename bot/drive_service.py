@@ -0,0 +1,59 @@
+import os
+import threading
+
+from googleapiclient.discovery import build_from_document
+
+from bot import LOGGER
+from bot.config import DRIVE_DISCOVERY_FILE
+from bot.http_transport import PooledHttp
+
+# Drive v3 discovery document shipped with the bot, used when DRIVE_DISCOVERY_FILE is not set.
+BUNDLED_DISCOVERY_FILE = os.path.join(os.path.dirname(__file__), 'drive_v3_discovery.json')
+
+_discovery = None
+_credentials = {}
+_lock = threading.Lock()
+_local = threading.local()
+
+
+def get_discovery_document():
+    """:return: The Drive v3 discovery document, read from disk once per process"""
+    global _discovery
+    with _lock:
+        if _discovery is None:
+            path = DRIVE_DISCOVERY_FILE or BUNDLED_DISCOVERY_FILE
+            with open(path, 'r') as f:
+                # Kept as text: build_from_document modifies the parsed document it is given.
+                _discovery = f.read()
+            LOGGER.info(f"Loaded Drive discovery document from {path}")
+        return _discovery
+
+
+def build_drive(credentials):
+    return build_from_document(get_discovery_document(), http=PooledHttp(credentials))
+
+
+def get_credentials(key, credentials_factory):
+    """:return: The credentials of `key`, created once per process with credentials_factory()"""
+    with _lock:
+        credentials = _credentials.get(key)
+    if credentials is None:
+        credentials = credentials_factory()
+        with _lock:
+            credentials = _credentials.setdefault(key, credentials)
+    return credentials
+
+
+def get_service(key, credentials_factory):
+    """
+    Returns the Drive service of `key` for the calling thread, building it on first use.
+    Credentials are shared by all threads, see get_credentials.
+    """
+    services = getattr(_local, 'services', None)
+    if services is None:
+        services = _local.services = {}
+    service = services.get(key)
+    if service is None:
+        service = services[key] = build_drive(get_credentials(key, credentials_factory))
+    return service
+
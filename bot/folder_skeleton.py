@@ -0,0 +1,127 @@
+import threading
+
+from bot import LOGGER
+
+# files.generateIds hands out at most 1000 ids per call.
+ID_BLOCK = 1000
+
+
+class FolderSkeleton:
+    """
+    Creates destination folders in the background, in batches, with ids reserved up front.
+
+    reserve() returns a new folder id right away (taken from files.generateIds), so the
+    walk can go on and files can be queued for the folder at once. create() queues the
+    folder, a creator thread sends pending folders as batched files.create calls, each one
+    only once its parent exists, and wait(folder_id) blocks until that folder exists.
+    """
+
+    def __init__(self, generate_ids, create_batch, on_created=None, batch_size=50, linger=0.05):
+        # generate_ids(count) -> list of ids, create_batch([(id, name, parent_id)]) -> set of failed ids
+        self.__generate_ids = generate_ids
+        self.__create_batch = create_batch
+        self.__on_created = on_created
+        self.__batch_size = max(1, batch_size)
+        self.__linger = linger
+        self.__ids = []
+        self.__ids_lock = threading.Lock()
+        self.__cond = threading.Condition()
+        self.__pending = []
+        # Folder id -> Event set once the folder exists or failed
+        self.__events = {}
+        self.__failed = set()
+        self.__stopped = False
+        self.__thread = threading.Thread(target=self.__run, name='folder-skeleton', daemon=True)
+        self.__thread.start()
+
+    def reserve(self):
+        """:return: An unused id for a new folder"""
+        with self.__ids_lock:
+            if not self.__ids:
+                self.__ids = list(self.__generate_ids(ID_BLOCK))
+            return self.__ids.pop()
+
+    def create(self, folder_id, name, parent_id):
+        with self.__cond:
+            self.__events[folder_id] = threading.Event()
+            self.__pending.append((folder_id, name, parent_id))
+            self.__cond.notify()
+
+    def __state(self, folder_id):
+        """:return: True if folder_id exists, False if it failed, None while it is pending"""
+        event = self.__events.get(folder_id)
+        if event is None:
+            # Not created by us, so it already existed.
+            return True
+        if not event.is_set():
+            return None
+        return folder_id not in self.__failed
+
+    def wait(self, folder_id):
+        """:return: Whether folder_id exists, blocking while its creation is pending"""
+        event = self.__events.get(folder_id)
+        if event is not None:
+            event.wait()
+        return self.__state(folder_id)
+
+    def __take_ready(self):
+        """Pops up to a batch of folders whose parent exists, failing those whose parent failed."""
+        ready, failed, waiting = [], [], []
+        for item in self.__pending:
+            parent = self.__state(item[2])
+            if parent is None or len(ready) >= self.__batch_size:
+                waiting.append(item)
+            elif parent:
+                ready.append(item)
+            else:
+                failed.append(item)
+        self.__pending = waiting
+        return ready, failed
+
+    def __run(self):
+        while True:
+            with self.__cond:
+                while not self.__stopped and not self.__pending:
+                    self.__cond.wait()
+                if self.__stopped:
+                    return
+                if len(self.__pending) < self.__batch_size:
+                    # Give the walk a moment to fill the batch.
+                    self.__cond.wait(self.__linger)
+                ready, failed = self.__take_ready()
+                if not ready and not failed:
+                    # Everything pending waits for a parent that is still being created elsewhere.
+                    self.__cond.wait(self.__linger)
+                    continue
+            try:
+                failed_ids = set(self.__create_batch(ready)) if ready else set()
+            except Exception as e:
+                LOGGER.error(f"Failed to create {len(ready)} folders: {e}")
+                failed_ids = {item[0] for item in ready}
+            self.__finish(ready, failed_ids)
+            self.__finish(failed, {item[0] for item in failed})
+
+    def __finish(self, items, failed_ids):
+        with self.__cond:
+            self.__failed.update(failed_ids)
+            for folder_id, _, _ in items:
+                self.__events[folder_id].set()
+            self.__cond.notify_all()
+        if self.__on_created is not None:
+            for folder_id, _, _ in items:
+                self.__on_created(folder_id, folder_id not in failed_ids)
+
+    def join(self):
+        """Waits until every folder added so far is created or failed."""
+        with self.__cond:
+            events = list(self.__events.values())
+        for event in events:
+            event.wait()
+
+    def stop(self):
+        """Fails every folder not created yet and ends the creator thread."""
+        with self.__cond:
+            self.__stopped = True
+            pending, self.__pending = self.__pending, []
+            self.__cond.notify_all()
+        self.__finish(pending, {item[0] for item in pending})
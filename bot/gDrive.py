@@ -9,22 +9,94 @@ import logging
 import re
 import requests
 import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 from google.auth.transport.requests import Request
-from google.oauth2 import service_account
 from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 from googleapiclient.http import MediaFileUpload
 from tenacity import *
 
 from bot.config import IS_TEAM_DRIVE, \
-            USE_SERVICE_ACCOUNTS, GDRIVE_FOLDER_ID, INDEX_URL
+            USE_SERVICE_ACCOUNTS, GDRIVE_FOLDER_ID, INDEX_URL, CLONE_WORKERS, \
+            COPY_BATCH_SIZE, LIST_WORKERS, ASYNC_CLONE, CLONE_PROCESSES
 from bot.fs_utils import get_mime_type
+from bot.drive_index import DestinationIndex
+from bot.tree_walker import TreeWalker, SharedWalk, FILE, FOLDER, FOLDER_DONE
+from bot.clone_status import CloneStatus
+from bot.listing_cache import listing_cache
+from bot.clone_journal import CloneJournal
+from bot.sync_state import SyncState
+from bot.folder_skeleton import FolderSkeleton
+from bot.sa_pool import get_pool
+from bot.drive_service import get_service, get_credentials
+from bot import async_drive
+from bot.async_clone import AsyncClone
+from bot.clone_shards import get_shard_workers
+from bot.drive_metrics import metrics, record_retry, error_reason
+from bot.rate_limiter import THROTTLE_REASONS, jittered_backoff
 
 logging.getLogger('googleapiclient.discovery').setLevel(logging.ERROR)
-socket.setdefaulttimeout(650) # https://github.com/googleapis/google-api-python-client/issues/632#issuecomment-541973021
-SERVICE_ACCOUNT_INDEX = 0
+RATE_LIMIT_REASONS = ('userRateLimitExceeded', 'dailyLimitExceeded')
+TRANSIENT_REASONS = ('rateLimitExceeded', 'backendError', 'internalError')
+LIST_FIELDS = 'id, name, mimeType, size'
+# Sync mode also compares content, see GoogleDriveHelper.isChanged.
+SYNC_LIST_FIELDS = 'id, name, mimeType, size, md5Checksum, modifiedTime'
+CHANGE_FIELDS = f'nextPageToken, newStartPageToken, changes(fileId, removed, file({SYNC_LIST_FIELDS}, parents, trashed))'
+
+
+
+class CloneCancelled(Exception):
+    def __init__(self):
+        super().__init__("Clonación cancelada")
+
+
+def stop_if_cancelled(retry_state):
+    """tenacity stop condition: gives up retrying a GoogleDriveHelper call once its clone is cancelled."""
+    helper = retry_state.args[0] if retry_state.args else None
+    return getattr(helper, 'is_cancelled', False)
+
+
+def is_retryable(exception):
+    """tenacity retry condition: only rate limits, server errors and dropped connections are worth another try."""
+    if isinstance(exception, (ConnectionError, socket.timeout)):
+        # Raised by PooledHttp, e.g. for a kept-alive connection Google closed.
+        return True
+    if not isinstance(exception, HttpError):
+        return False
+    status = exception.resp.status
+    return status == 429 or status >= 500 or \
+        GoogleDriveHelper.getErrorReason(exception) in TRANSIENT_REASONS + THROTTLE_REASONS
+
+
+# Helper whose call is about to sleep before a retry, per thread.
+_retrying = threading.local()
+
+
+def before_retry_sleep(retry_state):
+    record_retry(retry_state)
+    _retrying.helper = retry_state.args[0] if retry_state.args else None
+
+
+def sleep_unless_cancelled(seconds):
+    """tenacity sleep: waits for the next attempt, cut short by cancelling the helper's clone."""
+    helper, _retrying.helper = getattr(_retrying, 'helper', None), None
+    if not isinstance(helper, GoogleDriveHelper):
+        time.sleep(seconds)
+    elif helper.wait_cancelled(seconds):
+        raise CloneCancelled()
+
+
+# Shared by every Drive call. The jitter keeps callers that failed together from retrying
+# together, the pace itself is set by the account's limiter in bot.rate_limiter.
+drive_retry = retry(wait=wait_random_exponential(multiplier=1, max=60), stop=stop_after_attempt(15) | stop_if_cancelled,
+                    retry=retry_if_exception(is_retryable), before=before_log(LOGGER, logging.DEBUG),
+                    before_sleep=before_retry_sleep, sleep=sleep_unless_cancelled)
+
 
 def clean_name(name):
     name = name.replace("'", "\\'")
@@ -41,8 +113,49 @@ class GoogleDriveHelper:
         self.__G_DRIVE_BASE_DOWNLOAD_URL = "https://drive.google.com/uc?id={}&export=download"
         self.__G_DRIVE_DIR_BASE_DOWNLOAD_URL = "https://drive.google.com/drive/folders/{}"
         self.__listener = listener
+        # googleapiclient services are not thread-safe, so every copy worker builds its own.
+        self.__local = threading.local()
+        self.__lock = threading.Lock()
+        # Service accounts leased from the pool by this helper's threads.
+        self.__accounts = []
         self.__service = self.authorize()
-        self.__listener = listener
+        self.__copy_pool = None
+        self.__pending_copies = None
+        self.__dest_index = None
+        self.__journal = None
+        self.__walker = None
+        self.__cancelled = threading.Event()
+        self.__sync = False
+        self.__delete = False
+        self.__list_fields = LIST_FIELDS
+        # Source file id -> outdated destination copy, trashed once the new copy exists.
+        self.__replaced = {}
+        # Creates the destination folders of a folder clone in the background.
+        self.__skeleton = None
+        # Folder id being created -> (source folder id or None if ignored, path, source parent id)
+        self.__creating = {}
+        # Set while /sync records the source -> destination mapping of a clone.
+        self.__sync_state = None
+        # Set while /sync walks the whole source, it has to see the source as it is now.
+        self.__fresh_listings = False
+        self.__complete = False
+        # This destination's view of a source walk shared with other destinations, see cloneMany.
+        self.__shared_walk = None
+        # Per destination helpers of a fan-out clone.
+        self.__targets = []
+        # Destination index kept across the links of a multi-link clone, see cloneLinks.
+        self.__shared_index = None
+        # Worker processes copying this clone's files, see CLONE_PROCESSES.
+        self.__shards = None
+        self.__shard_clone_id = None
+        # Set while an asyncio clone runs, see __clone_async.
+        self.__async_clone = None
+        # Source folder id -> [copies in flight, listing finished, had failures]
+        self.__folder_state = {}
+        self.transferred_size = 0
+        self.copied_files = 0
+        self.updated_files = 0
+        self.removed_files = 0
         self._file_uploaded_bytes = 0
         self.uploaded_bytes = 0
         self.UPDATE_INTERVAL = 5
@@ -60,9 +173,39 @@ class GoogleDriveHelper:
         else:
             self.gparentid = GFolder_ID
 
+    @property
+    def __service(self):
+        service = getattr(self.__local, 'service', None)
+        if service is None:
+            service = self.__local.service = self.authorize()
+        return service
+
+    @__service.setter
+    def __service(self, service):
+        self.__local.service = service
+
+    def wait_cancelled(self, timeout):
+        """:return: Whether the clone was cancelled within timeout seconds"""
+        return self.__cancelled.wait(timeout)
+
     def cancel(self):
         self.is_cancelled = True
         self.is_uploading = False
+        self.__cancelled.set()
+        walker = self.__walker
+        if walker is not None:
+            walker.stop()
+        skeleton = self.__skeleton
+        if skeleton is not None:
+            skeleton.stop()
+        for target in self.__targets:
+            target.cancel()
+        async_clone = self.__async_clone
+        if async_clone is not None:
+            async_clone.cancel()
+        shards = self.__shards
+        if shards is not None:
+            shards.cancel(self.__shard_clone_id)
 
     def speed(self):
         """
@@ -87,17 +230,38 @@ class GoogleDriveHelper:
         parsed = urlparse.urlparse(link)
         return parse_qs(parsed.query)['id'][0]
 
-    def switchServiceAccount(self):
-        global SERVICE_ACCOUNT_INDEX
-        service_account_count = len(os.listdir("accounts"))
-        if SERVICE_ACCOUNT_INDEX == service_account_count - 1:
-            SERVICE_ACCOUNT_INDEX = 0
-        SERVICE_ACCOUNT_INDEX += 1
-        LOGGER.info(f"Switching to {SERVICE_ACCOUNT_INDEX}.json service account")
-        self.__service = self.authorize()
+    def switchServiceAccount(self, reason='dailyLimitExceeded'):
+        """Puts this thread's account in cooldown and moves the thread to the next available one."""
+        pool = get_pool()
+        current = getattr(self.__local, 'account', None)
+        if current is not None:
+            if reason == 'dailyLimitExceeded':
+                pool.mark_exhausted(current)
+            else:
+                pool.mark_throttled(current)
+            self.__release_account(current)
+        account = pool.acquire(exclude=current)
+        LOGGER.info(f"Switching to {account} service account")
+        with self.__lock:
+            self.__accounts.append(account)
+        self.__local.account = account
+        self.__service = pool.service(account)
+
+    def __release_account(self, account):
+        with self.__lock:
+            if account in self.__accounts:
+                self.__accounts.remove(account)
+                get_pool().release(account)
 
-    @retry(wait=wait_exponential(multiplier=2, min=3, max=6), stop=stop_after_attempt(15),
-           retry=retry_if_exception_type(HttpError), before=before_log(LOGGER, logging.DEBUG))
+    def releaseAccounts(self):
+        with self.__lock:
+            accounts, self.__accounts = self.__accounts, []
+        for account in accounts:
+            get_pool().release(account)
+        for target in self.__targets:
+            target.releaseAccounts()
+
+    @drive_retry
     def __set_permission(self, drive_id):
         permissions = {
             'role': 'reader',
@@ -109,29 +273,157 @@ class GoogleDriveHelper:
                                                    body=permissions).execute()
 
 
-    @retry(wait=wait_exponential(multiplier=2, min=3, max=6), stop=stop_after_attempt(15),
-           retry=retry_if_exception_type(HttpError), before=before_log(LOGGER, logging.DEBUG))
+    @drive_retry
     def copyFile(self, file_id, dest_id, status):
         body = {
             'parents': [dest_id]
         }
+        while True:
+            if self.is_cancelled:
+                raise CloneCancelled()
+            try:
+                return self.__service.files().copy(supportsAllDrives=True, fileId=file_id, body=body).execute()
+            except HttpError as err:
+                reason = self.getErrorReason(err)
+                if reason not in RATE_LIMIT_REASONS or not USE_SERVICE_ACCOUNTS:
+                    raise err
+                LOGGER.info(f"Got: {reason}, Trying Again.")
+                self.switchServiceAccount(reason)
 
-        try:
-            res = self.__service.files().copy(supportsAllDrives=True,fileId=file_id,body=body).execute()
-            return res
-        except HttpError as err:
-            if err.resp.get('content-type', '').startswith('application/json'):
-                reason = json.loads(err.content).get('error').get('errors')[0].get('reason')
-                if reason == 'userRateLimitExceeded' or reason == 'dailyLimitExceeded':
-                    if USE_SERVICE_ACCOUNTS:
-                        self.switchServiceAccount()
-                        LOGGER.info(f"Got: {reason}, Trying Again.")
-                        self.copyFile(file_id, dest_id, status)
+    @staticmethod
+    def getErrorReason(err):
+        if err.resp.get('content-type', '').startswith('application/json'):
+            try:
+                return json.loads(err.content).get('error').get('errors')[0].get('reason')
+            except (ValueError, AttributeError, IndexError, TypeError):
+                return None
+
+    @drive_retry
+    def __list_page(self, query, fields, page_token):
+        return self.__service.files().list(supportsAllDrives=True,
+                                           includeItemsFromAllDrives=True,
+                                           q=query,
+                                           spaces='drive',
+                                           pageSize=1000,
+                                           fields=f'nextPageToken, files({fields})',
+                                           pageToken=page_token).execute()
+
+    def iterFolder(self, folder_id, fields=LIST_FIELDS, cached=False):
+        """
+        Yields the children of folder_id one page at a time.
+        :param cached: Serve and store the listing through the source listing cache
+        """
+        if cached:
+            children = listing_cache.get(folder_id, fields)
+            if children is not None:
+                yield children
+                return
+        listed = []
+        page_token = None
+        while True:
+            if self.is_cancelled:
+                raise CloneCancelled()
+            response = self.__list_page(f"'{folder_id}' in parents and trashed = false", fields, page_token)
+            page = response.get('files', [])
+            if cached:
+                listed.extend(page)
+            yield page
+            page_token = response.get('nextPageToken', None)
+            if page_token is None:
+                break
+        if cached:
+            listing_cache.put(folder_id, fields, listed)
+
+    def listFolder(self, folder_id, fields=LIST_FIELDS):
+        files = []
+        for page in self.iterFolder(folder_id, fields):
+            files.extend(page)
+        return files
+
+    @drive_retry
+    def __execute_batch(self, batch):
+        batch.execute()
+
+    def copyFiles(self, files, dest_id, status, attempts=5):
+        """
+        Copies files into dest_id using batch requests, handling every sub-response on its own.
+        Sub-requests that hit the per-user quota are re-sent on the next service account,
+        transient failures are re-sent after a jittered backoff.
+        :return: List of files that could not be copied
+        """
+        tries = 0
+        failed = []
+        rate_limited = []
+        transient = []
+        reasons = set()
+
+        def callback(request_id, response, exception):
+            file = files[int(request_id)]
+            account = getattr(self.__local, 'account', None)
+            account = account.email if account is not None else 'token'
+            if exception is None:
+                metrics.record('files.copy', 200, account=account)
+                self.__record_copy(file, dest_id, response, status)
+                return
+            if isinstance(exception, HttpError):
+                metrics.record('files.copy', exception.resp.status,
+                               error_reason(exception.resp.status, exception.content), account)
+            else:
+                metrics.record('files.copy', 0, type(exception).__name__, account)
+            reason = self.getErrorReason(exception) if isinstance(exception, HttpError) else None
+            if reason in RATE_LIMIT_REASONS and USE_SERVICE_ACCOUNTS:
+                reasons.add(reason)
+                rate_limited.append(file)
+            elif reason in TRANSIENT_REASONS or \
+                    (isinstance(exception, HttpError) and exception.resp.status >= 500):
+                transient.append(file)
+            else:
+                LOGGER.error(f"Failed to copy {file.get('name')}: {exception}")
+                failed.append(file)
+
+        while files:
+            if self.is_cancelled:
+                failed.extend(files)
+                break
+            service = self.__service
+            batch = service.new_batch_http_request(callback=callback)
+            for index, file in enumerate(files):
+                batch.add(service.files().copy(supportsAllDrives=True, fileId=file.get('id'),
+                                               body={'parents': [dest_id]}),
+                          request_id=str(index))
+            self.__execute_batch(batch)
+            if rate_limited:
+                LOGGER.info(f"Got: {', '.join(sorted(reasons))} on {len(rate_limited)} copies, Trying Again.")
+                self.switchServiceAccount('dailyLimitExceeded' if 'dailyLimitExceeded' in reasons
+                                          else 'userRateLimitExceeded')
+            elif transient:
+                attempts -= 1
+                if attempts <= 0:
+                    failed.extend(transient)
+                    transient.clear()
                 else:
-                    raise err
+                    tries += 1
+                    self.__cancelled.wait(jittered_backoff(tries))
+            files = rate_limited + transient
+            if files:
+                metrics.record_retry('copyFiles', len(files))
+            rate_limited, transient = [], []
+            reasons.clear()
+        return failed
 
-    def clone(self, link, status, ignoreList=[]):
+    def clone(self, link, status, ignoreList=[], sync=False, delete=False):
+        """
+        :param sync: Also replace destination files whose content differs from the source
+        :param delete: With sync, trash destination entries that no longer exist in the source
+        """
         self.transferred_size = 0
+        self.copied_files = 0
+        self.updated_files = 0
+        self.removed_files = 0
+        self.__sync = sync
+        self.__delete = sync and delete
+        self.__list_fields = SYNC_LIST_FIELDS if sync else LIST_FIELDS
+        self.__complete = False
         try:
             file_id = self.getIdFromUrl(link)
         except (KeyError,IndexError):
@@ -141,41 +433,84 @@ class GoogleDriveHelper:
         LOGGER.info(f"File ID: {file_id}")
         try:
             meta = self.__service.files().get(supportsAllDrives=True, fileId=file_id,
-                                              fields="name,id,mimeType,size").execute()
+                                              fields=self.__list_fields.replace(' ', '')).execute()
             dest_meta = self.__service.files().get(supportsAllDrives=True, fileId=self.gparentid,
                                               fields="name,id,size").execute()
             status.SetMainFolder(meta.get('name'), self.__G_DRIVE_DIR_BASE_DOWNLOAD_URL.format(meta.get('id')))
             status.SetDestinationFolder(dest_meta.get('name'), self.__G_DRIVE_DIR_BASE_DOWNLOAD_URL.format(dest_meta.get('id')))
         except Exception as e:
             return f"{str(e).replace('>', '').replace('<', '')}"
+        if meta.get("mimeType") == self.__G_DRIVE_DIR_MIME_TYPE and self.__can_clone_async(sync):
+            return self.__clone_async(meta, status, ignoreList)
         if meta.get("mimeType") == self.__G_DRIVE_DIR_MIME_TYPE:
-            dir_id = self.check_folder_exists(meta.get('name'), self.gparentid)
-            if not dir_id:
-                dir_id = self.create_directory(meta.get('name'), self.gparentid)
+            self.__dest_index = self.__shared_index or \
+                DestinationIndex(partial(self.listFolder, fields=self.__list_fields))
+            self.__journal = CloneJournal(meta.get('id'), self.gparentid)
+            dir_id = self.__journal.dest_of(meta.get('id'))
+            if dir_id:
+                LOGGER.info(f"Resuming clone of {meta.get('name')} from its journal")
+            else:
+                dir_id = self.check_folder_exists(meta.get('name'), self.gparentid)
+                if not dir_id:
+                    dir_id = self.create_directory(meta.get('name'), self.gparentid)
+            if self.__shared_index is None:
+                self.__dest_index.forget(self.gparentid)
+            self.__map(meta.get('id'), dir_id, True)
+            workers = max(1, CLONE_WORKERS)
+            if CLONE_PROCESSES > 0 and USE_SERVICE_ACCOUNTS and not sync:
+                # Unlike id(self), never reused by a later clone the workers could mistake for this one.
+                self.__shard_clone_id = uuid.uuid4().hex
+                self.__shards = get_shard_workers()
+                # Every thread here waits on one shard, enough to keep all worker threads busy.
+                workers *= self.__shards.processes
+            self.__copy_pool = ThreadPoolExecutor(max_workers=workers)
+            # Keeps the folder walk at most a couple of copies ahead of the workers.
+            self.__pending_copies = threading.BoundedSemaphore(workers * 2)
+            self.__skeleton = FolderSkeleton(self.__generate_ids, self.createFolders, self.__folder_created,
+                                             batch_size=COPY_BATCH_SIZE)
             try:
                 self.cloneFolder(meta.get('name'), meta.get('name'), meta.get('id'), dir_id, status, ignoreList)
             except Exception as e:
-                if isinstance(e, RetryError):
-                    LOGGER.info(f"Total Attempts: {e.last_attempt.attempt_number}")
-                    err = e.last_attempt.exception()
-                else:
-                    err = str(e).replace('>', '').replace('<', '')
-                LOGGER.error(err)
-                return err
+                # A cancelled clone ends with the partial summary below.
+                if not self.is_cancelled:
+                    if isinstance(e, RetryError):
+                        LOGGER.info(f"Total Attempts: {e.last_attempt.attempt_number}")
+                        err = e.last_attempt.exception()
+                    else:
+                        err = str(e).replace('>', '').replace('<', '')
+                    LOGGER.error(err)
+                    return err
+            finally:
+                if not self.is_cancelled:
+                    self.__skeleton.join()
+                self.__skeleton.stop()
+                # Copies still waiting in the pool are dropped on cancel.
+                self.__copy_pool.shutdown(wait=True, cancel_futures=self.is_cancelled)
+                self.__skeleton = None
+                self.__shards = None
+                self.__dest_index = self.__shared_index
+                self.__folder_state = {}
+                # Folders that lost a copy stay in the frontier for the next run.
+                resumable = self.__journal.is_resumable()
+                self.__complete = not resumable and not self.is_cancelled
+                if not resumable:
+                    self.__journal.finish()
+                self.__journal.close()
+                self.__journal = None
             status.set_status(True)
-            msg += f'<a href="{self.__G_DRIVE_DIR_BASE_DOWNLOAD_URL.format(dir_id)}">{meta.get("name")}</a>' \
-                   f' ({get_readable_file_size(self.transferred_size)})'
-            if INDEX_URL:
-                url = requests.utils.requote_uri(f'{INDEX_URL}/{meta.get("name")}/')
-                msg += f' | <a href="{url}"> URL de índice</a>'
+            msg += self.__folder_summary(meta, dir_id, sync)
         else:
             try:
-                file = self.check_file_exists(meta.get('id'), self.gparentid)
+                file = self.check_file_exists(meta.get('name'), self.gparentid, self.__list_fields)
+                if file and sync and self.isChanged(meta, file):
+                    self.__replaced[meta.get('id')] = file.get('id')
+                    file = None
                 if file:
                     status.checkFileExist(True)
                 if not file:
                     status.checkFileExist(False)
                     file = self.copyFile(meta.get('id'), self.gparentid, status)
+                    self.__record_copy(meta, self.gparentid, file, status)
             except Exception as e:
                 if isinstance(e, RetryError):
                     LOGGER.info(f"Intentos totales: {e.last_attempt.attempt_number}")
@@ -194,57 +529,780 @@ class GoogleDriveHelper:
                 pass
         return msg
 
-    def cloneFolder(self, name, local_path, folder_id, parent_id, status, ignoreList=[]):
-        page_token = None
-        q = f"'{folder_id}' En los padres"
-        files = []
-        LOGGER.info(f"Syncing: {local_path}")
-        while True:
-            response = self.__service.files().list(supportsTeamDrives=True,
-                                                   includeTeamDriveItems=True,
-                                                   q=q,
-                                                   spaces='drive',
-                                                   fields='nextPageToken, files(id, name, mimeType,size)',
-                                                   pageToken=page_token).execute()
-            for file in response.get('files', []):
-                files.append(file)
-            page_token = response.get('nextPageToken', None)
-            if page_token is None:
-                break
-        if len(files) == 0:
-            return parent_id
-        for file in files:
-            if file.get('mimeType') == self.__G_DRIVE_DIR_MIME_TYPE:
-                file_path = os.path.join(local_path, file.get('name'))
-                current_dir_id = self.check_folder_exists(file.get('name'), parent_id)
-                if not current_dir_id:
-                    current_dir_id = self.create_directory(file.get('name'), parent_id)
-                if not str(file.get('id')) in ignoreList:
-                    self.cloneFolder(file.get('name'), file_path, file.get('id'), current_dir_id, status, ignoreList)
+    def __folder_summary(self, meta, dir_id, sync):
+        msg = ''
+        if self.is_cancelled:
+            LOGGER.info(f"Cancelled clone of {meta.get('name')} after {self.copied_files} files")
+            msg += f'<b>Clonación cancelada.</b> Copiados {self.copied_files} archivos a '
+        msg += f'<a href="{self.__G_DRIVE_DIR_BASE_DOWNLOAD_URL.format(dir_id)}">{meta.get("name")}</a>' \
+               f' ({get_readable_file_size(self.transferred_size)})'
+        if sync:
+            msg += f'\n{self.copied_files - self.updated_files} nuevos · {self.updated_files} actualizados'
+            if self.__delete:
+                msg += f' · {self.removed_files} eliminados'
+        if INDEX_URL:
+            url = requests.utils.requote_uri(f'{INDEX_URL}/{meta.get("name")}/')
+            msg += f' | <a href="{url}"> URL de índice</a>'
+        return msg
+
+    def __can_clone_async(self, sync):
+        """Plain folder clones to a single destination can run on the asyncio client, see ASYNC_CLONE."""
+        if not ASYNC_CLONE or sync or self.__shared_walk is not None or self.__shared_index is not None:
+            return False
+        if not async_drive.available():
+            LOGGER.warning("ASYNC_CLONE needs aiohttp, cloning with worker threads")
+            return False
+        return True
+
+    def __clone_async(self, meta, status, ignoreList):
+        self.__async_clone = AsyncClone(partial(get_credentials, 'token', self.__load_token), status, ignoreList,
+                                        lanes=CLONE_WORKERS)
+        if self.is_cancelled:
+            self.__async_clone.cancel()
+        try:
+            dir_id = self.__async_clone.run(meta, self.gparentid)
+        except Exception as e:
+            err = str(e).replace('>', '').replace('<', '')
+            LOGGER.error(err)
+            return err
+        finally:
+            self.copied_files = self.__async_clone.copied_files
+            self.transferred_size = self.__async_clone.transferred_size
+            self.__async_clone = None
+        status.set_status(True)
+        if dir_id is None:
+            return '<b>Clonación cancelada.</b>'
+        return self.__folder_summary(meta, dir_id, False)
+
+    def cloneMany(self, link, destinations, status, ignoreList=[], sync=False, delete=False):
+        """
+        Clones a link into several destinations, walking and listing the source only once.
+        Every destination gets its own helper, with its own index, folder mapping, journal
+        and CloneStatus (kept in status.targets), all fed from the same walk.
+        """
+        self.copied_files = 0
+        self.transferred_size = 0
+        try:
+            file_id = self.getIdFromUrl(link)
+        except (KeyError, IndexError):
+            return "No se pudo encontrar el ID de la unidad de Google en el enlace proporcionado"
+        fields = SYNC_LIST_FIELDS if sync else LIST_FIELDS
+        walker = self.__walker = TreeWalker(partial(self.iterFolder, fields=fields, cached=True),
+                                            workers=LIST_WORKERS, ignoreList=ignoreList)
+        shared = SharedWalk(walker, file_id, len(destinations))
+        status.targets = [CloneStatus() for _ in destinations]
+        targets = []
+        for index, destination in enumerate(destinations):
+            target = GoogleDriveHelper(GFolder_ID=destination)
+            target.__shared_walk = shared.consumer(index)
+            targets.append(target)
+        self.__targets = targets
+        if self.is_cancelled:
+            # cancel() may have come before the targets existed.
+            self.cancel()
+        results = [None] * len(targets)
+
+        def run(index):
+            try:
+                results[index] = targets[index].clone(link, status.targets[index], ignoreList, sync, delete)
+            except Exception as e:
+                LOGGER.exception(e)
+                results[index] = str(e).replace('>', '').replace('<', '')
+            finally:
+                # A single file or a failed start never reads the walk.
+                shared.detach(index)
+
+        threads = [threading.Thread(target=run, args=(index,), name=f'clone-target-{index}')
+                   for index in range(len(targets))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.__walker = None
+        self.copied_files = sum(target.copied_files for target in targets)
+        self.transferred_size = sum(target.transferred_size for target in targets)
+        for target in targets:
+            target.releaseAccounts()
+        self.__targets = []
+        status.set_status(True)
+        # Destinations are named rather than numbered, cloneLinks numbers the links around them.
+        return self.__summary('', [f'📁 <b>{target_status.DestinationFolderName or destination}</b>: {result}'
+                                   for destination, target_status, result in
+                                   zip(destinations, status.targets, results)])
+
+    def cloneLinks(self, links, destinations, status, ignoreList=[], sync=False, delete=False):
+        """
+        Clones several links one after another through this helper, so they share its Drive
+        clients, service accounts and, with a single destination, its destination index.
+        Every link gets its own CloneStatus in status.links. copied_files and
+        transferred_size end up with the totals of all links.
+        :return: Summary with one line per link
+        """
+        status.total_links = len(links)
+        if len(destinations) == 1:
+            fields = SYNC_LIST_FIELDS if sync else LIST_FIELDS
+            self.__shared_index = self.__dest_index = DestinationIndex(partial(self.listFolder, fields=fields))
+        results = []
+        copied = size = 0
+        try:
+            for link in links:
+                if self.is_cancelled:
+                    results.append(f'<code>{link}</code>: cancelado')
+                    continue
+                link_status = CloneStatus()
+                status.links.append(link_status)
+                # Left at zero by a link that fails before it starts, not at the previous link's totals.
+                self.copied_files = self.transferred_size = 0
+                if len(destinations) > 1:
+                    result = self.cloneMany(link, destinations, link_status, ignoreList, sync, delete)
                 else:
-                    LOGGER.info("Ignorando FolderID del clon: " + str(file.get('id')))
+                    result = self.clone(link, link_status, ignoreList, sync, delete)
+                copied += self.copied_files
+                size += self.transferred_size
+                results.append(result)
+        finally:
+            self.__shared_index = self.__dest_index = None
+        self.copied_files, self.transferred_size = copied, size
+        status.set_status(True)
+        # A link cloned to several destinations starts its destination lines below its number.
+        separator = '\n' if len(destinations) > 1 else ' '
+        return self.__summary(f'<b>{len(links)} enlaces</b> · {copied} archivos copiados '
+                              f'({get_readable_file_size(size)})\n',
+                              [f'<b>{index + 1}.</b>{separator}{result}' for index, result in enumerate(results)])
+
+    @staticmethod
+    def __summary(msg, results):
+        """:return: msg followed by one result per line, leaving out whole results past the message limit"""
+        for index, result in enumerate(results):
+            line = f'\n{result}' if msg else result
+            # Telegram messages are limited to 4096 characters.
+            if len(msg) + len(line) > 3800:
+                msg += f'\n… y {len(results) - index} más'
+                break
+            msg += line
+        return msg
+
+    def count(self, link, status):
+        """
+        Counts the files, folders and bytes of a link without copying anything, updating
+        status while the tree is walked. Totals and listings are kept in the listing cache,
+        so a /clone of the same link right after does not list it again.
+        """
+        try:
+            file_id = self.getIdFromUrl(link)
+        except (KeyError, IndexError):
+            return "No se pudo encontrar el ID de la unidad de Google en el enlace proporcionado"
+        try:
+            meta = self.__service.files().get(supportsAllDrives=True, fileId=file_id,
+                                              fields=SYNC_LIST_FIELDS.replace(' ', '')).execute()
+        except Exception as e:
+            return f"{str(e).replace('>', '').replace('<', '')}"
+        is_folder = meta.get('mimeType') == self.__G_DRIVE_DIR_MIME_TYPE
+        url = (self.__G_DRIVE_DIR_BASE_DOWNLOAD_URL if is_folder else self.__G_DRIVE_BASE_DOWNLOAD_URL)
+        status.name = meta.get('name')
+        status.link = url.format(meta.get('id'))
+        if not is_folder:
+            status.add_file(meta.get('size', 0))
+        else:
+            totals = listing_cache.totals(file_id)
+            if totals is not None:
+                status.set_totals(totals)
             else:
+                walker = self.__walker = TreeWalker(partial(self.iterFolder, fields=SYNC_LIST_FIELDS, cached=True),
+                                                    workers=LIST_WORKERS)
+                if self.is_cancelled:
+                    # cancel() may have come before the walker existed.
+                    walker.stop()
                 try:
-                    if not self.check_file_exists(file.get('name'), parent_id):
-                        status.checkFileExist(False)
-                        self.copyFile(file.get('id'), parent_id, status)
-                        self.transferred_size += int(file.get('size'))
-                        status.set_name(file.get('name'))
-                        status.add_size(int(file.get('size')))
-                    else:
-                        status.checkFileExist(True)
-                except TypeError:
-                    pass
+                    for kind, _, item in walker.walk(file_id):
+                        if kind == FOLDER:
+                            status.add_folder()
+                        elif kind == FILE:
+                            # Google Docs have no size.
+                            status.add_file(item.get('size', 0))
                 except Exception as e:
-                    if isinstance(e, RetryError):
-                        LOGGER.info(f"Intentos totales: {e.last_attempt.attempt_number}")
-                        err = e.last_attempt.exception()
+                    if not self.is_cancelled:
+                        LOGGER.error(e)
+                        return f"{str(e).replace('>', '').replace('<', '')}"
+                finally:
+                    self.__walker = None
+                if self.is_cancelled:
+                    return "Recuento cancelado."
+                listing_cache.put_totals(file_id, status.totals())
+        status.set_status(True)
+        files, folders, size = status.totals()
+        return f'<a href="{status.link}">{meta.get("name")}</a>\n' \
+               f'<b>Archivos:</b> {files} · <b>Carpetas:</b> {folders} · <b>Tamaño:</b> {get_readable_file_size(size)}'
+
+    def cloneFolder(self, name, local_path, folder_id, parent_id, status, ignoreList=[]):
+        journal = self.__journal
+        known = set()
+        # A shared walk always covers the whole tree, the journal then only skips copied files.
+        if journal is not None and journal.is_resumable() and self.__shared_walk is None:
+            roots = journal.frontier()
+            known = journal.known_folders()
+            LOGGER.info(f"Resuming {local_path} from {len(roots)} unfinished folders")
+        else:
+            roots = [(folder_id, parent_id, local_path)]
+            if journal is not None:
+                journal.add_folder(folder_id, parent_id, local_path)
+        # Source folder id -> destination folder id, for folders still being listed.
+        folders = {src: dest for src, dest, _ in roots}
+        paths = {src: path for src, _, path in roots}
+        # /sync takes its changes page token before walking, an older cached listing could miss changes.
+        cached = self.__sync_state is None and not self.__fresh_listings
+        walker = self.__walker = self.__shared_walk or \
+            TreeWalker(partial(self.iterFolder, fields=self.__list_fields, cached=cached),
+                       workers=LIST_WORKERS, ignoreList=ignoreList, skip=known)
+        for _, _, path in roots:
+            LOGGER.info(f"Syncing: {path}")
+        try:
+            self.__walk(walker, folders, paths, known, journal, status, ignoreList)
+        finally:
+            self.__walker = None
+        if self.is_cancelled:
+            raise CloneCancelled()
+
+    def __walk(self, walker, folders, paths, known, journal, status, ignoreList):
+        batches = {}
+        # Source folder id -> names seen in it, to find destination entries missing from the source.
+        seen = {}
+        for kind, src_parent, file in walker.walk(*folders):
+            if self.is_cancelled:
+                # Batches not yet sent are dropped.
+                break
+            dest_parent = folders[src_parent]
+            if self.__delete and kind != FOLDER_DONE:
+                seen.setdefault(src_parent, set()).add(file.get('name'))
+            if kind == FOLDER_DONE:
+                if batches.get(src_parent):
+                    self.__submit_copy(self.__copy_batch_task, batches[src_parent], src_parent, dest_parent, status)
+                batches.pop(src_parent, None)
+                if self.__delete:
+                    self.__remove_extras(dest_parent, seen.pop(src_parent, set()))
+                folders.pop(src_parent)
+                paths.pop(src_parent)
+                self.__dest_index.forget(dest_parent)
+                self.__folder_listed(src_parent)
+            elif kind == FOLDER:
+                if file.get('id') in known:
+                    continue
+                file_path = os.path.join(paths[src_parent], file.get('name'))
+                LOGGER.info(f"Syncing: {file_path}")
+                ignored = str(file.get('id')) in ignoreList
+                current_dir_id = self.check_folder_exists(file.get('name'), dest_parent)
+                created = not current_dir_id
+                if created:
+                    current_dir_id = self.__create_later(file.get('name'), dest_parent,
+                                                         None if ignored else file.get('id'), file_path, src_parent)
+                if not ignored:
+                    self.__map(file.get('id'), current_dir_id, True)
+                    folders[file.get('id')] = current_dir_id
+                    paths[file.get('id')] = file_path
+                    # New folders are journaled once they exist, see __folder_created.
+                    if journal is not None and not created:
+                        journal.add_folder(file.get('id'), current_dir_id, file_path)
+            elif (journal is not None and journal.is_copied(file.get('id'))) or \
+                    not self.__needs_copy(file, dest_parent):
+                status.checkFileExist(True)
+            elif COPY_BATCH_SIZE > 1:
+                status.checkFileExist(False)
+                batch = batches.setdefault(src_parent, [])
+                batch.append(file)
+                if len(batch) == COPY_BATCH_SIZE:
+                    self.__submit_copy(self.__copy_batch_task, batch, src_parent, dest_parent, status)
+                    batches[src_parent] = []
+            else:
+                status.checkFileExist(False)
+                self.__submit_copy(self.__copy_task, file, src_parent, dest_parent, status)
+
+    @staticmethod
+    def isChanged(source, destination):
+        """
+        Compares a source file with its destination copy by checksum when both have one
+        (Google Docs have none), otherwise by size and by the source changing after the copy was made.
+        """
+        if source.get('md5Checksum') and destination.get('md5Checksum'):
+            return source.get('md5Checksum') != destination.get('md5Checksum')
+        if source.get('size') != destination.get('size'):
+            return True
+        if not destination.get('modifiedTime'):
+            # Nothing to compare with, the copy is kept rather than replaced blindly.
+            return False
+        return source.get('modifiedTime', '') > destination.get('modifiedTime')
+
+    def __needs_copy(self, file, dest_parent):
+        existing = self.check_file_exists(file.get('name'), dest_parent, self.__list_fields)
+        if not existing:
+            return True
+        if self.__sync and self.isChanged(file, existing):
+            with self.__lock:
+                self.__replaced[file.get('id')] = existing.get('id')
+            return True
+        self.__map(file.get('id'), existing.get('id'), False)
+        return False
+
+    def __create_later(self, name, dest_parent, src_id, path, src_parent):
+        """
+        Queues a destination folder on the skeleton and returns its reserved id.
+        The folder itself and its source parent only count as done once it has been created.
+        """
+        folder_id = self.__skeleton.reserve()
+        with self.__lock:
+            self.__creating[folder_id] = (src_id, path, src_parent)
+            for folder in (src_id, src_parent):
+                if folder is not None:
+                    self.__folder_state.setdefault(folder, [0, False, False])[0] += 1
+        self.__dest_index.add(dest_parent, {'id': folder_id, 'name': name, 'mimeType': self.__G_DRIVE_DIR_MIME_TYPE})
+        self.__dest_index.add_empty(folder_id)
+        self.__skeleton.create(folder_id, name, dest_parent)
+        return folder_id
+
+    def __folder_created(self, folder_id, created):
+        with self.__lock:
+            src_id, path, src_parent = self.__creating.pop(folder_id)
+        if created and src_id is not None and self.__journal is not None:
+            self.__journal.add_folder(src_id, folder_id, path)
+        for folder in (src_id, src_parent):
+            if folder is not None:
+                self.__copies_finished(folder, 1, not created)
+
+    @drive_retry
+    def __generate_ids(self, count):
+        return self.__service.files().generateIds(count=count, space='drive').execute().get('ids', [])
+
+    def createFolders(self, folders, attempts=15):
+        """
+        Creates (id, name, parent_id) folders with batch requests, like copyFiles does for copies.
+        Creating folders does not use up the copy quota, so rate limited sub-requests are
+        re-sent after a jittered backoff on the same account, as create_directory does.
+        :return: Set of the ids that could not be created
+        """
+        tries = 0
+        failed = set()
+        created = []
+        transient = []
+
+        def callback(request_id, response, exception):
+            folder = pending[int(request_id)]
+            account = getattr(self.__local, 'account', None)
+            account = account.email if account is not None else 'token'
+            # 409: the id is taken, an earlier attempt of this same create went through.
+            if exception is None or (isinstance(exception, HttpError) and exception.resp.status == 409):
+                metrics.record('files.create', 200, account=account)
+                created.append(folder)
+                return
+            if isinstance(exception, HttpError):
+                metrics.record('files.create', exception.resp.status,
+                               error_reason(exception.resp.status, exception.content), account)
+            else:
+                metrics.record('files.create', 0, type(exception).__name__, account)
+            reason = self.getErrorReason(exception) if isinstance(exception, HttpError) else None
+            if reason in RATE_LIMIT_REASONS or reason in TRANSIENT_REASONS or \
+                    (isinstance(exception, HttpError) and exception.resp.status >= 500):
+                transient.append(folder)
+            else:
+                LOGGER.error(f"Failed to create folder {folder[1]}: {exception}")
+                failed.add(folder[0])
+
+        pending = list(folders)
+        while pending and not self.is_cancelled:
+            service = self.__service
+            batch = service.new_batch_http_request(callback=callback)
+            for index, (folder_id, name, parent_id) in enumerate(pending):
+                body = {'id': folder_id, 'name': name, 'mimeType': self.__G_DRIVE_DIR_MIME_TYPE, 'parents': [parent_id]}
+                batch.add(service.files().create(supportsAllDrives=True, body=body), request_id=str(index))
+            self.__execute_batch(batch)
+            if transient:
+                attempts -= 1
+                if attempts <= 0:
+                    failed.update(folder[0] for folder in transient)
+                    transient.clear()
+                else:
+                    tries += 1
+                    self.__cancelled.wait(jittered_backoff(tries))
+            pending, transient = transient, []
+            if pending:
+                metrics.record_retry('createFolders', len(pending))
+        failed.update(folder[0] for folder in pending)
+        if created and not IS_TEAM_DRIVE:
+            self.__share_folders([folder[0] for folder in created])
+        for folder_id, name, _ in created:
+            LOGGER.info("Carpeta creada en Google-Drive:\nNombre: {}\nID: {} ".format(name, folder_id))
+        return failed
+
+    def __share_folders(self, folder_ids):
+        def callback(request_id, response, exception):
+            if exception is not None:
+                LOGGER.error(f"Failed to share folder {folder_ids[int(request_id)]}: {exception}")
+
+        service = self.__service
+        batch = service.new_batch_http_request(callback=callback)
+        for index, folder_id in enumerate(folder_ids):
+            batch.add(service.permissions().create(supportsAllDrives=True, fileId=folder_id, body={
+                'role': 'reader',
+                'type': 'anyone',
+                'value': None,
+                'withLink': True
+            }), request_id=str(index))
+        self.__execute_batch(batch)
+
+    def __map(self, source_id, dest_id, is_folder):
+        if self.__sync_state is not None:
+            self.__sync_state.map(source_id, dest_id, is_folder)
+
+    def __remove_extras(self, dest_folder, source_names):
+        for meta in self.__dest_index.children(dest_folder):
+            if meta.get('name') in source_names:
+                continue
+            LOGGER.info(f"Removing {meta.get('name')}, it is no longer in the source")
+            try:
+                self.trash(meta.get('id'))
+            except Exception as e:
+                self.__log_copy_error(e)
+                continue
+            with self.__lock:
+                self.removed_files += 1
+
+    @drive_retry
+    def trash(self, file_id):
+        return self.__service.files().update(supportsAllDrives=True, fileId=file_id,
+                                             body={'trashed': True}).execute()
+
+    @drive_retry
+    def __start_page_token(self, drive_id, service):
+        kwargs = {'driveId': drive_id} if drive_id else {}
+        return service.changes().getStartPageToken(supportsAllDrives=True, **kwargs) \
+            .execute().get('startPageToken')
+
+    @drive_retry
+    def __list_changes(self, page_token, drive_id, service):
+        kwargs = {'driveId': drive_id} if drive_id else {}
+        return service.changes().list(pageToken=page_token, pageSize=1000, includeRemoved=True,
+                                      supportsAllDrives=True, includeItemsFromAllDrives=True,
+                                      fields=CHANGE_FIELDS, **kwargs).execute()
+
+    @drive_retry
+    def __get_meta(self, file_id, fields):
+        try:
+            return self.__service.files().get(supportsAllDrives=True, fileId=file_id, fields=fields).execute()
+        except HttpError as err:
+            if err.resp.status == 404:
+                return None
+            raise err
+
+    @drive_retry
+    def __move(self, file_id, name, new_parent, old_parents):
+        return self.__service.files().update(supportsAllDrives=True, fileId=file_id, body={'name': name},
+                                             addParents=new_parent,
+                                             removeParents=','.join(p for p in old_parents if p != new_parent)
+                                             ).execute()
+
+    def __changes_service(self, account_path):
+        """
+        :param account_path: Service account a page token was taken with, None for any
+        :return: (service, account path) to follow the changes feed with
+        """
+        if USE_SERVICE_ACCOUNTS and account_path is not None:
+            account = get_pool().find(account_path)
+            if account is not None:
+                return get_pool().service(account), account_path
+            # Any member of the shared drive reads its feed.
+            LOGGER.info(f"Service account {account_path} is gone, following the changes with another one")
+        service = self.__service
+        account = getattr(self.__local, 'account', None)
+        return service, account.path if account is not None else None
+
+    def syncChanges(self, link, status):
+        """
+        Brings the copy of link in this helper's destination up to date.
+        The first sync of a folder is a sync clone that records the source -> destination mapping
+        and a changes page token, later ones only apply what the Drive changes feed reports since then.
+        """
+        try:
+            file_id = self.getIdFromUrl(link)
+        except (KeyError, IndexError):
+            return "No se pudo encontrar el ID de la unidad de Google en el enlace proporcionado"
+        try:
+            meta = self.__service.files().get(supportsAllDrives=True, fileId=file_id,
+                                              fields='id, name, mimeType, driveId').execute()
+        except Exception as e:
+            return f"{str(e).replace('>', '').replace('<', '')}"
+        if meta.get('mimeType') != self.__G_DRIVE_DIR_MIME_TYPE:
+            return self.clone(link, status, sync=True)
+        if USE_SERVICE_ACCOUNTS and not meta.get('driveId'):
+            # Outside a shared drive the changes feed is the account's own, a folder shared
+            # with service accounts by link never shows up in it.
+            LOGGER.info(f"{meta.get('name')} is not in a shared drive, syncing it with a full walk")
+            self.__fresh_listings = True
+            try:
+                # Like the changes feed would, the copies of removed files go to the trash.
+                return self.clone(link, status, sync=True, delete=True)
+            finally:
+                self.__fresh_listings = False
+        state = SyncState(file_id, self.gparentid)
+        try:
+            root = state.lookup(file_id)
+            if state.page_token is None or root is None:
+                # Taken before the walk, so changes made while cloning are picked up by the next sync.
+                service, account = self.__changes_service(None)
+                token = self.__start_page_token(meta.get('driveId'), service)
+                self.__sync_state = state
+                try:
+                    msg = self.clone(link, status, sync=True)
+                finally:
+                    self.__sync_state = None
+                if self.__complete:
+                    state.set_token(token, meta.get('driveId'), account)
+                return msg
+            return self.__apply_changes(meta, root[0], state, status)
+        except Exception as e:
+            if isinstance(e, RetryError):
+                LOGGER.info(f"Intentos totales: {e.last_attempt.attempt_number}")
+                e = e.last_attempt.exception()
+            LOGGER.error(e)
+            return str(e).replace('>', '').replace('<', '')
+        finally:
+            state.close()
+
+    def __apply_changes(self, meta, root_dest, state, status):
+        self.transferred_size = 0
+        self.copied_files = self.updated_files = self.removed_files = 0
+        moved = 0
+        status.SetMainFolder(meta.get('name'), self.__G_DRIVE_DIR_BASE_DOWNLOAD_URL.format(meta.get('id')))
+        status.SetDestinationFolder(meta.get('name'), self.__G_DRIVE_DIR_BASE_DOWNLOAD_URL.format(root_dest))
+        # Only the latest state of every changed item matters.
+        changes = {}
+        page_token, new_token = state.page_token, state.page_token
+        service, account = self.__changes_service(state.account)
+        while page_token:
+            response = self.__list_changes(page_token, state.drive_id, service)
+            for change in response.get('changes', []):
+                changes[change.get('fileId')] = change
+            page_token = response.get('nextPageToken')
+            new_token = response.get('newStartPageToken', new_token)
+        changes.pop(meta.get('id'), None)
+        # The feed covers the whole drive (or user), changes outside the synced tree are skipped below.
+        LOGGER.info(f"Applying {len(changes)} changes to {meta.get('name')}")
+        self.__sync_state = state
+        failed = False
+        try:
+            def parent_dest(file):
+                parents = file.get('parents') or []
+                mapped = state.lookup(parents[0]) if parents else None
+                return mapped[0] if mapped and mapped[1] else None
+
+            live = {file_id: change.get('file') for file_id, change in changes.items()
+                    if not change.get('removed') and change.get('file') and not change['file'].get('trashed')}
+            folders = {i: f for i, f in live.items() if f.get('mimeType') == self.__G_DRIVE_DIR_MIME_TYPE}
+            files = {i: f for i, f in live.items() if i not in folders}
+            new_folders = []
+            # Parents before children: keep going while some folder's parent got a destination.
+            progress = True
+            while folders and progress and not self.is_cancelled:
+                progress = False
+                for file_id, folder in list(folders.items()):
+                    dest_parent = parent_dest(folder)
+                    if dest_parent is None:
+                        continue
+                    progress = True
+                    del folders[file_id]
+                    mapped = state.lookup(file_id)
+                    if mapped:
+                        moved += self.__move_if_needed(folder, mapped[0], dest_parent)
+                        continue
+                    dest_id = self.check_folder_exists(folder.get('name'), dest_parent) or \
+                        self.create_directory(folder.get('name'), dest_parent)
+                    state.map(file_id, dest_id, True)
+                    new_folders.append((file_id, dest_id))
+            # Folders whose parent is not part of the synced tree have been moved out of it.
+            gone = [file_id for file_id, change in changes.items() if file_id not in live] + list(folders)
+            copies = {}
+            for file_id, file in files.items():
+                dest_parent = parent_dest(file)
+                if dest_parent is None:
+                    gone.append(file_id)
+                    continue
+                mapped = state.lookup(file_id)
+                existing = self.__get_meta(mapped[0], 'id, name, parents, size, md5Checksum, modifiedTime') \
+                    if mapped else self.check_file_exists(file.get('name'), dest_parent, SYNC_LIST_FIELDS)
+                if existing and not self.isChanged(file, existing):
+                    state.map(file_id, existing.get('id'), False)
+                    if mapped:
+                        moved += self.__move_if_needed(file, existing.get('id'), dest_parent, existing)
+                    continue
+                if existing:
+                    self.__replaced[file_id] = existing.get('id')
+                copies.setdefault(dest_parent, []).append(file)
+            # Folders that appeared in the tree (new or moved in) bring content that has no changes of its own.
+            while new_folders and not self.is_cancelled:
+                src_folder, dest_folder = new_folders.pop()
+                for child in self.listFolder(src_folder, SYNC_LIST_FIELDS):
+                    if child.get('id') in changes or state.lookup(child.get('id')):
+                        continue
+                    if child.get('mimeType') == self.__G_DRIVE_DIR_MIME_TYPE:
+                        dest_id = self.check_folder_exists(child.get('name'), dest_folder) or \
+                            self.create_directory(child.get('name'), dest_folder)
+                        state.map(child.get('id'), dest_id, True)
+                        new_folders.append((child.get('id'), dest_id))
                     else:
-                        err = e
-                    LOGGER.error(err)
+                        copies.setdefault(dest_folder, []).append(child)
+            batch_size = max(1, COPY_BATCH_SIZE)
+            for dest_parent, pending in copies.items():
+                for i in range(0, len(pending), batch_size):
+                    if self.copyFiles(pending[i:i + batch_size], dest_parent, status):
+                        failed = True
+            for file_id in gone:
+                mapped = state.lookup(file_id)
+                if mapped is None or self.is_cancelled:
+                    continue
+                LOGGER.info(f"Removing {mapped[0]}, {file_id} is no longer in the source")
+                self.trash(mapped[0])
+                state.unmap(file_id)
+                self.removed_files += 1
+        finally:
+            self.__sync_state = None
+        if not failed and not self.is_cancelled:
+            state.set_token(new_token, state.drive_id, account)
+        status.set_status(True)
+        msg = f'<a href="{self.__G_DRIVE_DIR_BASE_DOWNLOAD_URL.format(root_dest)}">{meta.get("name")}</a>' \
+              f' ({get_readable_file_size(self.transferred_size)})\n' \
+              f'{self.copied_files - self.updated_files} nuevos · ' \
+              f'{self.updated_files} actualizados · {moved} movidos · {self.removed_files} eliminados'
+        if self.is_cancelled:
+            msg = '<b>Sincronización cancelada.</b> ' + msg
+        elif failed:
+            msg += '\nAlgunos archivos no se pudieron copiar, envía /sync otra vez para reintentarlo.'
+        return msg
+
+    def __move_if_needed(self, source, dest_id, dest_parent, dest_meta=None):
+        """:return: 1 if the destination item had to be renamed or moved, else 0"""
+        if dest_meta is None:
+            dest_meta = self.__get_meta(dest_id, 'id, name, parents')
+        if dest_meta is None:
+            return 0
+        if dest_meta.get('name') == source.get('name') and dest_parent in (dest_meta.get('parents') or []):
+            return 0
+        self.__move(dest_id, source.get('name'), dest_parent, dest_meta.get('parents') or [])
+        return 1
+
+    def __folder_listed(self, src_folder):
+        with self.__lock:
+            state = self.__folder_state.setdefault(src_folder, [0, False, False])
+            state[1] = True
+        self.__maybe_folder_done(src_folder)
+
+    def __copies_finished(self, src_folder, count, failed):
+        with self.__lock:
+            state = self.__folder_state[src_folder]
+            state[0] -= count
+            state[2] = state[2] or failed
+        self.__maybe_folder_done(src_folder)
+
+    def __maybe_folder_done(self, src_folder):
+        with self.__lock:
+            in_flight, listed, failed = self.__folder_state[src_folder]
+            if not listed or in_flight > 0:
+                return
+            del self.__folder_state[src_folder]
+        if self.__journal is not None and not failed:
+            self.__journal.folder_done(src_folder)
+
+    def __submit_copy(self, task, files, src_folder, *args):
+        with self.__lock:
+            state = self.__folder_state.setdefault(src_folder, [0, False, False])
+            state[0] += len(files) if isinstance(files, list) else 1
+        self.__pending_copies.acquire()
+        try:
+            future = self.__copy_pool.submit(task, files, src_folder, *args)
+        except Exception:
+            self.__pending_copies.release()
+            raise
+        future.add_done_callback(lambda _: self.__pending_copies.release())
+
+    def __record_copy(self, file, parent_id, response, status):
+        with self.__lock:
+            replaced = self.__replaced.pop(file.get('id'), None) if response else None
+        if replaced:
+            try:
+                self.trash(replaced)
+            except Exception as e:
+                self.__log_copy_error(e)
+            with self.__lock:
+                self.updated_files += 1
+        if self.__dest_index is not None and response:
+            self.__dest_index.add(parent_id, dict(file, id=response.get('id')))
+        if self.__journal is not None and response:
+            self.__journal.file_copied(file.get('id'), response.get('id'))
+        if response:
+            self.__map(file.get('id'), response.get('id'), False)
+        size = int(file.get('size', 0))
+        with self.__lock:
+            self.transferred_size += size
+            if response:
+                self.copied_files += 1
+        account = getattr(self.__local, 'account', None)
+        if account is not None:
+            get_pool().record_bytes(account, size)
+        if self.__listener is not None and response:
+            self.__listener.onFileCopied(file, parent_id, response, account)
+        status.set_name(file.get('name'))
+        status.add_size(size)
+
+    def __shard_copied(self, parent_id, status, file, response, account_path):
+        self.__record_copy(file, parent_id, response, status)
+        # The worker's pool counted the bytes, this keeps /stats of the parent right.
+        account = get_pool().find(account_path)
+        if account is not None:
+            get_pool().record_bytes(account, int(file.get('size', 0)))
+
+    def __copy_files(self, files, parent_id, status):
+        """:return: Files that could not be copied, copied here or on a shard worker process"""
+        if self.__shards is not None:
+            return self.__shards.copy(self.__shard_clone_id, files, parent_id, partial(self.__shard_copied, parent_id, status))
+        return self.copyFiles(files, parent_id, status)
+
+    def __copy_task(self, file, src_folder, parent_id, status):
+        failed = True
+        try:
+            if self.is_cancelled:
+                return
+            if self.__skeleton is not None and not self.__skeleton.wait(parent_id):
+                return
+            if self.__shards is not None:
+                failed = len(self.__copy_files([file], parent_id, status)) > 0
+            else:
+                res = self.copyFile(file.get('id'), parent_id, status)
+                self.__record_copy(file, parent_id, res, status)
+                failed = not res
+        except Exception as e:
+            self.__log_copy_error(e)
+        finally:
+            self.__copies_finished(src_folder, 1, failed)
 
-    @retry(wait=wait_exponential(multiplier=2, min=3, max=6), stop=stop_after_attempt(15),
-           retry=retry_if_exception_type(HttpError), before=before_log(LOGGER, logging.DEBUG))
+    def __copy_batch_task(self, files, src_folder, parent_id, status):
+        failed = True
+        try:
+            if self.is_cancelled:
+                return
+            if self.__skeleton is not None and not self.__skeleton.wait(parent_id):
+                return
+            failed = len(self.__copy_files(files, parent_id, status)) > 0
+        except Exception as e:
+            self.__log_copy_error(e)
+        finally:
+            self.__copies_finished(src_folder, len(files), failed)
+
+    @staticmethod
+    def __log_copy_error(e):
+        if isinstance(e, RetryError):
+            LOGGER.info(f"Intentos totales: {e.last_attempt.attempt_number}")
+            err = e.last_attempt.exception()
+        else:
+            err = e
+        LOGGER.error(err)
+
+    @drive_retry
     def create_directory(self, directory_name, parent_id):
         file_metadata = {
             "name": directory_name,
@@ -256,72 +1314,76 @@ class GoogleDriveHelper:
         file_id = file.get("id")
         if not IS_TEAM_DRIVE:
             self.__set_permission(file_id)
+        if self.__dest_index is not None:
+            self.__dest_index.add(parent_id, {'id': file_id, 'name': directory_name,
+                                              'mimeType': self.__G_DRIVE_DIR_MIME_TYPE})
+            self.__dest_index.add_empty(file_id)
         LOGGER.info("Carpeta creada en Google-Drive:\nNombre: {}\nID: {} ".format(file.get("name"), file_id))
         return file_id
 
 
     def authorize(self):
+        if not USE_SERVICE_ACCOUNTS:
+            return get_service('token', self.__load_token)
+        pool = get_pool()
+        account = pool.acquire()
+        LOGGER.info(f"Autorizando con {account} cuenta de servicio")
+        with self.__lock:
+            self.__accounts.append(account)
+        self.__local.account = account
+        return pool.service(account)
+
+    def __load_token(self):
         # Get credentials
         credentials = None
-        if not USE_SERVICE_ACCOUNTS:
-            if os.path.exists(self.__G_DRIVE_TOKEN_FILE):
-                with open(self.__G_DRIVE_TOKEN_FILE, 'rb') as f:
-                    credentials = pickle.load(f)
-            if credentials is None or not credentials.valid:
-                if credentials and credentials.expired and credentials.refresh_token:
-                    credentials.refresh(Request())
-                else:
-                    flow = InstalledAppFlow.from_client_secrets_file(
-                        'credentials.json', self.__OAUTH_SCOPE)
-                    LOGGER.info(flow)
-                    credentials = flow.run_console(port=0)
-
-                # Save the credentials for the next run
-                with open(self.__G_DRIVE_TOKEN_FILE, 'wb') as token:
-                    pickle.dump(credentials, token)
-        else:
-            LOGGER.info(f"Autorizando con {SERVICE_ACCOUNT_INDEX}.json cuenta de servicio")
-            credentials = service_account.Credentials.from_service_account_file(
-                f'cuentas/{SERVICE_ACCOUNT_INDEX}.json',
-                scopes=self.__OAUTH_SCOPE)
-        return build('drive', 'v3', credentials=credentials, cache_discovery=False)
+        if os.path.exists(self.__G_DRIVE_TOKEN_FILE):
+            with open(self.__G_DRIVE_TOKEN_FILE, 'rb') as f:
+                credentials = pickle.load(f)
+        if credentials is None or not credentials.valid:
+            if credentials and credentials.expired and credentials.refresh_token:
+                credentials.refresh(Request())
+            else:
+                flow = InstalledAppFlow.from_client_secrets_file(
+                    'credentials.json', self.__OAUTH_SCOPE)
+                LOGGER.info(flow)
+                credentials = flow.run_console(port=0)
+
+            # Save the credentials for the next run
+            with open(self.__G_DRIVE_TOKEN_FILE, 'wb') as token:
+                pickle.dump(credentials, token)
+        return credentials
 
     
-    @retry(wait=wait_exponential(multiplier=2, min=3, max=6), stop=stop_after_attempt(15),
-           retry=retry_if_exception_type(HttpError), before=before_log(LOGGER, logging.DEBUG))
-    def check_folder_exists(self, fileName, u_parent_id):
-        fileName = clean_name(fileName)
-        # Create Search Query for API request.
-        query = f"'{u_parent_id}' en los padres y (el nombre contiene '{fileName}' y trashed=false)"
-        response = self.__service.files().list(supportsTeamDrives=True,
-                                               includeTeamDriveItems=True,
-                                               q=query,
-                                               spaces='drive',
-                                               pageSize=5,
-                                               fields='files(id, name, mimeType, size)',
-                                               orderBy='modifiedTime desc').execute()
-        for file in response.get('files', []):
-            if file.get('mimeType') == "application/vnd.google-apps.folder":  # Detect Whether Current Entity is a Folder or File.
-                    driveid = file.get('id')
-                    return driveid
-    
-    @retry(wait=wait_exponential(multiplier=2, min=3, max=6), stop=stop_after_attempt(15),
-           retry=retry_if_exception_type(HttpError), before=before_log(LOGGER, logging.DEBUG))
-    def check_file_exists(self, fileName, u_parent_id):
+    @drive_retry
+    def __find_by_name(self, fileName, u_parent_id, fields=LIST_FIELDS):
         fileName = clean_name(fileName)
         # Create Search Query for API request.
-        query = f"'{u_parent_id}' en los padres y (el nombre contiene '{fileName}' y trashed=false)"
+        query = f"'{u_parent_id}' in parents and name = '{fileName}' and trashed = false"
         response = self.__service.files().list(supportsTeamDrives=True,
                                                includeTeamDriveItems=True,
                                                q=query,
                                                spaces='drive',
                                                pageSize=5,
-                                               fields='files(id, name, mimeType, size)',
+                                               fields=f'files({fields})',
                                                orderBy='modifiedTime desc').execute()
-        for file in response.get('files', []):
-            if file.get('mimeType') != "application/vnd.google-apps.folder":
-                    # driveid = file.get('id')
-                    return file
+        return response.get('files', [])
+
+    def check_folder_exists(self, fileName, u_parent_id):
+        # During a folder clone, the destination index answers without an API call.
+        if self.__dest_index is not None:
+            folder = self.__dest_index.find_folder(fileName, u_parent_id)
+            return folder.get('id') if folder else None
+        for file in self.__find_by_name(fileName, u_parent_id):
+            if file.get('mimeType') == self.__G_DRIVE_DIR_MIME_TYPE:  # Detect Whether Current Entity is a Folder or File.
+                return file.get('id')
+
+    def check_file_exists(self, fileName, u_parent_id, fields=LIST_FIELDS):
+        """:param fields: Fields of the file returned, the destination index has its own"""
+        if self.__dest_index is not None:
+            return self.__dest_index.find_file(fileName, u_parent_id)
+        for file in self.__find_by_name(fileName, u_parent_id, fields):
+            if file.get('mimeType') != self.__G_DRIVE_DIR_MIME_TYPE:
+                return file
 
 
 def get_readable_file_size(size_in_bytes) -> str:
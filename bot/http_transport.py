@@ -0,0 +1,70 @@
+import socket
+import time
+
+import httplib2
+import requests
+from google.auth.transport.requests import AuthorizedSession
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from bot.config import DRIVE_CONNECT_TIMEOUT, DRIVE_READ_TIMEOUT, HTTP_POOL_SIZE
+from bot.drive_metrics import metrics, call_name, error_reason, account_name
+from bot.rate_limiter import controller, is_throttled, batch_size, batch_throttled
+
+# One keep-alive connection pool shared by every Drive client in the process,
+# so workers and service account switches reuse TLS connections. Failed connects are
+# retried here like httplib2 did, anything after the request was sent goes to drive_retry.
+_adapter = HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE,
+                       max_retries=Retry(total=2, connect=2, read=0, status=0, redirect=0, raise_on_status=False))
+
+
+class PooledHttp:
+    """
+    Drop-in replacement for httplib2.Http for googleapiclient, sending requests
+    through the shared requests connection pool with per-request timeouts.
+    One instance belongs to one Drive service, the pool underneath is thread-safe.
+    """
+
+    def __init__(self, credentials, timeout=(DRIVE_CONNECT_TIMEOUT, DRIVE_READ_TIMEOUT)):
+        # googleapiclient reads this attribute to authorize batch requests.
+        self.credentials = credentials
+        self.timeout = timeout
+        self.__session = AuthorizedSession(credentials)
+        self.__session.mount('https://', _adapter)
+        self.__session.mount('http://', _adapter)
+
+    def request(self, uri, method='GET', body=None, headers=None, redirections=5, connection_type=None):
+        if isinstance(body, str):
+            # Batch bodies are built as text, httplib2 sends them as UTF-8 too.
+            body = body.encode('utf-8')
+        call = call_name(method, uri)
+        account = account_name(self.credentials)
+        limiter = controller.limiter(account)
+        cost = batch_size(body) if call == 'batch' else 1
+        limiter.acquire(cost)
+        # Stays None when Drive did not answer at all, which says nothing about the rate.
+        throttled = None
+        start = time.perf_counter()
+        try:
+            response = self.__session.request(method, uri, data=body, headers=headers,
+                                              timeout=self.timeout, allow_redirects=redirections > 0)
+            reason = error_reason(response.status_code, response.content)
+            throttled = is_throttled(response.status_code, reason) or \
+                (call == 'batch' and response.status_code == 200 and batch_throttled(response.content))
+        except requests.exceptions.Timeout as e:
+            metrics.record(call, 0, 'timeout', account, time.perf_counter() - start)
+            # googleapiclient only knows httplib2's exceptions.
+            raise socket.timeout(str(e))
+        except requests.exceptions.ConnectionError as e:
+            metrics.record(call, 0, 'connectionError', account, time.perf_counter() - start)
+            raise ConnectionError(str(e))
+        finally:
+            limiter.release(throttled, cost)
+        metrics.record(call, response.status_code, reason, account, time.perf_counter() - start)
+        info = {key.lower(): value for key, value in response.headers.items()}
+        # requests already decoded the body.
+        info.pop('content-encoding', None)
+        info['status'] = str(response.status_code)
+        resp = httplib2.Response(info)
+        resp.reason = response.reason
+        return resp, response.content
@@ -0,0 +1,240 @@
+import json
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+
+from bot import LOGGER
+from bot.config import JOB_QUEUE
+from bot.job_scheduler import QUEUED, RUNNING, DONE, CANCELLED
+
+# A job whose worker vanished this many times is given up on.
+MAX_ATTEMPTS = 3
+
+
+class JobQueue(ABC):
+    """
+    Clone jobs shared by frontends and workers, see BOT_MODE.
+
+    Jobs are plain dicts (see CloneJob.to_record). A worker claims a job with a lease it
+    keeps renewing with heartbeat(), which also stores the job's progress and tells the
+    worker whether to go on. A job whose lease runs out goes back to the next worker that
+    claims one. Backends register in BACKENDS under the scheme of their JOB_QUEUE url.
+    """
+
+    @abstractmethod
+    def submit(self, record):
+        """:return: Id of the new job"""
+
+    @abstractmethod
+    def claim(self, worker, lease):
+        """:return: The queued (or abandoned) job now leased to worker, or None"""
+
+    @abstractmethod
+    def heartbeat(self, job_id, worker, lease, progress=None):
+        """:return: Whether worker should keep running the job: False once it is cancelled or taken over"""
+
+    @abstractmethod
+    def finish(self, job_id, worker, result):
+        """Ends a job worker ran, storing the result message sent to Telegram."""
+
+    @abstractmethod
+    def cancel(self, job_id):
+        """Cancels a queued job, or asks the worker of a running one to stop at its next heartbeat."""
+
+    @abstractmethod
+    def get(self, job_id):
+        """:return: The job job_id, or None"""
+
+    @abstractmethod
+    def active(self):
+        """:return: Running jobs followed by queued jobs in the order they will start"""
+
+    @abstractmethod
+    def position(self, job_id):
+        """:return: Number of queued jobs that start before job_id"""
+
+    @abstractmethod
+    def user_jobs(self, user_id):
+        """:return: Number of queued or running jobs of user_id"""
+
+    @abstractmethod
+    def unnotified(self):
+        """:return: Finished jobs whose result has not been sent to Telegram yet"""
+
+    @abstractmethod
+    def mark_notified(self, job_id):
+        """:return: Whether the caller is the one to send the result, only one frontend gets True"""
+
+
+class SQLiteJobQueue(JobQueue):
+    """JobQueue in a SQLite file, shared by the processes of one machine or of a shared filesystem."""
+
+    COLUMNS = ('id', 'user_id', 'chat_id', 'message_id', 'links', 'destinations', 'ignore_list', 'priority',
+               'sync', 'remove', 'changes', 'count', 'state', 'worker', 'lease_until', 'attempts', 'cancel_requested',
+               'progress', 'result', 'notified', 'created', 'updated')
+    JSON_COLUMNS = ('links', 'destinations', 'ignore_list', 'progress')
+
+    def __init__(self, path):
+        self.__lock = threading.Lock()
+        self.__db = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.__db.execute("PRAGMA journal_mode=WAL")
+        self.__db.executescript("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                chat_id INTEGER,
+                message_id INTEGER,
+                links TEXT NOT NULL,
+                destinations TEXT NOT NULL,
+                ignore_list TEXT NOT NULL,
+                priority INTEGER NOT NULL,
+                sync INTEGER NOT NULL,
+                remove INTEGER NOT NULL,
+                changes INTEGER NOT NULL,
+                count INTEGER NOT NULL DEFAULT 0,
+                state TEXT NOT NULL,
+                worker TEXT,
+                lease_until REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                cancel_requested INTEGER NOT NULL DEFAULT 0,
+                progress TEXT,
+                result TEXT,
+                notified INTEGER NOT NULL DEFAULT 0,
+                created REAL NOT NULL,
+                updated REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, priority, id);
+        """)
+        # Queues created before /count jobs lack the column.
+        if 'count' not in {row[1] for row in self.__db.execute("PRAGMA table_info(jobs)")}:
+            self.__db.execute("ALTER TABLE jobs ADD COLUMN count INTEGER NOT NULL DEFAULT 0")
+        LOGGER.info(f"Using job queue {path}")
+
+    def __record(self, row):
+        if row is None:
+            return None
+        record = dict(zip(self.COLUMNS, row))
+        for column in self.JSON_COLUMNS:
+            if record[column] is not None:
+                record[column] = json.loads(record[column])
+        return record
+
+    def __query(self, sql, params=()):
+        with self.__lock:
+            return self.__db.execute(sql, params).fetchall()
+
+    def __select(self, where, params=()):
+        return [self.__record(row) for row in
+                self.__query(f"SELECT {', '.join(self.COLUMNS)} FROM jobs WHERE {where}", params)]
+
+    def __write(self, sql, params=()):
+        """:return: Number of rows changed"""
+        with self.__lock:
+            return self.__db.execute(sql, params).rowcount
+
+    def submit(self, record):
+        now = time.time()
+        with self.__lock:
+            cursor = self.__db.execute(
+                "INSERT INTO jobs (user_id, chat_id, message_id, links, destinations, ignore_list, priority, sync, "
+                "remove, changes, count, state, created, updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (record['user_id'], record.get('chat_id'), record.get('message_id'), json.dumps(record['links']),
+                 json.dumps(record['destinations']), json.dumps(record['ignore_list']), record['priority'],
+                 int(record['sync']), int(record['remove']), int(record['changes']),
+                 int(record['count']), QUEUED, now, now))
+            return cursor.lastrowid
+
+    def claim(self, worker, lease):
+        now = time.time()
+        with self.__lock:
+            # IMMEDIATE takes the write lock up front, so two workers can not claim the same job.
+            self.__db.execute("BEGIN IMMEDIATE")
+            try:
+                # Abandoned jobs that were cancelled, or that every worker so far died on, end here.
+                self.__db.execute("UPDATE jobs SET state = ?, updated = ? WHERE state = ? AND lease_until < ? "
+                                  "AND cancel_requested = 1", (CANCELLED, now, RUNNING, now))
+                self.__db.execute("UPDATE jobs SET state = ?, result = ?, updated = ? WHERE state = ? "
+                                  "AND lease_until < ? AND attempts >= ?",
+                                  (DONE, f"El trabajo se abandonó tras {MAX_ATTEMPTS} intentos.", now, RUNNING,
+                                   now, MAX_ATTEMPTS))
+                row = self.__db.execute(
+                    f"SELECT {', '.join(self.COLUMNS)} FROM jobs WHERE (state = ? AND cancel_requested = 0) "
+                    f"OR (state = ? AND lease_until < ?) ORDER BY priority, id LIMIT 1",
+                    (QUEUED, RUNNING, now)).fetchone()
+                if row is not None:
+                    self.__db.execute("UPDATE jobs SET state = ?, worker = ?, lease_until = ?, "
+                                      "attempts = attempts + 1, updated = ? WHERE id = ?",
+                                      (RUNNING, worker, now + lease, now, row[0]))
+                self.__db.execute("COMMIT")
+            except Exception:
+                self.__db.execute("ROLLBACK")
+                raise
+        record = self.__record(row)
+        if record is None:
+            return None
+        if record['state'] == RUNNING:
+            LOGGER.info(f"Taking over clone job {record['id']} from {record['worker']}")
+        record.update(state=RUNNING, worker=worker, lease_until=now + lease, attempts=record['attempts'] + 1)
+        return record
+
+    def heartbeat(self, job_id, worker, lease, progress=None):
+        now = time.time()
+        changed = self.__write("UPDATE jobs SET lease_until = ?, progress = COALESCE(?, progress), updated = ? "
+                               "WHERE id = ? AND worker = ? AND state = ? AND cancel_requested = 0",
+                               (now + lease, json.dumps(progress) if progress is not None else None, now,
+                                job_id, worker, RUNNING))
+        return changed == 1
+
+    def finish(self, job_id, worker, result):
+        self.__write("UPDATE jobs SET state = CASE cancel_requested WHEN 1 THEN ? ELSE ? END, result = ?, "
+                     "lease_until = NULL, updated = ? WHERE id = ? AND worker = ? AND state = ?",
+                     (CANCELLED, DONE, result, time.time(), job_id, worker, RUNNING))
+
+    def cancel(self, job_id):
+        now = time.time()
+        # A queued job never reaches a worker, its cancellation is already answered by /cancel.
+        self.__write("UPDATE jobs SET state = ?, cancel_requested = 1, notified = 1, updated = ? "
+                     "WHERE id = ? AND state = ?", (CANCELLED, now, job_id, QUEUED))
+        self.__write("UPDATE jobs SET cancel_requested = 1, updated = ? WHERE id = ? AND state = ?",
+                     (now, job_id, RUNNING))
+
+    def get(self, job_id):
+        records = self.__select("id = ?", (job_id,))
+        return records[0] if records else None
+
+    def active(self):
+        running = self.__select("state = ? ORDER BY id", (RUNNING,))
+        queued = self.__select("state = ? AND cancel_requested = 0 ORDER BY priority, id", (QUEUED,))
+        return running + queued
+
+    def position(self, job_id):
+        record = self.get(job_id)
+        if record is None or record['state'] != QUEUED:
+            return 0
+        return self.__query("SELECT COUNT(*) FROM jobs WHERE state = ? AND (priority < ? OR (priority = ? AND id < ?))",
+                            (QUEUED, record['priority'], record['priority'], job_id))[0][0]
+
+    def user_jobs(self, user_id):
+        return self.__query("SELECT COUNT(*) FROM jobs WHERE user_id = ? AND state IN (?, ?)",
+                            (user_id, QUEUED, RUNNING))[0][0]
+
+    def unnotified(self):
+        return self.__select("state IN (?, ?) AND notified = 0 ORDER BY id", (DONE, CANCELLED))
+
+    def mark_notified(self, job_id):
+        return self.__write("UPDATE jobs SET notified = 1 WHERE id = ? AND notified = 0", (job_id,)) == 1
+
+
+BACKENDS = {
+    'sqlite': SQLiteJobQueue,
+}
+
+
+def open_job_queue(url=JOB_QUEUE):
+    """:return: The JobQueue of a url like sqlite:jobs.db"""
+    scheme, _, location = url.partition(':')
+    backend = BACKENDS.get(scheme)
+    if backend is None:
+        raise ValueError(f"Unknown job queue backend: {scheme}")
+    return backend(location)
@@ -0,0 +1,268 @@
+import heapq
+import itertools
+import threading
+import time
+
+from bot import LOGGER
+from bot.clone_status import CloneStatus, CountStatus
+
+QUEUED = 'En cola'
+RUNNING = 'Clonando'
+DONE = 'Terminado'
+CANCELLED = 'Cancelado'
+
+
+class QueueLimitReached(Exception):
+    pass
+
+
+class CloneJob:
+    def __init__(self, user_id, chat_id, update, links, destinations, ignoreList, priority=1, sync=False, delete=False,
+                 changes=False, count=False):
+        self.id = None
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.update = update
+        # Where results go when the job finishes on another node than the one that queued it.
+        self.message_id = update.message.message_id if update is not None else None
+        self.links = links
+        # How the job is shown in messages and logs.
+        self.link = links[0] if len(links) == 1 else f'{len(links)} enlaces'
+        # Several destinations are cloned from a single walk of the source.
+        self.destinations = destinations
+        self.ignoreList = ignoreList
+        self.priority = priority
+        self.sync = sync
+        self.delete = delete
+        # Apply the Drive changes feed to an earlier /sync copy instead of walking the source.
+        self.changes = changes
+        # Only count the files, folders and size of the link, see /count.
+        self.count = count
+        self.created = time.time()
+        self.state = QUEUED
+        # Set by the runner while the clone is in progress.
+        self.helper = None
+        self.status = None
+        # Status message of the job while it runs.
+        self.message = None
+
+    def new_status(self):
+        return CountStatus() if self.count else CloneStatus()
+
+    def cancel(self):
+        self.state = CANCELLED
+        if self.helper is not None:
+            self.helper.cancel()
+
+    def to_record(self):
+        """:return: The job as stored in a JobQueue"""
+        return {'id': self.id, 'user_id': self.user_id, 'chat_id': self.chat_id, 'message_id': self.message_id,
+                'links': self.links, 'destinations': self.destinations, 'ignore_list': self.ignoreList,
+                'priority': self.priority, 'sync': self.sync, 'remove': self.delete, 'changes': self.changes,
+                'count': self.count}
+
+    @classmethod
+    def from_record(cls, record):
+        job = cls(record['user_id'], record['chat_id'], None, record['links'], record['destinations'],
+                  record['ignore_list'], priority=record['priority'], sync=bool(record['sync']),
+                  delete=bool(record['remove']), changes=bool(record['changes']),
+                  count=bool(record.get('count')))
+        job.id = record['id']
+        job.message_id = record['message_id']
+        job.state = record.get('state', QUEUED)
+        if record.get('progress'):
+            job.status = job.new_status()
+            job.status.load(record['progress'])
+        return job
+
+
+class CloneScheduler:
+    """
+    Runs clone jobs on a fixed number of worker threads, separate from the Telegram dispatcher.
+    Jobs wait in a priority queue (lower priority value first, FIFO within a priority)
+    and every user can only have a limited number of queued or running jobs.
+    """
+
+    def __init__(self, runner, workers=4, per_user=2):
+        self.__runner = runner
+        self.__per_user = per_user
+        self.__queue = []
+        self.__running = {}
+        self.__ids = itertools.count(1)
+        self.__order = itertools.count()
+        self.__cond = threading.Condition()
+        self.__workers = max(1, workers)
+        for i in range(self.__workers):
+            threading.Thread(target=self.__work, name=f'clone-worker-{i}', daemon=True).start()
+
+    def __user_jobs(self, user_id):
+        queued = sum(1 for _, _, job in self.__queue if job.user_id == user_id)
+        running = sum(1 for job in self.__running.values() if job.user_id == user_id)
+        return queued + running
+
+    def submit(self, job, limited=True):
+        """:return: Position of the job in the queue, 0 if a worker picks it up right away"""
+        with self.__cond:
+            if limited and self.__user_jobs(job.user_id) >= self.__per_user:
+                raise QueueLimitReached(f"Ya tienes {self.__per_user} clonaciones en curso o en cola.")
+            job.id = next(self.__ids)
+            heapq.heappush(self.__queue, (job.priority, next(self.__order), job))
+            position = self.__position(job)
+            self.__cond.notify()
+        LOGGER.info(f"Queued clone job {job.id} of {job.user_id}: {job.link}")
+        return position
+
+    def __position(self, job):
+        key = next((entry[:2] for entry in self.__queue if entry[2] is job), None)
+        if key is None:
+            return 0
+        ahead = sum(1 for entry in self.__queue if entry[:2] <= key)
+        idle = self.__workers - len(self.__running)
+        return max(0, ahead - idle)
+
+    def position(self, job):
+        with self.__cond:
+            return self.__position(job)
+
+    def __work(self):
+        while True:
+            with self.__cond:
+                while not self.__queue:
+                    self.__cond.wait()
+                _, _, job = heapq.heappop(self.__queue)
+                if job.state == CANCELLED:
+                    continue
+                job.state = RUNNING
+                self.__running[job.id] = job
+            try:
+                self.__runner(job)
+            except Exception as e:
+                LOGGER.exception(f"Clone job {job.id} failed: {e}")
+            finally:
+                with self.__cond:
+                    self.__running.pop(job.id, None)
+                if job.state != CANCELLED:
+                    job.state = DONE
+
+    def cancel(self, job_id, user_id=None):
+        """
+        Cancels a queued or running job. With user_id, only that user's jobs can be cancelled.
+        :return: The cancelled job, or None if there is no such job
+        """
+        with self.__cond:
+            job = self.__running.get(job_id)
+            if job is None:
+                job = next((j for _, _, j in self.__queue if j.id == job_id), None)
+            if job is None or (user_id is not None and job.user_id != user_id):
+                return None
+            if job.state == QUEUED:
+                self.__queue = [entry for entry in self.__queue if entry[2] is not job]
+                heapq.heapify(self.__queue)
+        job.cancel()
+        LOGGER.info(f"Cancelled clone job {job.id}")
+        return job
+
+    def jobs(self):
+        """:return: Running jobs followed by queued jobs in the order they will start"""
+        with self.__cond:
+            running = sorted(self.__running.values(), key=lambda j: j.id)
+            queued = [job for _, _, job in sorted(self.__queue)]
+        return running + queued
+
+
+class RemoteScheduler:
+    """
+    CloneScheduler of a frontend (BOT_MODE=frontend): jobs go to a shared JobQueue and
+    headless workers run them.
+
+    A poller thread follows the queue. Jobs queued here get on_start(job) once a worker
+    claims them and their status follows the progress the worker reports. Every finished
+    job gets on_finish(job, result) on exactly one frontend, also jobs queued before a restart.
+    """
+
+    def __init__(self, queue, on_start, on_finish, per_user=2, poll=2):
+        self.__queue = queue
+        self.__on_start = on_start
+        self.__on_finish = on_finish
+        self.__per_user = per_user
+        self.__poll = poll
+        # Jobs queued by this frontend that are not finished yet.
+        self.__jobs = {}
+        self.__lock = threading.Lock()
+        threading.Thread(target=self.__run, name='remote-scheduler', daemon=True).start()
+
+    def submit(self, job, limited=True):
+        """:return: Number of queued jobs that start before this one"""
+        if limited and self.__queue.user_jobs(job.user_id) >= self.__per_user:
+            raise QueueLimitReached(f"Ya tienes {self.__per_user} clonaciones en curso o en cola.")
+        job.id = self.__queue.submit(job.to_record())
+        with self.__lock:
+            self.__jobs[job.id] = job
+        LOGGER.info(f"Queued clone job {job.id} of {job.user_id} for the workers: {job.link}")
+        return self.__queue.position(job.id)
+
+    def position(self, job):
+        return self.__queue.position(job.id)
+
+    def jobs(self):
+        with self.__lock:
+            local = dict(self.__jobs)
+        jobs = []
+        for record in self.__queue.active():
+            job = local.get(record['id'])
+            if job is None:
+                job = CloneJob.from_record(record)
+            jobs.append(job)
+        return jobs
+
+    def cancel(self, job_id, user_id=None):
+        record = self.__queue.get(job_id)
+        if record is None or record['state'] not in (QUEUED, RUNNING) or \
+                (user_id is not None and record['user_id'] != user_id):
+            return None
+        self.__queue.cancel(job_id)
+        with self.__lock:
+            job = self.__jobs.get(job_id)
+            if job is not None and job.state == QUEUED:
+                # Its worker never starts it, so nothing is left to report.
+                self.__jobs.pop(job_id)
+        if job is None:
+            job = CloneJob.from_record(record)
+        job.state = CANCELLED
+        LOGGER.info(f"Cancelled clone job {job_id}")
+        return job
+
+    def __run(self):
+        while True:
+            try:
+                self.__follow()
+            except Exception as e:
+                LOGGER.exception(f"Failed to poll the job queue: {e}")
+            time.sleep(self.__poll)
+
+    def __follow(self):
+        with self.__lock:
+            jobs = list(self.__jobs.values())
+        for job in jobs:
+            record = self.__queue.get(job.id)
+            if record is None or record['state'] != RUNNING:
+                continue
+            if job.status is None:
+                job.status = job.new_status()
+                job.state = RUNNING
+                self.__on_start(job)
+            if record['progress']:
+                job.status.load(record['progress'])
+        for record in self.__queue.unnotified():
+            if not self.__queue.mark_notified(record['id']):
+                # Another frontend sends this one.
+                continue
+            with self.__lock:
+                job = self.__jobs.pop(record['id'], None)
+            if job is None:
+                job = CloneJob.from_record(record)
+            job.state = record['state']
+            try:
+                self.__on_finish(job, record['result'])
+            except Exception as e:
+                LOGGER.exception(f"Failed to report clone job {job.id}: {e}")
@@ -0,0 +1,187 @@
+import atexit
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from bot import LOGGER
+from bot.config import LISTING_CACHE_TTL, LISTING_CACHE_MAX_ITEMS, LISTING_CACHE_FILE
+
+# Expired entries are swept after this many writes.
+PURGE_EVERY = 1000
+
+
+def field_set(fields):
+    return frozenset(field.strip() for field in fields.split(','))
+
+
+class ListingCache:
+    """
+    Children of source folders, and the totals /count found below them, kept for `ttl` seconds.
+
+    A listing made with some fields can serve any later request for a subset of them,
+    e.g. one listed by /count (with checksums) also serves a plain /clone. At most
+    `max_items` children are kept in memory, the least recently used folders go first.
+    With `path`, entries are also written to SQLite and survive restarts.
+    """
+
+    def __init__(self, ttl=LISTING_CACHE_TTL, max_items=LISTING_CACHE_MAX_ITEMS, path=LISTING_CACHE_FILE,
+                 commit_every=100, commit_interval=5):
+        self.ttl = ttl
+        self.max_items = max_items
+        self.__lock = threading.Lock()
+        # folder id -> (expires, fields, children), least recently used first
+        self.__listings = OrderedDict()
+        self.__items = 0
+        # folder id -> (expires, (files, folders, bytes))
+        self.__totals = {}
+        self.__writes = 0
+        self.hits = 0
+        self.misses = 0
+        self.__db = None
+        self.__commit_every = commit_every
+        self.__commit_interval = commit_interval
+        self.__dirty = 0
+        self.__last_commit = time.time()
+        if path and self.enabled:
+            self.__open(path)
+
+    def __open(self, path):
+        self.__db = sqlite3.connect(path, check_same_thread=False)
+        self.__db.executescript("""
+            CREATE TABLE IF NOT EXISTS listings (
+                folder_id TEXT PRIMARY KEY,
+                expires REAL NOT NULL,
+                fields TEXT NOT NULL,
+                children TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS totals (
+                folder_id TEXT PRIMARY KEY,
+                expires REAL NOT NULL,
+                files INTEGER NOT NULL,
+                folders INTEGER NOT NULL,
+                bytes INTEGER NOT NULL
+            );
+        """)
+        now = time.time()
+        self.__db.execute("DELETE FROM listings WHERE expires < ?", (now,))
+        self.__db.execute("DELETE FROM totals WHERE expires < ?", (now,))
+        self.__db.commit()
+        count = self.__db.execute("SELECT COUNT(*) FROM listings").fetchone()[0]
+        LOGGER.info(f"Listing cache {path} holds {count} folders")
+
+    @property
+    def enabled(self):
+        return self.ttl > 0
+
+    def get(self, folder_id, fields):
+        """:return: The cached children of folder_id listed with at least `fields`, or None"""
+        if not self.enabled:
+            return None
+        wanted = field_set(fields)
+        now = time.time()
+        with self.__lock:
+            entry = self.__listings.get(folder_id)
+            if entry is not None:
+                self.__listings.move_to_end(folder_id)
+            elif self.__db is not None:
+                entry = self.__load(folder_id)
+            if entry is None or entry[0] < now or not wanted <= entry[1]:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[2]
+
+    def __load(self, folder_id):
+        row = self.__db.execute("SELECT expires, fields, children FROM listings WHERE folder_id = ?",
+                                (folder_id,)).fetchone()
+        if row is None:
+            return None
+        entry = (row[0], field_set(row[1]), json.loads(row[2]))
+        self.__remember(folder_id, entry)
+        return entry
+
+    def __remember(self, folder_id, entry):
+        old = self.__listings.pop(folder_id, None)
+        if old is not None:
+            self.__items -= len(old[2])
+        self.__listings[folder_id] = entry
+        self.__items += len(entry[2])
+        while self.__items > self.max_items and len(self.__listings) > 1:
+            _, evicted = self.__listings.popitem(last=False)
+            self.__items -= len(evicted[2])
+
+    def put(self, folder_id, fields, children):
+        if not self.enabled:
+            return
+        entry = (time.time() + self.ttl, field_set(fields), list(children))
+        with self.__lock:
+            self.__remember(folder_id, entry)
+            if self.__db is not None:
+                self.__write("INSERT OR REPLACE INTO listings (folder_id, expires, fields, children) VALUES (?, ?, ?, ?)",
+                             (folder_id, entry[0], fields, json.dumps(entry[2], separators=(',', ':'))))
+            self.__wrote()
+
+    def totals(self, folder_id):
+        """:return: (files, folders, bytes) below folder_id from a recent /count, or None"""
+        if not self.enabled:
+            return None
+        with self.__lock:
+            entry = self.__totals.get(folder_id)
+            if entry is None and self.__db is not None:
+                row = self.__db.execute("SELECT expires, files, folders, bytes FROM totals WHERE folder_id = ?",
+                                        (folder_id,)).fetchone()
+                if row is not None:
+                    entry = self.__totals[folder_id] = (row[0], tuple(row[1:]))
+        if entry is None or entry[0] < time.time():
+            return None
+        return entry[1]
+
+    def put_totals(self, folder_id, totals):
+        if not self.enabled:
+            return
+        entry = (time.time() + self.ttl, tuple(totals))
+        with self.__lock:
+            self.__totals[folder_id] = entry
+            if self.__db is not None:
+                self.__write("INSERT OR REPLACE INTO totals (folder_id, expires, files, folders, bytes) "
+                             "VALUES (?, ?, ?, ?, ?)", (folder_id, entry[0]) + entry[1])
+            self.__wrote()
+
+    def __write(self, sql, params):
+        self.__db.execute(sql, params)
+        self.__dirty += 1
+        if self.__dirty >= self.__commit_every or time.time() - self.__last_commit >= self.__commit_interval:
+            self.__db.commit()
+            self.__dirty = 0
+            self.__last_commit = time.time()
+
+    def __wrote(self):
+        self.__writes += 1
+        if self.__writes % PURGE_EVERY:
+            return
+        now = time.time()
+        for key in [key for key, entry in self.__listings.items() if entry[0] < now]:
+            self.__items -= len(self.__listings.pop(key)[2])
+        for key in [key for key, entry in self.__totals.items() if entry[0] < now]:
+            del self.__totals[key]
+        if self.__db is not None:
+            self.__write("DELETE FROM listings WHERE expires < ?", (now,))
+            self.__write("DELETE FROM totals WHERE expires < ?", (now,))
+
+    def stats(self):
+        """:return: (folders in memory, children in memory, hits, misses)"""
+        with self.__lock:
+            return len(self.__listings), self.__items, self.hits, self.misses
+
+    def close(self):
+        with self.__lock:
+            if self.__db is not None:
+                self.__db.commit()
+                self.__db.close()
+                self.__db = None
+
+
+listing_cache = ListingCache()
+atexit.register(listing_cache.close)
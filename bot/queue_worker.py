@@ -0,0 +1,88 @@
+import os
+import socket
+import threading
+import time
+
+from bot import LOGGER
+from bot.config import WORKER_NAME, JOB_LEASE_SECONDS, MAX_CONCURRENT_CLONES, STATUS_UPDATE_INTERVAL
+from bot.job_scheduler import CloneJob, RUNNING
+
+
+class QueueWorker:
+    """
+    Headless node of a split deployment (BOT_MODE=worker): claims clone jobs from the
+    shared JobQueue and runs them with runner(job), up to `slots` at a time.
+
+    A heartbeat thread renews the lease of every running job at least three times per lease,
+    and as often as status messages are edited, storing its progress for the frontend. A job
+    cancelled from Telegram, or taken over after this worker missed its heartbeats, is
+    cancelled here. A worker that dies simply
+    stops heartbeating: the next worker takes the job over once the lease runs out and the
+    clone skips what is already in the destination.
+    """
+
+    def __init__(self, queue, runner, name=WORKER_NAME, slots=MAX_CONCURRENT_CLONES, lease=JOB_LEASE_SECONDS,
+                 poll=2):
+        self.__queue = queue
+        self.__runner = runner
+        self.name = name or f'{socket.gethostname()}:{os.getpid()}'
+        self.__slots = max(1, slots)
+        self.__lease = lease
+        self.__poll = poll
+        self.__running = {}
+        self.__lock = threading.Lock()
+
+    def run(self):
+        """Works the queue until the process exits."""
+        LOGGER.info(f"Worker {self.name} is taking up to {self.__slots} clone jobs")
+        threads = [threading.Thread(target=self.__work, name=f'queue-worker-{i}', daemon=True)
+                   for i in range(self.__slots)]
+        threads.append(threading.Thread(target=self.__heartbeat, name='queue-heartbeat', daemon=True))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def __work(self):
+        while True:
+            try:
+                record = self.__queue.claim(self.name, self.__lease)
+            except Exception as e:
+                LOGGER.error(f"Failed to claim a clone job: {e}")
+                record = None
+            if record is None:
+                time.sleep(self.__poll)
+                continue
+            job = CloneJob.from_record(record)
+            job.status = None
+            job.state = RUNNING
+            with self.__lock:
+                self.__running[job.id] = job
+            LOGGER.info(f"Running clone job {job.id} of {job.user_id}: {job.link}")
+            result = None
+            try:
+                result = self.__runner(job)
+            except Exception as e:
+                LOGGER.exception(f"Clone job {job.id} failed: {e}")
+                result = str(e).replace('>', '').replace('<', '')
+            finally:
+                with self.__lock:
+                    self.__running.pop(job.id, None)
+                self.__queue.finish(job.id, self.name, result)
+
+    def __heartbeat(self):
+        while True:
+            time.sleep(min(self.__lease / 3, STATUS_UPDATE_INTERVAL))
+            with self.__lock:
+                jobs = list(self.__running.values())
+            for job in jobs:
+                progress = job.status.to_dict() if job.status is not None else None
+                try:
+                    alive = self.__queue.heartbeat(job.id, self.name, self.__lease, progress)
+                except Exception as e:
+                    # The lease still runs, the next heartbeat may get through.
+                    LOGGER.error(f"Heartbeat of clone job {job.id} failed: {e}")
+                    continue
+                if not alive:
+                    LOGGER.info(f"Clone job {job.id} was cancelled or taken over, stopping it")
+                    job.cancel()
@@ -0,0 +1,157 @@
+import asyncio
+import random
+import re
+import threading
+import time
+
+from bot.config import DRIVE_REQUESTS_PER_SECOND, DRIVE_MAX_REQUESTS_PER_SECOND, HTTP_POOL_SIZE
+
+# Drive answers these when requests come in faster than the quota allows.
+THROTTLE_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded')
+_THROTTLED_PART = re.compile(rb'"reason"\s*:\s*"(?:rateLimitExceeded|userRateLimitExceeded)"|HTTP/1\.1 429')
+_BATCH_PART = re.compile(rb'^Content-Type: application/http', re.MULTILINE)
+# Seconds of full-jitter backoff after the first throttled response, doubled on every further one.
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 32
+# Throttled responses closer together than this are taken as one signal, so the
+# requests that were already in flight do not cut the rate several times over.
+DECREASE_HOLD = 1
+# Requests per second added to the rate for every second worth of successful requests.
+RATE_STEP = 5
+
+
+def is_throttled(status, reason):
+    return status == 429 or (status == 403 and reason in THROTTLE_REASONS)
+
+
+def jittered_backoff(attempt, cap=BACKOFF_MAX):
+    """:return: Seconds to wait before retry number `attempt` (from 1), with full jitter"""
+    return random.uniform(0, min(cap, BACKOFF_BASE * 2 ** attempt))
+
+
+def batch_size(body):
+    """:return: Number of sub-requests in a batch request body"""
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    return max(1, len(_BATCH_PART.findall(body or b'')))
+
+
+def batch_throttled(content):
+    """:return: Whether any sub-response of a batch response was throttled"""
+    return _THROTTLED_PART.search(content or b'') is not None
+
+
+class AccountLimiter:
+    """
+    Token bucket plus AIMD concurrency limit for the Drive requests of one account.
+
+    Every request takes a token per API call it carries (sub-requests of a batch count
+    on their own) and a concurrency slot. Successful requests grow the rate and the
+    limit additively, a throttled one halves both and holds new requests back for a
+    jittered, exponentially growing backoff.
+    """
+
+    def __init__(self, rate=DRIVE_REQUESTS_PER_SECOND, max_rate=DRIVE_MAX_REQUESTS_PER_SECOND,
+                 concurrency=8, max_concurrency=HTTP_POOL_SIZE, min_rate=1):
+        self.rate = float(rate)
+        self.max_rate = float(max(rate, max_rate))
+        self.min_rate = float(min(min_rate, rate))
+        self.limit = float(concurrency)
+        self.max_concurrency = max(concurrency, max_concurrency)
+        self.in_flight = 0
+        self.throttled = 0
+        self.__tokens = self.rate
+        self.__updated = time.monotonic()
+        self.__backoff_until = 0
+        self.__last_decrease = 0
+        self.__strikes = 0
+        self.__cond = threading.Condition()
+
+    def __refill(self, now):
+        # At most one second worth of requests can be sent as a burst.
+        self.__tokens = min(self.rate, self.__tokens + (now - self.__updated) * self.rate)
+        self.__updated = now
+
+    def __take(self, cost, bounded=True):
+        """:return: 0 once the request is let through, else seconds to wait (None until a slot frees up)"""
+        now = time.monotonic()
+        self.__refill(now)
+        if now < self.__backoff_until:
+            return self.__backoff_until - now
+        if bounded and self.in_flight >= int(self.limit):
+            return None
+        if self.__tokens < min(cost, self.rate):
+            return (min(cost, self.rate) - self.__tokens) / self.rate
+        # A batch bigger than the bucket leaves it in debt.
+        self.__tokens -= cost
+        self.in_flight += 1
+        return 0
+
+    def acquire(self, cost=1):
+        """Blocks until a request carrying `cost` API calls may be sent."""
+        with self.__cond:
+            while True:
+                wait = self.__take(cost)
+                if wait == 0:
+                    return
+                self.__cond.wait(wait)
+
+    async def acquire_async(self, cost=1):
+        """
+        acquire() for coroutines. Only the rate and the backoff apply: the concurrency limit is
+        sized for the threaded connection pool, asyncio clients bound their requests in flight themselves.
+        """
+        while True:
+            with self.__cond:
+                wait = self.__take(cost, bounded=False)
+            if wait == 0:
+                return
+            await asyncio.sleep(wait)
+
+    def release(self, throttled=False, cost=1):
+        """Frees the slot of a finished request, throttled is None if it got no answer."""
+        with self.__cond:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if throttled:
+                self.throttled += 1
+                if now - self.__last_decrease >= DECREASE_HOLD:
+                    self.__last_decrease = now
+                    self.__strikes += 1
+                    self.rate = max(self.min_rate, self.rate / 2)
+                    self.limit = max(1.0, self.limit / 2)
+                    self.__tokens = min(self.__tokens, 0)
+                    backoff = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (self.__strikes - 1))
+                    self.__backoff_until = max(self.__backoff_until, now + random.uniform(0, backoff))
+            elif throttled is not None:
+                if now >= self.__backoff_until:
+                    self.__strikes = 0
+                # One more slot per limit's worth of successes, RATE_STEP more requests per second worth.
+                self.rate = min(self.max_rate, self.rate + RATE_STEP * cost / self.rate)
+                self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+            self.__cond.notify_all()
+
+
+class RateController:
+    """The AccountLimiter of every account, shared by all Drive clients in the process."""
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__limiters = {}
+
+    def limiter(self, account):
+        with self.__lock:
+            limiter = self.__limiters.get(account)
+            if limiter is None:
+                limiter = self.__limiters[account] = AccountLimiter()
+            return limiter
+
+    def stats(self):
+        """:return: {account: (requests per second, concurrency limit, in flight, throttled responses)}"""
+        with self.__lock:
+            limiters = dict(self.__limiters)
+        return {account: (limiter.rate, int(limiter.limit), limiter.in_flight, limiter.throttled)
+                for account, limiter in limiters.items()}
+
+
+controller = RateController()
@@ -0,0 +1,177 @@
+import datetime
+import glob
+import json
+import os
+import threading
+import time
+
+from google.oauth2 import service_account
+from bot import LOGGER
+from bot.drive_service import get_service
+from bot.config import SA_DAILY_LIMIT_GB
+
+OAUTH_SCOPE = ['https://www.googleapis.com/auth/drive']
+# Seconds a rate limited account rests, doubled for every further rate limit before it copies again.
+COOLDOWN = 10
+# Longest short cooldown acquire() waits out instead of giving up.
+MAX_COOLDOWN_WAIT = 300
+try:
+    from zoneinfo import ZoneInfo
+    # Drive quotas roll over at midnight Pacific time.
+    QUOTA_TIMEZONE = ZoneInfo('America/Los_Angeles')
+except Exception:
+    QUOTA_TIMEZONE = datetime.timezone(datetime.timedelta(hours=-8))
+
+
+class ServiceAccountsExhausted(Exception):
+    pass
+
+
+def quota_day():
+    return datetime.datetime.now(QUOTA_TIMEZONE).date()
+
+
+def next_quota_reset():
+    now = datetime.datetime.now(QUOTA_TIMEZONE)
+    midnight = datetime.datetime.combine(now.date() + datetime.timedelta(days=1), datetime.time(), QUOTA_TIMEZONE)
+    return midnight.timestamp()
+
+
+class ServiceAccount:
+    def __init__(self, index, path, credentials):
+        self.index = index
+        self.path = path
+        self.email = credentials.service_account_email
+        self.credentials = credentials
+        self.day = quota_day()
+        self.bytes_today = 0
+        self.exhausted_until = 0
+        # Rate limits in a row, reset by a successful copy.
+        self.strikes = 0
+        self.leases = 0
+
+    def __repr__(self):
+        return f"{os.path.basename(self.path)} ({self.email})"
+
+
+class ServiceAccountPool:
+    """
+    Loads every service account once and hands them out to clones.
+
+    Accounts are leased least-used first, bytes copied per account are counted
+    against the daily upload cap, and accounts that hit it are kept in cooldown
+    until the quota resets. Rate limited accounts only rest for a short, growing
+    cooldown. Drive clients are built once per account and thread.
+    """
+
+    def __init__(self, path='accounts', daily_limit=SA_DAILY_LIMIT_GB * 1024 ** 3, files=None):
+        """:param files: Load only these account files instead of every one in `path`"""
+        self.daily_limit = daily_limit
+        self.__lock = threading.Lock()
+        self.accounts = []
+        if files is None:
+            files = sorted(glob.glob(os.path.join(path, '*.json')),
+                           key=lambda f: (len(os.path.basename(f)), os.path.basename(f)))
+        for file in files:
+            try:
+                credentials = service_account.Credentials.from_service_account_file(file, scopes=OAUTH_SCOPE)
+            except (ValueError, KeyError, json.JSONDecodeError) as e:
+                LOGGER.error(f"Skipping invalid service account {file}: {e}")
+                continue
+            self.accounts.append(ServiceAccount(len(self.accounts), file, credentials))
+        self.__by_path = {account.path: account for account in self.accounts}
+        LOGGER.info(f"Loaded {len(self.accounts)} service accounts from {path}")
+
+    def __len__(self):
+        return len(self.accounts)
+
+    def __roll_day(self, account):
+        today = quota_day()
+        if account.day != today:
+            account.day = today
+            account.bytes_today = 0
+
+    def __available(self, account, now):
+        self.__roll_day(account)
+        return account.exhausted_until <= now and account.bytes_today < self.daily_limit
+
+    def acquire(self, exclude=None):
+        """
+        :return: The available account with the fewest leases and bytes copied today.
+        When every account is in a short cooldown, waits for the first one to come back.
+        """
+        while True:
+            now = datetime.datetime.now().timestamp()
+            with self.__lock:
+                candidates = [a for a in self.accounts if a is not exclude and self.__available(a, now)]
+                if candidates:
+                    account = min(candidates, key=lambda a: (a.leases, a.bytes_today))
+                    account.leases += 1
+                    break
+                resting = [a.exhausted_until for a in self.accounts
+                           if a.bytes_today < self.daily_limit and a.exhausted_until - now <= MAX_COOLDOWN_WAIT]
+            if not resting:
+                raise ServiceAccountsExhausted("Todas las cuentas de servicio agotaron su cuota diaria.")
+            exclude = None
+            time.sleep(max(0.0, min(resting) - now))
+        LOGGER.info(f"Using service account {account}")
+        return account
+
+    def release(self, account):
+        with self.__lock:
+            account.leases = max(0, account.leases - 1)
+
+    def record_bytes(self, account, size):
+        with self.__lock:
+            self.__roll_day(account)
+            account.bytes_today += size
+            account.strikes = 0
+
+    def mark_exhausted(self, account):
+        with self.__lock:
+            account.exhausted_until = next_quota_reset()
+        LOGGER.info(f"Service account {account} is in cooldown until the quota resets")
+
+    def mark_throttled(self, account):
+        """
+        Rests an account that got userRateLimitExceeded. Drive also answers that once the
+        daily copy quota is used up, so the cooldown doubles while the account keeps failing.
+        """
+        with self.__lock:
+            account.strikes += 1
+            cooldown = COOLDOWN * 2 ** (account.strikes - 1)
+            account.exhausted_until = min(datetime.datetime.now().timestamp() + cooldown, next_quota_reset())
+        LOGGER.info(f"Service account {account} is rate limited, resting {cooldown}s")
+
+    def find(self, path):
+        """:return: The account loaded from `path`, or None"""
+        return self.__by_path.get(path)
+
+    def service(self, account):
+        return get_service(account.path, lambda: account.credentials)
+
+    def stats(self):
+        now = datetime.datetime.now().timestamp()
+        with self.__lock:
+            available = sum(1 for a in self.accounts if self.__available(a, now))
+            used = sum(a.bytes_today for a in self.accounts)
+        return available, len(self.accounts), used
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def set_pool(pool):
+    """Replaces the process's pool, e.g. with the slice of accounts of a clone shard worker."""
+    global _pool
+    with _pool_lock:
+        _pool = pool
+
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ServiceAccountPool()
+        return _pool
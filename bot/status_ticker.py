@@ -0,0 +1,105 @@
+import threading
+import time
+
+from telegram.error import BadRequest, RetryAfter
+
+from bot import LOGGER
+from bot.config import STATUS_UPDATE_INTERVAL
+
+# Telegram allows about 30 messages per second overall and 20 per minute in a group.
+GLOBAL_EDITS_PER_SECOND = 20
+CHAT_EDIT_INTERVAL = 3
+
+
+class _Entry:
+    def __init__(self, msg, status, render):
+        self.msg = msg
+        self.status = status
+        self.render = render
+        self.chat_id = msg.chat_id
+        self.last_text = ''
+        self.next_at = 0
+
+
+class StatusTicker:
+    """
+    One thread that keeps every live clone status message up to date.
+
+    Each message is re-rendered from its CloneStatus at most every `interval` seconds
+    and only edited when the text changed. Edits are spaced globally and per chat,
+    and a RetryAfter from Telegram pauses that chat (or everything) for the time asked.
+    """
+
+    def __init__(self, interval=STATUS_UPDATE_INTERVAL, tick=0.5):
+        self.interval = interval
+        self.tick = tick
+        self.__entries = {}
+        self.__chat_next = {}
+        self.__global_next = 0
+        self.__lock = threading.Lock()
+        self.__thread = None
+
+    def add(self, msg, status, render):
+        with self.__lock:
+            self.__entries[(msg.chat_id, msg.message_id)] = _Entry(msg, status, render)
+            if self.__thread is None:
+                self.__thread = threading.Thread(target=self.__run, name='status-ticker', daemon=True)
+                self.__thread.start()
+
+    def remove(self, msg):
+        with self.__lock:
+            self.__entries.pop((msg.chat_id, msg.message_id), None)
+
+    def __run(self):
+        while True:
+            time.sleep(self.tick)
+            try:
+                self.__update_due()
+            except Exception as e:
+                LOGGER.error(f"Status ticker: {e}")
+
+    def __due(self, now):
+        with self.__lock:
+            for key, entry in list(self.__entries.items()):
+                if entry.status.done():
+                    del self.__entries[key]
+            # Messages waiting the longest go first so busy chats do not starve others.
+            entries = sorted(self.__entries.items(), key=lambda item: item[1].next_at)
+        return [entry for _, entry in entries if entry.next_at <= now]
+
+    def __update_due(self):
+        for entry in self.__due(time.time()):
+            now = time.time()
+            if self.__chat_next.get(entry.chat_id, 0) > now:
+                continue
+            text = entry.render(entry.status)
+            if text == entry.last_text:
+                entry.next_at = now + self.interval
+                continue
+            if self.__global_next > now:
+                time.sleep(self.__global_next - now)
+            self.__edit(entry, text)
+
+    def __edit(self, entry, text):
+        now = time.time()
+        self.__global_next = now + 1 / GLOBAL_EDITS_PER_SECOND
+        self.__chat_next[entry.chat_id] = now + CHAT_EDIT_INTERVAL
+        entry.next_at = now + self.interval
+        try:
+            entry.msg.edit_text(text=text, parse_mode="Markdown", timeout=30)
+            entry.last_text = text
+        except RetryAfter as e:
+            LOGGER.warning(f"Telegram asked to wait {e.retry_after}s before editing chat {entry.chat_id}")
+            self.__chat_next[entry.chat_id] = now + e.retry_after
+            # Flood control is per bot as well, keep the other chats quiet for a moment too.
+            self.__global_next = now + min(e.retry_after, CHAT_EDIT_INTERVAL)
+            entry.next_at = now + e.retry_after
+        except BadRequest as e:
+            if 'not modified' in str(e).lower():
+                entry.last_text = text
+            elif 'not found' in str(e).lower():
+                self.remove(entry.msg)
+            else:
+                LOGGER.error(f"Status ticker: {e}")
+        except Exception as e:
+            LOGGER.error(f"Status ticker: {e}")
@@ -0,0 +1,99 @@
+import sqlite3
+import threading
+import time
+
+from bot import LOGGER
+from bot.config import SYNC_STATE
+
+
+class SyncState:
+    """
+    Persistent state of a folder kept in sync with /sync, keyed by (source id, destination parent id).
+
+    It stores the Drive changes page token to continue from (per shared drive when the
+    source lives in one), the service account whose changes feed the token belongs to, and the source -> destination id of every folder and file copied,
+    so later syncs only have to apply what changes.list reports.
+    """
+
+    def __init__(self, source_id, dest_id, path=SYNC_STATE, commit_every=500, commit_interval=5):
+        self.source_id = source_id
+        self.dest_id = dest_id
+        self.__commit_every = commit_every
+        self.__commit_interval = commit_interval
+        self.__dirty = 0
+        self.__last_commit = time.time()
+        self.__lock = threading.Lock()
+        self.__db = sqlite3.connect(path, check_same_thread=False)
+        self.__db.executescript("""
+            CREATE TABLE IF NOT EXISTS sources (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                source_id TEXT NOT NULL,
+                dest_id TEXT NOT NULL,
+                drive_id TEXT,
+                page_token TEXT,
+                account TEXT,
+                synced REAL,
+                UNIQUE (source_id, dest_id)
+            );
+            CREATE TABLE IF NOT EXISTS items (
+                sync_id INTEGER NOT NULL,
+                source_id TEXT NOT NULL,
+                dest_id TEXT NOT NULL,
+                is_folder INTEGER NOT NULL,
+                PRIMARY KEY (sync_id, source_id)
+            );
+        """)
+        if 'account' not in [column[1] for column in self.__db.execute("PRAGMA table_info(sources)")]:
+            # Files from before tokens were tied to an account.
+            self.__db.execute("ALTER TABLE sources ADD COLUMN account TEXT")
+        row = self.__db.execute("SELECT id, drive_id, page_token, account FROM sources WHERE source_id = ? "
+                                "AND dest_id = ?", (source_id, dest_id)).fetchone()
+        if row is None:
+            cursor = self.__db.execute("INSERT INTO sources (source_id, dest_id) VALUES (?, ?)", (source_id, dest_id))
+            self.__db.commit()
+            self.__sync_id, self.drive_id, self.page_token, self.account = cursor.lastrowid, None, None, None
+        else:
+            self.__sync_id, self.drive_id, self.page_token, self.account = row
+
+    def __write(self, sql, params):
+        with self.__lock:
+            self.__db.execute(sql, params)
+            self.__dirty += 1
+            if self.__dirty >= self.__commit_every or time.time() - self.__last_commit >= self.__commit_interval:
+                self.__commit()
+
+    def __commit(self):
+        self.__db.commit()
+        self.__dirty = 0
+        self.__last_commit = time.time()
+
+    def lookup(self, source_id):
+        """:return: (dest_id, is_folder) of a synced source item, or None"""
+        with self.__lock:
+            row = self.__db.execute("SELECT dest_id, is_folder FROM items WHERE sync_id = ? AND source_id = ?",
+                                    (self.__sync_id, source_id)).fetchone()
+        return (row[0], bool(row[1])) if row else None
+
+    def map(self, source_id, dest_id, is_folder):
+        self.__write("INSERT OR REPLACE INTO items (sync_id, source_id, dest_id, is_folder) VALUES (?, ?, ?, ?)",
+                     (self.__sync_id, source_id, dest_id, int(is_folder)))
+
+    def unmap(self, source_id):
+        self.__write("DELETE FROM items WHERE sync_id = ? AND source_id = ?", (self.__sync_id, source_id))
+
+    def set_token(self, page_token, drive_id=None, account=None):
+        """
+        Saves the changes page token the next sync starts from.
+        :param account: Path of the service account the token was taken with
+        """
+        with self.__lock:
+            self.__db.execute("UPDATE sources SET page_token = ?, drive_id = ?, account = ?, synced = ? WHERE id = ?",
+                              (page_token, drive_id, account, time.time(), self.__sync_id))
+            self.__commit()
+        self.page_token, self.drive_id, self.account = page_token, drive_id, account
+        LOGGER.info(f"Sync of {self.source_id} -> {self.dest_id} continues from page token {page_token}")
+
+    def close(self):
+        with self.__lock:
+            self.__commit()
+            self.__db.close()
@@ -0,0 +1,187 @@
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from bot import LOGGER
+from bot.drive_index import G_DRIVE_DIR_MIME_TYPE
+
+FILE = 'file'
+FOLDER = 'folder'
+FOLDER_DONE = 'folder_done'
+
+
+class TreeWalker:
+    """
+    Walks a source tree breadth-first, listing up to `workers` folders at once.
+
+    walk() yields (kind, folder_id, meta) tuples as soon as each page is listed:
+      FILE / FOLDER  -> meta is a child of folder_id
+      FOLDER_DONE    -> folder_id has been listed completely, meta is None
+    A FOLDER entry is always yielded before anything from inside that folder.
+    """
+
+    def __init__(self, page_lister, workers=4, ignoreList=(), skip=(), max_pending=10000):
+        # page_lister(folder_id) must yield the children of folder_id one page at a time
+        self.__page_lister = page_lister
+        self.__workers = max(1, workers)
+        self.__ignore = set(ignoreList or ())
+        # Folders that are yielded but not descended into, e.g. already walked by a previous run
+        self.__skip = set(skip or ())
+        self.__queue = queue.Queue(maxsize=max_pending)
+        self.__lock = threading.Lock()
+        self.__outstanding = 0
+        self.__stopped = threading.Event()
+        self.__pool = None
+
+    def __put(self, item):
+        while not self.__stopped.is_set():
+            try:
+                self.__queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def __schedule(self, *folder_ids):
+        # Counted before submitting, so a fast listing can not see zero outstanding too early.
+        with self.__lock:
+            self.__outstanding += len(folder_ids)
+        for folder_id in folder_ids:
+            self.__pool.submit(self.__list, folder_id)
+
+    def __list(self, folder_id):
+        try:
+            for page in self.__page_lister(folder_id):
+                for meta in page:
+                    if self.__stopped.is_set():
+                        return
+                    if meta.get('mimeType') == G_DRIVE_DIR_MIME_TYPE:
+                        self.__put((FOLDER, folder_id, meta))
+                        if meta.get('id') in self.__ignore:
+                            LOGGER.info("Ignorando FolderID del clon: " + str(meta.get('id')))
+                        elif meta.get('id') not in self.__skip:
+                            self.__schedule(meta.get('id'))
+                    else:
+                        self.__put((FILE, folder_id, meta))
+            self.__put((FOLDER_DONE, folder_id, None))
+        except Exception as e:
+            self.__put(e)
+        finally:
+            with self.__lock:
+                self.__outstanding -= 1
+                finished = self.__outstanding == 0
+            if finished:
+                self.__put(None)
+
+    def stop(self):
+        self.__stopped.set()
+
+    def walk(self, *root_ids):
+        if not root_ids:
+            return
+        self.__pool = ThreadPoolExecutor(max_workers=self.__workers)
+        try:
+            self.__schedule(*root_ids)
+            while True:
+                try:
+                    item = self.__queue.get(timeout=1)
+                except queue.Empty:
+                    # stop() from another thread ends the walk even if no listing reports back.
+                    if self.__stopped.is_set():
+                        return
+                    continue
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            self.stop()
+            self.__pool.shutdown(wait=False)
+
+
+class SharedWalk:
+    """
+    One walk of a source tree fed to several consumers, e.g. the destinations of a fan-out clone.
+
+    Every consumer sees every entry of the walk in the same order. Queues are bounded,
+    so the walk goes as fast as the slowest consumer, and a consumer that stops is
+    dropped without holding the others back. The walk starts when the first consumer
+    asks for entries and ends once nobody is left to read it.
+    """
+
+    def __init__(self, walker, root_id, consumers, max_pending=10000):
+        self.__walker = walker
+        self.__root_id = root_id
+        self.__queues = [queue.Queue(maxsize=max_pending) for _ in range(consumers)]
+        self.__active = [True] * consumers
+        self.__lock = threading.Lock()
+        self.__thread = None
+
+    def consumer(self, index):
+        """:return: A walker-like view of the walk for consumer `index`"""
+        return _SharedWalkConsumer(self, index)
+
+    def detach(self, index):
+        with self.__lock:
+            self.__active[index] = False
+            finished = not any(self.__active)
+        if finished:
+            self.__walker.stop()
+
+    def __start(self):
+        with self.__lock:
+            if self.__thread is None:
+                self.__thread = threading.Thread(target=self.__run, name='shared-walk', daemon=True)
+                self.__thread.start()
+
+    def __run(self):
+        try:
+            for item in self.__walker.walk(self.__root_id):
+                if not self.__publish(item):
+                    return
+            self.__publish(None)
+        except Exception as e:
+            self.__publish(e)
+
+    def __publish(self, item):
+        """:return: Whether any consumer is still reading"""
+        delivered = False
+        for index, entries in enumerate(self.__queues):
+            while self.__active[index]:
+                try:
+                    entries.put(item, timeout=1)
+                    delivered = True
+                    break
+                except queue.Full:
+                    continue
+        return delivered
+
+    def entries(self, index):
+        self.__start()
+        entries = self.__queues[index]
+        try:
+            while self.__active[index]:
+                try:
+                    item = entries.get(timeout=1)
+                except queue.Empty:
+                    continue
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            self.detach(index)
+
+
+class _SharedWalkConsumer:
+    def __init__(self, shared, index):
+        self.__shared = shared
+        self.__index = index
+
+    def walk(self, *root_ids):
+        # The roots are those of the shared walk.
+        return self.__shared.entries(self.__index)
+
+    def stop(self):
+        self.__shared.detach(self.__index)
@@ -2,12 +2,14 @@ import errno
 import os
 import pickle
 import sys
+import threading
 from argparse import ArgumentParser
 from base64 import b64decode
+from concurrent.futures import ThreadPoolExecutor
 from glob import glob
 from json import loads
-from random import choice
-from time import sleep
+from random import choice, random
+from time import sleep, monotonic
 
 from google.auth.transport.requests import Request
 from google_auth_oauthlib.flow import InstalledAppFlow
@@ -16,29 +18,149 @@ from googleapiclient.errors import HttpError
 
 SCOPES = ['https://www.googleapis.com/auth/drive', 'https://www.googleapis.com/auth/cloud-platform',
           'https://www.googleapis.com/auth/iam']
-project_create_ops = []
-current_key_dump = []
 sleep_time = 30
+# Most sub-requests in one batch request.
+batch_size = 100
+# Rounds of retries of the sub-requests of a batch that keep failing.
+batch_attempts = 10
+# Polling rounds in which a project creation operation can go unanswered before it counts as failed.
+poll_failures = 5
+_local = threading.local()
+
+
+class _Backoff:
+    """
+    Shared by every thread: a 429 on any of them pauses all requests, the pause doubles
+    (up to sleep_time) while 429s go on and shrinks again once requests get through.
+    """
+
+    def __init__(self, base=sleep_time / 100, cap=sleep_time):
+        self.__base = base
+        self.__cap = cap
+        self.__delay = 0
+        self.__until = 0
+        self.__lock = threading.Lock()
+
+    def wait(self):
+        while True:
+            with self.__lock:
+                remaining = self.__until - monotonic()
+            if remaining <= 0:
+                return
+            sleep(remaining)
+
+    def throttled(self):
+        with self.__lock:
+            self.__delay = min(self.__cap, self.__delay * 2 or self.__base)
+            # Jittered, so threads do not all come back at the same moment.
+            self.__until = max(self.__until, monotonic() + self.__delay * (0.5 + random() / 2))
+
+    def succeeded(self):
+        with self.__lock:
+            self.__delay = self.__delay / 2 if self.__delay > self.__base else 0
+
+
+backoff = _Backoff()
+
+
+# Key files named 0.json, 1.json... in path, numbered after the keys already there
+class _KeyWriter:
+    def __init__(self, path):
+        self.__path = path
+        self.__lock = threading.Lock()
+        indexes = [int(os.path.basename(i)[:-5]) for i in glob(os.path.join(path, '*.json'))
+                   if os.path.basename(i)[:-5].isdigit()]
+        self.__next = max(indexes, default=-1) + 1
+
+    def write(self, data):
+        with self.__lock:
+            index = self.__next
+            self.__next += 1
+        # Written aside and renamed, so the bot never reads half a key.
+        tmp = os.path.join(self.__path, '.%d.json.tmp' % index)
+        with open(tmp, 'w') as f:
+            f.write(data)
+        os.replace(tmp, os.path.join(self.__path, '%d.json' % index))
+
+
+# googleapiclient services are not thread safe, every thread builds its own
+def _service(credentials, name, version):
+    services = _local.__dict__.setdefault('services', {})
+    if (name, version) not in services:
+        services[(name, version)] = build(name, version, credentials=credentials, cache_discovery=False)
+    return services[(name, version)]
+
+
+# Run work(project) for several projects at once
+def _for_each_project(projects, work, workers):
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        for i in [executor.submit(work, j) for j in projects]:
+            i.result()
+
+
+def _is_retryable(exception):
+    return isinstance(exception, HttpError) and (exception.resp.status == 429 or exception.resp.status >= 500)
+
+
+# Run {request_id: request} in batches, retrying only the sub-requests that failed
+def _batch(service, requests):
+    responses = {}
+    pending = dict(requests)
+    for attempt in range(batch_attempts):
+        failed = {}
+
+        def callback(request_id, resp, exception):
+            if exception is None:
+                responses[request_id] = resp
+            elif _is_retryable(exception):
+                failed[request_id] = pending[request_id]
+            else:
+                print(str(exception))
+
+        ids = list(pending)
+        for i in range(0, len(ids), batch_size):
+            backoff.wait()
+            batch = service.new_batch_http_request(callback=callback)
+            for j in ids[i:i + batch_size]:
+                batch.add(pending[j], request_id=j)
+            try:
+                batch.execute()
+            except HttpError as e:
+                if not _is_retryable(e):
+                    raise
+                failed.update((j, pending[j]) for j in ids[i:i + batch_size] if j not in responses)
+        if not failed:
+            backoff.succeeded()
+            break
+        backoff.throttled()
+        pending = failed
+    else:
+        print('%d solicitudes fallaron tras %d intentos' % (len(pending), batch_attempts))
+    return responses
 
 
-# Create count SAs in project
+# Create count SAs in project, return how many were created
 def _create_accounts(service, project, count):
-    batch = service.new_batch_http_request(callback=_def_batch_resp)
+    requests = {}
     for i in range(count):
         aid = _generate_id('mfc-')
-        batch.add(service.projects().serviceAccounts().create(name='projects/' + project, body={'accountId': aid,
-                                                                                                'serviceAccount': {
-                                                                                                    'displayName': aid}}))
-    batch.execute()
+        requests[aid] = service.projects().serviceAccounts().create(name='projects/' + project,
+                                                                    body={'accountId': aid,
+                                                                          'serviceAccount': {'displayName': aid}})
+    return len(_batch(service, requests))
 
 
 # Create accounts needed to fill project
 def _create_remaining_accounts(iam, project):
     print('Creando cuentas en %s' % project)
-    sa_count = len(_list_sas(iam, project))
-    while sa_count != 100:
-        _create_accounts(iam, project, 100 - sa_count)
-        sa_count = len(_list_sas(iam, project))
+    # New accounts take a while to be listed, so they are counted instead of listed again.
+    missing = 100 - len(_list_sas(iam, project))
+    while missing > 0:
+        created = _create_accounts(iam, project, missing)
+        if not created:
+            print('No se pudieron crear cuentas en %s' % project)
+            return
+        missing -= created
 
 
 # Generate a random id
@@ -52,52 +174,42 @@ def _get_projects(service):
     return [i['projectId'] for i in service.projects().list().execute()['projects']]
 
 
-# Default batch callback handler
-def _def_batch_resp(id, resp, exception):
-    if exception is not None:
-        if str(exception).startswith('<HttpError 429'):
-            sleep(sleep_time / 100)
-        else:
-            print(str(exception))
-
-
-# Project Creation Batch Handler
-def _pc_resp(id, resp, exception):
-    global project_create_ops
-    if exception is not None:
-        print(str(exception))
-    else:
-        for i in resp.values():
-            project_create_ops.append(i)
-
-
 # Project Creation
 def _create_projects(cloud, count):
-    global project_create_ops
-    batch = cloud.new_batch_http_request(callback=_pc_resp)
-    new_projs = []
+    requests = {}
     for i in range(count):
         new_proj = _generate_id()
-        new_projs.append(new_proj)
-        batch.add(cloud.projects().create(body={'project_id': new_proj}))
-    batch.execute()
+        requests[new_proj] = cloud.projects().create(body={'project_id': new_proj})
+    ops = {resp['name']: project for project, resp in _batch(cloud, requests).items()}
 
-    for i in project_create_ops:
-        while True:
-            resp = cloud.operations().get(name=i).execute()
-            if 'done' in resp and resp['done']:
-                break
+    # All operations are polled together, one batch request per round.
+    new_projs = []
+    misses = {i: 0 for i in ops}
+    while ops:
+        responses = _batch(cloud, {i: cloud.operations().get(name=i) for i in ops})
+        for name in list(ops):
+            if name in responses:
+                misses[name] = 0
+                continue
+            misses[name] += 1
+            if misses[name] >= poll_failures:
+                print('No se pudo consultar la creación de %s' % ops.pop(name))
+        for name, resp in responses.items():
+            if resp.get('done'):
+                project = ops.pop(name)
+                if 'error' in resp:
+                    print('No se pudo crear %s: %s' % (project, resp['error'].get('message')))
+                else:
+                    new_projs.append(project)
+        if ops:
             sleep(3)
     return new_projs
 
 
 # Enable services ste for projects in projects
 def _enable_services(service, projects, ste):
-    batch = service.new_batch_http_request(callback=_def_batch_resp)
-    for i in projects:
-        for j in ste:
-            batch.add(service.services().enable(name='projects/%s/services/%s' % (i, j)))
-    batch.execute()
+    _batch(service, {'%s/%s' % (i, j): service.services().enable(name='projects/%s/services/%s' % (i, j))
+                     for i in projects for j in ste})
 
 
 # List SAs in project
@@ -108,57 +220,27 @@ def _list_sas(iam, project):
     return []
 
 
-# Create Keys Batch Handler
-def _batch_keys_resp(id, resp, exception):
-    global current_key_dump
-    if exception is not None:
-        current_key_dump = None
-        sleep(sleep_time / 100)
-    elif current_key_dump is None:
-        sleep(sleep_time / 100)
-    else:
-        current_key_dump.append((
-            resp['name'][resp['name'].rfind('/'):],
-            b64decode(resp['privateKeyData']).decode('utf-8')
-        ))
-
-
 # Create Keys
-def _create_sa_keys(iam, projects, path):
-    global current_key_dump
-    for i in projects:
-        current_key_dump = []
-        print('Descargando claves de %s' % i)
-        while current_key_dump is None or len(current_key_dump) != 100:
-            batch = iam.new_batch_http_request(callback=_batch_keys_resp)
-            total_sas = _list_sas(iam, i)
-            for j in total_sas:
-                batch.add(iam.projects().serviceAccounts().keys().create(
-                    name='projects/%s/serviceAccounts/%s' % (i, j['uniqueId']),
-                    body={
-                        'privateKeyType': 'TYPE_GOOGLE_CREDENTIALS_FILE',
-                        'keyAlgorithm': 'KEY_ALG_RSA_2048'
-                    }
-                ))
-            batch.execute()
-            if current_key_dump is None:
-                print('Descargando claves de %s' % i)
-                current_key_dump = []
-            else:
-                index = 0
-                for j in current_key_dump:
-                    with open(f'{path}/{index}.json', 'w+') as f:
-                        f.write(j[1])
-                    index += 1
+def _create_sa_keys(iam, project, keys):
+    print('Descargando claves de %s' % project)
+    requests = {}
+    for i in _list_sas(iam, project):
+        requests[i['uniqueId']] = iam.projects().serviceAccounts().keys().create(
+            name='projects/%s/serviceAccounts/%s' % (project, i['uniqueId']),
+            body={
+                'privateKeyType': 'TYPE_GOOGLE_CREDENTIALS_FILE',
+                'keyAlgorithm': 'KEY_ALG_RSA_2048'
+            }
+        )
+    for resp in _batch(iam, requests).values():
+        keys.write(b64decode(resp['privateKeyData']).decode('utf-8'))
 
 
 # Delete Service Accounts
 def _delete_sas(iam, project):
-    sas = _list_sas(iam, project)
-    batch = iam.new_batch_http_request(callback=_def_batch_resp)
-    for i in sas:
-        batch.add(iam.projects().serviceAccounts().delete(name=i['name']))
-    batch.execute()
+    print('Eliminando cuentas de servicio en %s' % project)
+    _batch(iam, {i['uniqueId']: iam.projects().serviceAccounts().delete(name=i['name'])
+                 for i in _list_sas(iam, project)})
 
 
 def serviceaccountfactory(
@@ -173,7 +255,8 @@ def serviceaccountfactory(
         services=['iam', 'drive'],
         create_sas=None,
         delete_sas=None,
-        download_keys=None
+        download_keys=None,
+        workers=4
 ):
     selected_projects = []
     proj_id = loads(open(credentials, 'r').read())['installed']['project_id']
@@ -249,8 +332,7 @@ def serviceaccountfactory(
             stc = selected_projects
         elif create_sas == '*':
             stc = _get_projects(cloud)
-        for i in stc:
-            _create_remaining_accounts(iam, i)
+        _for_each_project(stc, lambda i: _create_remaining_accounts(_service(creds, 'iam', 'v1'), i), workers)
     if download_keys:
         try:
             os.mkdir(path)
@@ -265,7 +347,8 @@ def serviceaccountfactory(
             std = selected_projects
         elif download_keys == '*':
             std = _get_projects(cloud)
-        _create_sa_keys(iam, std, path)
+        keys = _KeyWriter(path)
+        _for_each_project(std, lambda i: _create_sa_keys(_service(creds, 'iam', 'v1'), i, keys), workers)
     if delete_sas:
         std = []
         std.append(delete_sas)
@@ -273,9 +356,7 @@ def serviceaccountfactory(
             std = selected_projects
         elif delete_sas == '*':
             std = _get_projects(cloud)
-        for i in std:
-            print('Eliminando cuentas de servicio en %s' % i)
-            _delete_sas(iam, i)
+        _for_each_project(std, lambda i: _delete_sas(_service(creds, 'iam', 'v1'), i), workers)
 
 
 if __name__ == '__main__':
@@ -299,6 +380,8 @@ if __name__ == '__main__':
     parse.add_argument('--quick-setup', default=None, type=int,
                        help='Cree proyectos, habilite servicios, cree cuentas de servicio y descargue claves. ')
     parse.add_argument('--new-only', default=False, action='store_true', help='No utilice proyectos existentes.')
+    parse.add_argument('--workers', type=int, default=4,
+                       help='Proyectos en los que se trabaja a la vez. Por defecto: 4')
     args = parse.parse_args()
     # If credentials file is invalid, search for one.
     if not os.path.exists(args.credentials):
@@ -346,7 +429,8 @@ if __name__ == '__main__':
         delete_sas=args.delete_sas,
         enable_services=args.enable_services,
         services=args.services,
-        download_keys=args.download_keys
+        download_keys=args.download_keys,
+        workers=args.workers
     )
     if resp is not None:
         if args.list_projects: